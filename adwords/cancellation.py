@@ -0,0 +1,200 @@
+'''
+adwords.cancellation
+
+Deadlines and cooperative cancellation of long mapper calls. A token is
+checked by RequestProcessor before every request and during its delays:
+
+    token = cancellation.CancellationToken(timeout=3600)
+    try:
+        mapper.clone_account('from@example.com', 'to@example.com', cancel_token=token)
+    except cancellation.OperationCancelledError, e:
+        print e.status
+
+Work done before a token fires is committed. Units which would leave
+AdWords and the mapper database out of sync if stopped halfway (like
+adding an adgroup and recording it) are shielded and always finished, so a
+call stops at most one unit after its deadline.
+
+@version: 0.1.1
+'''
+
+from __future__ import with_statement
+
+import time
+import threading
+import functools
+import contextlib
+
+#-------------------------------------------------------------------------------
+
+CANCELLED = 'cancelled'
+DEADLINE = 'deadline'
+
+
+class OperationCancelledError(Exception):
+    '''
+    Raised when a cancellation token fires. 'reason' is CANCELLED or
+    DEADLINE, 'status' is a dict describing the progress made, filled in by
+    the mapper function cancelled (always with its name as 'operation') so
+    the rest of the work can be resumed.
+    '''
+    def __init__(self, reason=CANCELLED, status=None):
+        Exception.__init__(self, 'Operation stopped: %s' % reason)
+        self.reason = reason
+        self.status = status or {}
+
+
+class CancellationToken:
+    '''
+    Fires when cancel() is called (from any thread) or when its deadline
+    passes.
+    '''
+
+    def __init__(self, deadline=None, timeout=None):
+        '''
+        @param deadline: float - time.time() value
+        @param timeout: float - seconds from now, instead of a deadline
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.deadline = deadline
+        self.reason = None
+
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return '<CancellationToken %s>' % (self.is_cancelled() and self.reason or 'active')
+
+    def cancel(self):
+        if self.reason is None:
+            self.reason = CANCELLED
+        self._event.set()
+
+    def remaining(self):
+        '''
+        @return: float - seconds left to the deadline, None without one
+        '''
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def is_cancelled(self):
+        '''
+        @return: bool
+        '''
+        if self._event.isSet():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            if self.reason is None:
+                self.reason = DEADLINE
+            return True
+        return False
+
+    def check(self):
+        '''
+        Raises OperationCancelledError if the token has fired, unless called
+        in a shielded() block.
+        '''
+        if self.is_cancelled() and not is_shielded():
+            raise OperationCancelledError(self.reason)
+
+    def sleep(self, seconds):
+        '''
+        Sleeps a number of seconds, raising OperationCancelledError as soon
+        as the token fires. In a shielded() block it just sleeps.
+
+        @param seconds: float
+        '''
+        if is_shielded():
+            time.sleep(seconds)
+            return
+
+        self.check()
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._event.wait(seconds)
+        self.check()
+
+#-------------------------------------------------------------------------------
+
+_local = threading.local()
+
+
+def get_current():
+    '''
+    Returns the token activated by use() in the current thread, if any.
+
+    @return: CancellationToken
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+@contextlib.contextmanager
+def use(token):
+    '''
+    Makes mapper calls and processors in the current thread check a given
+    token inside a with-block.
+
+    @param token: CancellationToken
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append(token)
+    try:
+        yield token
+    finally:
+        stack.pop()
+
+
+def check():
+    '''
+    Raises OperationCancelledError if the token of the current thread has
+    fired, see CancellationToken.check().
+    '''
+    token = get_current()
+    if token is not None:
+        token.check()
+
+
+@contextlib.contextmanager
+def shielded(check_first=True):
+    '''
+    Makes tokens of the current thread not fire inside a with-block, for
+    units of work which have to be finished once started. Unless told
+    otherwise a unit isn't started when the token has already fired.
+
+    @param check_first: bool
+    '''
+    if check_first:
+        check()
+    _local.shield = getattr(_local, 'shield', 0) + 1
+    try:
+        yield
+    finally:
+        _local.shield -= 1
+
+
+def unit(function):
+    '''
+    Decorator running a function in a shielded() block.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with shielded():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def is_shielded():
+    '''
+    @return: bool
+    '''
+    return getattr(_local, 'shield', 0) > 0
+#-------------------------------------------------------------------------------
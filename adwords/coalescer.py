@@ -0,0 +1,161 @@
+'''
+adwords.coalescer
+
+@version: 0.1.1
+'''
+
+from __future__ import with_statement
+
+import threading
+
+import mapper
+import configuration
+import metrics
+import logwriter
+import settings
+
+#-------------------------------------------------------------------------------
+
+class WriteBuffer:
+    '''
+    Buffers modify_keywords() and change_default_bid() calls and sends them
+    to AdWords later with one mapper.update_sets() call. Calls for a set
+    made meanwhile are merged - only the last keywords list and the last bid
+    are sent, both in one EditKeywords submission per adgroup:
+
+        buffer = WriteBuffer()
+        buffer.modify_keywords('shoes', keywords)
+        buffer.change_default_bid('shoes', Decimal('0.30'))
+        buffer.modify_keywords('shoes', other_keywords)
+        buffer.flush()  # a single write of other_keywords with bid 0.30
+
+    Pending updates are flushed by a timer a given delay after the first of
+    them, or explicitly by flush()/close(). Reads like mapper.get_keywords()
+    don't see pending updates.
+    '''
+
+    def __init__(self, delay=None, config=None):
+        '''
+        @param delay: float - seconds, settings.COALESCE_DELAY by default,
+            0 to flush only explicitly
+        @param config: configuration.Configuration - the current one by default
+        '''
+        self.delay = settings.COALESCE_DELAY if delay is None else delay
+        self.configuration = config or configuration.get_current()
+
+        # updates received, sets written and the difference - writes avoided
+        self.stats = {'updates': 0, 'writes': 0, 'avoided': 0}
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._calls = {}
+        self._timer = None
+
+    def modify_keywords(self, set, new_keywords):
+        '''
+        Buffered mapper.modify_keywords(). Keywords are read right away,
+        a generator or a database cursor is not kept till the flush.
+
+        @param set: str
+        @param new_keywords: iterable
+        '''
+        keywords = list(new_keywords)
+        if len(keywords) == 0:
+            raise ValueError('"new_keywords" should not be empty')
+        self._add(set, 'keywords', keywords)
+
+    def change_default_bid(self, set, bid):
+        '''
+        Buffered mapper.change_default_bid().
+
+        @param set: str
+        @param bid: Decimal
+        '''
+        self._add(set, 'bid', bid)
+
+    def pending(self):
+        '''
+        @return: dict - set name => update, as passed to mapper.update_sets()
+        '''
+        with self._lock:
+            return dict([(set, dict(update)) for set, update in self._pending.items()])
+
+    def flush(self):
+        '''
+        Sends all pending updates. If that fails the updates not replaced
+        meanwhile are kept pending and the error is raised.
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            updates, calls = self._pending, self._calls
+            self._pending, self._calls = {}, {}
+
+        if not updates:
+            return
+
+        try:
+            with configuration.use(self.configuration):
+                mapper.update_sets(updates)
+        except Exception, e:
+            self._restore(updates, calls)
+            self.last_error = e
+            raise
+
+        avoided = sum(calls.values()) - len(updates)
+        with self._lock:
+            self.stats['writes'] += len(updates)
+            self.stats['avoided'] += avoided
+
+        logwriter.log(logwriter.INFO, 'coalesced %d updates into %d set writes' % (sum(calls.values()), len(updates)))
+        if metrics.enabled() and avoided:
+            metrics.increment('adwords_writes_avoided_total', {}, avoided)
+
+    def close(self):
+        '''
+        Flushes pending updates, the buffer shouldn't be used after that.
+        '''
+        self.flush()
+
+    def _add(self, set, key, value):
+        self._check_set(set)
+
+        with self._lock:
+            self._pending.setdefault(set, {})[key] = value
+            self._calls[set] = self._calls.get(set, 0) + 1
+            self.stats['updates'] += 1
+
+            if self._timer is None and self.delay:
+                self._timer = threading.Timer(self.delay, self._flush_on_timer)
+                self._timer.setDaemon(True)
+                self._timer.start()
+
+    def _restore(self, updates, calls):
+        with self._lock:
+            for set, update in updates.items():
+                merged = dict(update)
+                merged.update(self._pending.get(set, {}))
+                self._pending[set] = merged
+                self._calls[set] = self._calls.get(set, 0) + calls[set]
+
+    def _flush_on_timer(self):
+        # updates of a failed flush stay pending until the next update
+        # starts a timer again or flush() is called
+        try:
+            self.flush()
+        except Exception, e:
+            logwriter.log(logwriter.ERROR, '! coalesced flush failed: %s' % e)
+
+    def _check_set(self, set):
+        # failing now rather than on a flush which may happen on a timer
+        with configuration.use(self.configuration):
+            if not _set_exists(set):
+                raise ValueError('Set "%s" not found' % set)
+
+
+@mapper.transactional
+def _set_exists(set):
+    return mapper.get_session().query(mapper.AdGroup.id).filter(mapper.AdGroup.set == set).first() is not None
+#-------------------------------------------------------------------------------
@@ -0,0 +1,224 @@
+'''
+adwords.configuration
+
+@version: 0.1.1
+'''
+
+import threading
+import contextlib
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+class Configuration:
+    '''
+    Holds the database engine and session used by adwords.mapper. Nothing is
+    connected or even imported until the engine or the session is first
+    asked for, so importing the package stays cheap.
+
+    Several configurations can live in one process, see use().
+    '''
+
+    def __init__(self, db_connection=None, debug_db=None, pool_size=None, 
+                 max_overflow=None, pool_recycle=None, pool_timeout=None):
+        '''
+        Arguments left None are taken from adwords.settings.
+
+        @param db_connection: str
+        @param debug_db: bool
+        @param pool_size: int
+        @param max_overflow: int
+        @param pool_recycle: int - seconds
+        @param pool_timeout: int - seconds
+        '''
+        self.db_connection = db_connection or settings.DB_CONNECTION
+        self.debug_db = settings.DEBUG_DB if debug_db is None else debug_db
+        self.pool_size = pool_size or settings.DB_POOL_SIZE
+        self.max_overflow = settings.DB_MAX_OVERFLOW if max_overflow is None else max_overflow
+        self.pool_recycle = pool_recycle or settings.DB_POOL_RECYCLE
+        self.pool_timeout = pool_timeout or settings.DB_POOL_TIMEOUT
+
+        self._lock = threading.Lock()
+        self._engine = None
+        self._sessions = None
+
+    def __repr__(self):
+        return '<Configuration "%s">' % self.db_connection
+
+    def get_engine(self):
+        '''
+        @return: sqlalchemy.engine.Engine
+        '''
+        if self._engine is None:
+            self._lock.acquire()
+            try:
+                if self._engine is None:
+                    from sqlalchemy import create_engine
+                    self._engine = create_engine(self.db_connection, **self._engine_options())
+            finally:
+                self._lock.release()
+
+        return self._engine
+
+    def _engine_options(self):
+        options = {'echo': self.debug_db}
+
+        if self.is_sqlite():
+            # sqlite uses its own per-thread pool which can't be sized
+            options.update({
+                'connect_args': {'timeout': settings.SQLITE_BUSY_TIMEOUT},
+                'listeners': [_SQLitePragmas(settings.SQLITE_PRAGMAS)],
+            })
+        else:
+            options.update({
+                'pool_size': self.pool_size,
+                'max_overflow': self.max_overflow,
+                'pool_recycle': self.pool_recycle,
+                'pool_timeout': self.pool_timeout,
+            })
+
+        return options
+
+    def is_sqlite(self):
+        '''
+        @return: bool
+        '''
+        return self.db_connection.startswith('sqlite')
+
+    def get_session(self):
+        '''
+        Returns the session of the current thread. Every thread gets its own
+        session, all of them sharing the engine connection pool.
+
+        @return: sqlalchemy.orm.Session
+        '''
+        if self._sessions is None:
+            engine = self.get_engine()
+            self._lock.acquire()
+            try:
+                if self._sessions is None:
+                    from sqlalchemy.orm import sessionmaker, scoped_session
+                    self._sessions = scoped_session(sessionmaker(bind=engine))
+            finally:
+                self._lock.release()
+
+        return self._sessions()
+
+    def remove_session(self):
+        '''
+        Closes the session of the current thread, e.g. before the thread
+        exits. A new one is created on next get_session() call.
+        '''
+        if self._sessions is not None:
+            self._sessions.remove()
+
+    def dispose(self):
+        '''
+        Closes the session of the current thread and all pooled connections.
+        They will be created again if the configuration is used after that.
+        '''
+        self._lock.acquire()
+        try:
+            if self._sessions is not None:
+                self._sessions.remove()
+                self._sessions = None
+            if self._engine is not None:
+                self._engine.dispose()
+                self._engine = None
+        finally:
+            self._lock.release()
+
+    engine = property(get_engine)
+    session = property(get_session)
+
+
+class _SQLitePragmas(object):
+    '''
+    Pool listener applying settings.SQLITE_PRAGMAS to every new sqlite
+    connection (WAL journal, relaxed fsync, bigger cache, etc).
+    '''
+
+    def __init__(self, pragmas):
+        self.pragmas = pragmas
+
+    def connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+
+#-------------------------------------------------------------------------------
+
+_default = None
+_default_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_default():
+    '''
+    Returns the process-wide configuration built from adwords.settings,
+    creating it on first call.
+
+    @return: Configuration
+    '''
+    global _default
+
+    if _default is None:
+        _default_lock.acquire()
+        try:
+            if _default is None:
+                _default = Configuration()
+        finally:
+            _default_lock.release()
+
+    return _default
+
+
+def set_default(configuration):
+    '''
+    Replaces the process-wide configuration.
+
+    @param configuration: Configuration
+    '''
+    global _default
+    _default = configuration
+
+
+def get_current():
+    '''
+    Returns the configuration activated by use() in the current thread or
+    the default one.
+
+    @return: Configuration
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+
+    return get_default()
+
+
+@contextlib.contextmanager
+def use(configuration):
+    '''
+    Makes mapper calls in the current thread use a given configuration
+    inside a with-block:
+
+        with configuration.use(Configuration('sqlite:///other.db')):
+            mapper.create_set(...)
+
+    @param configuration: Configuration
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append(configuration)
+    try:
+        yield configuration
+    finally:
+        stack.pop()
+#-------------------------------------------------------------------------------
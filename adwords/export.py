@@ -0,0 +1,360 @@
+'''
+adwords.export
+
+Streams keyword performance reports and keyword sets to CSV or JSON lines
+files for analysis elsewhere (e.g. pandas.read_csv()):
+
+    python -m adwords.export report /data/adwords --days 7
+    python -m adwords.export keywords /data/adwords --format jsonl --set shoes
+
+Files are partitioned by kind and date, one or more files per set:
+
+    /data/adwords/report/date=2009-06-01/shoes.00000.csv
+
+Rows are written as soon as an adgroup is fetched, so memory use doesn't
+depend on the number of sets or keywords. A set's files appear under their
+final names only once the whole set is written, and sets already exported
+for a date are skipped, so an interrupted or repeated export of the same
+date only appends the missing sets.
+
+@version: 0.1.1
+'''
+
+import os
+import csv
+import json
+import urllib
+import decimal
+import datetime
+import optparse
+
+import mapper
+import settings
+
+#-------------------------------------------------------------------------------
+
+REPORT = 'report'
+KEYWORDS = 'keywords'
+
+COLUMNS = {
+    REPORT: ('date', 'account', 'set', 'campaign_id', 'adgroup_id', 'keyword', 'days',
+             'bid', 'clicks', 'impr', 'ctr', 'cpc', 'cost', 'pos'),
+    KEYWORDS: ('date', 'account', 'set', 'campaign_id', 'adgroup_id', 'keyword', 'text',
+               'match_mode', 'bid', 'url'),
+}
+
+FORMATS = ('csv', 'jsonl')
+
+#-------------------------------------------------------------------------------
+
+class SetWriter:
+    '''
+    Writes rows of one set to files of a partition, starting a new file
+    every chunk_rows rows. Files are written under temporary names and
+    renamed by commit().
+    '''
+
+    def __init__(self, partition, set, columns, format='csv', chunk_rows=None):
+        '''
+        @param partition: str - directory
+        @param set: str
+        @param columns: tuple
+        @param format: str - 'csv' or 'jsonl'
+        @param chunk_rows: int
+        '''
+        self.partition = partition
+        self.set = set
+        self.columns = columns
+        self.format = format
+        self.chunk_rows = chunk_rows or settings.EXPORT_CHUNK_ROWS
+        self.rows = 0
+
+        self._paths = []
+        self._file = None
+        self._writer = None
+
+    def write(self, row):
+        '''
+        @param row: tuple - values in the columns order
+        '''
+        if self.rows % self.chunk_rows == 0:
+            self._open_next()
+
+        if self.format == 'csv':
+            self._writer.writerow([_csv_value(value) for value in row])
+        else:
+            self._file.write(json.dumps(dict(zip(self.columns, [_json_value(value) for value in row]))) + '\n')
+
+        self.rows += 1
+
+    def _open_next(self):
+        self._close()
+
+        path = set_path(self.partition, self.set, len(self._paths), self.format)
+        self._paths.append(path)
+        self._file = open(path + '.tmp', 'wb')
+
+        if self.format == 'csv':
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.columns)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def commit(self):
+        '''
+        Closes the files and gives them their final names, removing files
+        left by an earlier export of the set. A set without rows still gets
+        an (empty) file, so it's known to be exported.
+        '''
+        if not self._paths:
+            self._open_next()
+        self._close()
+        for path in self._paths:
+            os.rename(path + '.tmp', path)
+
+        for path in set_files(self.partition, self.set):
+            if path not in self._paths:
+                os.remove(path)
+
+    def abort(self):
+        '''
+        Closes and removes the files written so far.
+        '''
+        self._close()
+        for path in self._paths:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _json_value(value):
+    # decimals are kept exact as strings instead of being turned into floats
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+#-------------------------------------------------------------------------------
+
+def get_partition(directory, kind, date):
+    '''
+    @param directory: str
+    @param kind: str - REPORT or KEYWORDS
+    @param date: datetime.date
+
+    @return: str
+    '''
+    return os.path.join(directory, kind, 'date=%s' % date.isoformat())
+
+
+def set_path(partition, set, number, format):
+    '''
+    @return: str - path of a given file of a set in a partition
+    '''
+    return os.path.join(partition, '%s.%05d.%s' % (urllib.quote(set, ''), number, format))
+
+
+def _iter_files(partition):
+    # (set, path) of every file fully written to a partition
+    if not os.path.isdir(partition):
+        return
+
+    for name in os.listdir(partition):
+        parts = name.rsplit('.', 2)
+        if len(parts) == 3 and parts[1].isdigit() and parts[2] in FORMATS:
+            yield urllib.unquote(parts[0]), os.path.join(partition, name)
+
+
+def exported_sets(partition):
+    '''
+    Returns names of the sets fully written to a partition.
+
+    @param partition: str
+
+    @return: set
+    '''
+    return set([file_set for file_set, path in _iter_files(partition)])
+
+
+def set_files(partition, set):
+    '''
+    Returns paths of the files of a set fully written to a partition.
+
+    @param partition: str
+    @param set: str
+
+    @return: list
+    '''
+    return [path for file_set, path in _iter_files(partition) if file_set == set]
+
+
+@mapper.transactional
+def list_adgroups(sets=None):
+    '''
+    Returns adgroups of given (or all) sets as tuples (email, password, set,
+    campaign_id, adgroup_id) ordered by account, set and adgroup. Plain
+    tuples are returned so no session is held while fetching.
+
+    @param sets: list
+
+    @return: list
+    '''
+    session = mapper.get_session()
+    query = session.query(mapper.Account.email, mapper.Account.password, mapper.AdGroup.set,
+                          mapper.AdGroup.campaign_id, mapper.AdGroup.id) \
+        .filter(mapper.Campaign.id == mapper.AdGroup.campaign_id) \
+        .filter(mapper.Account.id == mapper.Campaign.account_id)
+
+    if sets is not None:
+        query = query.filter(mapper.AdGroup.set.in_(list(sets)))
+
+    return [tuple(row) for row in query.order_by(mapper.Account.email, mapper.AdGroup.set, mapper.AdGroup.id)]
+
+
+def iter_rows(kind, adgroups, date, days=7):
+    '''
+    Fetches given adgroups one by one, signing in once per account, and
+    yields (set, row) pairs with rows as tuples in COLUMNS[kind] order.
+
+    @param kind: str - REPORT or KEYWORDS
+    @param adgroups: iterable - tuples as returned by list_adgroups()
+    @param date: datetime.date
+    @param days: int - report period
+
+    @return: generator
+    '''
+    processor = None
+    email = None
+
+    try:
+        for adgroup_email, password, set, campaign_id, adgroup_id in adgroups:
+            if adgroup_email != email:
+                if processor is not None:
+                    processor.sign_out()
+                email = adgroup_email
+                processor = mapper.RequestProcessor(email, password)
+                processor.sign_in()
+
+            if kind == REPORT:
+                report = processor.get_keywords_report(campaign_id, adgroup_id, days)
+                for keyword in sorted(report):
+                    values = report[keyword]
+                    yield set, (date, email, set, campaign_id, adgroup_id, keyword, days, values['bid'],
+                                values['clicks'], values['impr'], values['ctr'], values['cpc'],
+                                values['cost'], values['pos'])
+            else:
+                for keyword in processor.get_keywords(campaign_id, adgroup_id):
+                    text, match_mode = mapper.split_match_mode(keyword.keyword)
+                    yield set, (date, email, set, campaign_id, adgroup_id, keyword.keyword, text,
+                                match_mode, keyword.bid, keyword.url)
+    finally:
+        if processor is not None:
+            processor.sign_out()
+
+
+def export(kind, directory, sets=None, date=None, format='csv', days=7, chunk_rows=None, replace=False):
+    '''
+    Exports keyword performance reports (kind REPORT) or keywords (kind
+    KEYWORDS) of given or all sets to the date partition of a directory.
+    Sets already in the partition are skipped unless replace is True.
+
+    @param kind: str - REPORT or KEYWORDS
+    @param directory: str
+    @param sets: list - None for all sets
+    @param date: datetime.date - partition key, today by default
+    @param format: str - 'csv' or 'jsonl'
+    @param days: int - report period
+    @param chunk_rows: int - rows per file
+    @param replace: bool
+
+    @return: dict - counts of 'sets' written, 'skipped' and 'rows'
+    '''
+    if kind not in COLUMNS:
+        raise ValueError('Unknown export kind "%s"' % kind)
+    if format not in FORMATS:
+        raise ValueError('Unknown export format "%s"' % format)
+
+    date = date or datetime.date.today()
+    partition = get_partition(directory, kind, date)
+    if not os.path.isdir(partition):
+        os.makedirs(partition)
+
+    adgroups = list_adgroups(sets)
+    done = frozenset() if replace else exported_sets(partition)
+    result = {'sets': 0, 'skipped': len(frozenset([adgroup[2] for adgroup in adgroups]) & done), 'rows': 0}
+
+    adgroups = [adgroup for adgroup in adgroups if adgroup[2] not in done]
+    # sets in the order they're fetched, those passed without a row get an
+    # empty file so they aren't fetched again by the next export
+    pending = []
+    for adgroup in adgroups:
+        if not pending or pending[-1] != adgroup[2]:
+            pending.append(adgroup[2])
+    pending.reverse()
+
+    def commit_empty(until=None):
+        while pending and pending[-1] != until:
+            SetWriter(partition, pending.pop(), COLUMNS[kind], format, chunk_rows).commit()
+            result['sets'] += 1
+
+    writer = None
+    try:
+        for set, row in iter_rows(kind, adgroups, date, days):
+            if writer is None or writer.set != set:
+                if writer is not None:
+                    writer.commit()
+                    result['sets'] += 1
+                commit_empty(set)
+                pending.pop()
+                writer = SetWriter(partition, set, COLUMNS[kind], format, chunk_rows)
+            writer.write(row)
+            result['rows'] += 1
+
+        if writer is not None:
+            writer.commit()
+            result['sets'] += 1
+            writer = None
+        commit_empty()
+    finally:
+        if writer is not None:
+            writer.abort()
+
+    return result
+
+#-------------------------------------------------------------------------------
+
+def main(arguments=None):
+    parser = optparse.OptionParser(usage='%prog report|keywords DIRECTORY [options]')
+    parser.add_option('--set', dest='sets', action='append', help='set to export, may be repeated (all by default)')
+    parser.add_option('--date', help='partition date as YYYY-MM-DD (today by default)')
+    parser.add_option('--format', choices=FORMATS, default='csv', help='csv or jsonl')
+    parser.add_option('--days', type='int', default=7, help='report period, days')
+    parser.add_option('--chunk-rows', type='int', dest='chunk_rows', help='rows per file')
+    parser.add_option('--replace', action='store_true', default=False, help='export sets already in the partition again')
+
+    options, arguments = parser.parse_args(arguments)
+    if len(arguments) != 2 or arguments[0] not in COLUMNS:
+        parser.error('expected an export kind (report or keywords) and a directory')
+
+    date = None
+    if options.date:
+        date = datetime.datetime.strptime(options.date, '%Y-%m-%d').date()
+
+    result = export(arguments[0], arguments[1], options.sets, date, options.format, options.days,
+                    options.chunk_rows, options.replace)
+    print '%(sets)d sets, %(rows)d rows written, %(skipped)d sets already exported' % result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+'''
+adwords.keywordcodec
+
+@version: 0.1.1
+'''
+
+import re
+import decimal
+
+import requestprocessor
+
+#-------------------------------------------------------------------------------
+
+SEPARATOR = ' ** '
+LINE_SEPARATOR = '\x0D\x0A'
+
+CENT = decimal.Decimal('0.01')
+
+_bid_pattern = re.compile(r'^\d+(\.\d+)?$')
+
+# a part ending with ' **' runs into the separator following it
+_BROKEN_SEPARATOR = ' **' + SEPARATOR
+
+#-------------------------------------------------------------------------------
+
+def encode_keyword(keyword, url_filter=None):
+    '''
+    Encodes one keyword as a line of the keywords textarea:
+    'keyword[ ** bid][ ** url]'. Bids are written with exactly two decimal
+    places.
+
+    Raises ValueError for keywords which could not be decoded back to the
+    same value: containing line breaks or the separator, having a bid not
+    in whole cents (it would be rounded) or a url in place of a bid looking
+    like one.
+
+    @param keyword: str or Keyword
+    @param url_filter: callable - applied to the url before encoding
+
+    @return: str
+    '''
+    return encode([keyword], url_filter)
+
+
+def encode(keywords, url_filter=None):
+    '''
+    Encodes a whole keywords block as it's submitted in the keywords
+    textarea, see encode_keyword().
+
+    @param keywords: iterable - strings and/or Keyword instances
+    @param url_filter: callable - applied to every url before encoding
+
+    @return: str
+    '''
+    Keyword = requestprocessor.Keyword
+    lines = []
+    counts = []
+    add_line = lines.append
+    add_count = counts.append
+
+    for keyword in keywords:
+        if not isinstance(keyword, Keyword):
+            add_line(keyword)
+            add_count(0)
+            continue
+
+        line = keyword.keyword
+        separators = 0
+
+        bid = keyword.bid
+        if bid:
+            line += SEPARATOR + _encode_bid(bid)
+            separators = 1
+
+        url = keyword.url
+        if url:
+            if url_filter is not None:
+                url = url_filter(url)
+            # only a url in place of a bid would be decoded as one
+            if not bid and url[:1].isdigit() and _bid_pattern.match(url):
+                raise ValueError('Url "%s" can\'t be told apart from a bid' % url)
+            line += SEPARATOR + url
+            separators += 1
+
+        add_line(line)
+        add_count(separators)
+
+    block = LINE_SEPARATOR.join(lines)
+
+    # all lines are checked at once: a line break or a separator inside a
+    # part shows up as one too many in the whole block
+    breaks = max(0, len(lines) - 1)
+    if block.count('\n') != breaks or block.count('\r') != breaks \
+            or block.count(SEPARATOR) != sum(counts) or _BROKEN_SEPARATOR in block:
+        for line, separators in zip(lines, counts):
+            _check_line(line, separators)
+
+    return block
+
+
+def decode(block):
+    '''
+    Decodes keywords textarea contents to a list of Keyword instances.
+    Bids are kept as Decimal exactly as written, empty lines are skipped.
+
+    @param block: str
+
+    @return: list
+    '''
+    Keyword = requestprocessor.Keyword
+    result = []
+
+    # lines may end with '\r\n' as submitted or '\n' as found in pages
+    for line in block.splitlines():
+        if not line:
+            continue
+
+        parts = line.split(SEPARATOR)
+        keyword = Keyword(parts[0])
+
+        if len(parts) > 1:
+            part = parts[1]
+            if part[:1].isdigit() and _bid_pattern.match(part):
+                keyword.bid = decimal.Decimal(part)
+            else:
+                keyword.url = part
+            if len(parts) > 2:
+                keyword.url = parts[2]
+
+        result.append(keyword)
+
+    return result
+
+
+def _check_line(line, separators):
+    if '\n' in line or '\r' in line or line.count(SEPARATOR) != separators or _BROKEN_SEPARATOR in line:
+        raise ValueError('"%s" can\'t be encoded as a keyword line' % line)
+
+
+def _encode_bid(bid):
+    if not isinstance(bid, decimal.Decimal):
+        bid = requestprocessor.to_decimal(bid)
+
+    # str() is cheap next to quantize(), and already has two decimal places
+    # for bids decoded or given as strings
+    text = str(bid)
+    if text[:1].isdigit() and 'E' not in text:
+        point = text.find('.')
+        if point == -1:
+            return text + '.00'
+        places = len(text) - point - 1
+        if places == 2:
+            return text
+        if places < 2:
+            return text + '0'
+        if not text[point + 3:].strip('0'):
+            return text[:point + 3]
+    elif bid.is_finite() and bid > 0:
+        try:
+            quantized = bid.quantize(CENT)
+        except decimal.InvalidOperation:
+            quantized = None
+        if quantized == bid:
+            return str(quantized)
+
+    raise ValueError('Bid %s can\'t be written in whole cents' % bid)
+#-------------------------------------------------------------------------------
@@ -0,0 +1,202 @@
+'''
+adwords.logwriter
+
+@version: 0.1.1
+'''
+
+import threading
+import datetime
+import atexit
+import Queue
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR',
+}
+
+# Structured fields are rendered in this order, unknown ones go after them
+FIELDS_ORDER = ('account', 'operation', 'set', 'campaign_id', 'adgroup_id')
+
+#-------------------------------------------------------------------------------
+
+class LogWriter:
+    '''
+    Appends log records to a file from a background thread. Callers only put
+    a record into a queue; formatting and file I/O are done by the writer
+    thread which drains the queue in batches.
+    '''
+
+    def __init__(self, path, batch_size=None, flush_interval=None):
+        '''
+        @param path: str
+        @param batch_size: int
+        @param flush_interval: float - seconds
+        '''
+        self.path = path
+        self.batch_size = batch_size or settings.LOG_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.LOG_FLUSH_INTERVAL
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._file = None
+
+    def write(self, record):
+        '''
+        @param record: tuple - (datetime, level, message, fields)
+        '''
+        if self._thread is None:
+            self._start()
+        self._queue.put(record)
+
+    def flush(self):
+        '''
+        Blocks until every record queued so far is written.
+        '''
+        if self._thread is not None:
+            self._queue.join()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name='adwords-log-writer')
+                thread.setDaemon(True)
+                thread.start()
+                self._thread = thread
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(True, self.flush_interval))
+            except Queue.Empty:
+                pass
+
+            try:
+                try:
+                    data = ''.join([_format_safely(record) for record in batch])
+                    if self._file is None:
+                        self._file = open(self.path, 'a')
+                    self._file.write(data)
+                    self._file.flush()
+                except IOError:
+                    # the batch is lost, the file is reopened for the next one
+                    self._file = None
+                except Exception:
+                    # any other failure loses the batch only, never the
+                    # thread, or flush() would wait forever
+                    pass
+            finally:
+                for record in batch:
+                    self._queue.task_done()
+
+
+def format_record(record):
+    '''
+    @param record: tuple - (datetime, level, message, fields)
+
+    @return: str
+    '''
+    timestamp, level, message, fields = record
+
+    result = '[%s] %s: %s' % (timestamp, LEVEL_NAMES.get(level, level), _to_str(message))
+
+    if fields:
+        names = [name for name in FIELDS_ORDER if name in fields]
+        names += sorted([name for name in fields if name not in FIELDS_ORDER])
+        result += ' |' + ''.join([' %s=%s' % (name, _to_str(fields[name])) for name in names])
+
+    return result + '\n'
+
+
+def _to_str(value):
+    # unicode is written as UTF-8, mixing it with byte strings would fail
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if not isinstance(value, str):
+        value = str(value)
+    return value
+
+
+def _format_safely(record):
+    try:
+        return format_record(record)
+    except Exception:
+        return '[%s] %s: %r (unformattable record)\n' % (record[0], LEVEL_NAMES.get(record[1], record[1]), record[2])
+
+#-------------------------------------------------------------------------------
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path):
+    '''
+    Returns the writer appending to a given file, creating it on first use.
+
+    @param path: str
+
+    @return: LogWriter
+    '''
+    writer = _writers.get(path)
+    if writer is None:
+        _writers_lock.acquire()
+        try:
+            writer = _writers.get(path)
+            if writer is None:
+                writer = _writers[path] = LogWriter(path)
+        finally:
+            _writers_lock.release()
+
+    return writer
+
+
+def is_enabled_for(level):
+    '''
+    @param level: int
+
+    @return: bool
+    '''
+    return bool(settings.LOG_FILE) and level >= settings.LOG_LEVEL
+
+
+def log(level, message, **fields):
+    '''
+    Queues a message with optional structured fields like account,
+    operation, campaign_id or adgroup_id. Does nothing when logging is off or
+    the level is below settings.LOG_LEVEL.
+
+    @param level: int
+    @param message: str
+    '''
+    if not settings.LOG_FILE or level < settings.LOG_LEVEL:
+        return
+
+    get_writer(settings.LOG_FILE).write((datetime.datetime.now(), level, message, fields))
+
+
+def flush():
+    '''
+    Blocks until all queued records of every writer are written.
+    '''
+    for writer in _writers.values():
+        writer.flush()
+
+
+atexit.register(flush)
+#-------------------------------------------------------------------------------
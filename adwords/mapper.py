@@ -5,26 +5,121 @@ adwords.mapper
 @version: 0.1.1
 '''
 
+from __future__ import with_statement
+
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, ForeignKey, Numeric
+from sqlalchemy.orm import relation
+from sqlalchemy import Column, Integer, String, ForeignKey, Numeric, DateTime, Text, PickleType
 from sqlalchemy.sql import func, desc
 
+import sys
+import threading
+import functools
+import itertools
+
 from requestprocessor import RequestProcessor
+import configuration
+import cancellation
+import logwriter
+import metrics
+import partitioner
 import settings
 
 
-engine = create_engine(settings.DB_CONNECTION, echo=settings.DEBUG_DB)
-session = sessionmaker(bind=engine)()
 Base = declarative_base()
 
 
+def get_session():
+    '''
+    Returns the session of the configuration currently in use. The engine
+    and the session are created on first call, see adwords.configuration.
+    
+    @return: sqlalchemy.orm.Session
+    '''
+    return configuration.get_current().session
+
+
+_transactions = threading.local()
+
+
+def transactional(function):
+    '''
+    Runs a public mapper function in the current thread session: commits
+    when it returns and rolls back when it raises. Nested calls don't
+    commit or roll back on their own.
+    
+    AdWords changes can't be rolled back, so the records of every unit of
+    work done there (an adgroup added, edited, moved or removed) are
+    committed as soon as the unit is done, by the function or by helpers
+    like add_set_part(). Such a commit includes whatever the caller had
+    pending in the session, a rollback only drops the work since the last
+    unit. Callers shouldn't count on their own pending changes being undone
+    by a failing mapper call.
+    
+    Functions also take a 'cancel_token' (cancellation.CancellationToken)
+    or a 'deadline' (a time.time() value) keyword argument, see
+    adwords.cancellation. Once it fires the function stops raising
+    cancellation.OperationCancelledError, the work committed before is kept.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = kwargs.pop('cancel_token', None)
+        deadline = kwargs.pop('deadline', None)
+        if deadline is not None:
+            if token is not None:
+                raise ValueError('Either "cancel_token" or "deadline" can be given')
+            token = cancellation.CancellationToken(deadline)
+        
+        if token is None:
+            return _run_transaction(function, args, kwargs)
+        with cancellation.use(token):
+            return _run_transaction(function, args, kwargs)
+    
+    return wrapper
+
+
+def _run_transaction(function, args, kwargs):
+    # nesting is counted per configuration: a call under another one runs
+    # in another session, which it has to commit itself
+    current = configuration.get_current()
+    depths = getattr(_transactions, 'depths', None)
+    if depths is None:
+        depths = _transactions.depths = {}
+    
+    depth = depths.get(current, 0)
+    if depth > 0:
+        depths[current] = depth + 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            depths[current] = depth
+    
+    session = get_session()
+    depths[current] = 1
+    try:
+        try:
+            result = function(*args, **kwargs)
+            session.commit()
+            return result
+        except cancellation.OperationCancelledError, e:
+            # units of work are committed as they're done, so what's left is
+            # a unit interrupted before it touched AdWords
+            session.rollback()
+            e.status.setdefault('operation', function.__name__)
+            logwriter.log(logwriter.WARNING, '! %s stopped: %s' % (function.__name__, e.reason))
+            raise
+        except:
+            session.rollback()
+            raise
+    finally:
+        del depths[current]
+
+
 class AdGroup(Base):
     __tablename__ = 'adwords_adgroups'
     
     id = Column(Integer, primary_key=True)
-    campaign_id = Column(Integer, ForeignKey('adwords_campaigns.id'))
+    campaign_id = Column(Integer, ForeignKey('adwords_campaigns.id'), index=True)
     set = Column(String(1024))
     default_bid = Column(Numeric())
     default_url = Column(String(1024))
@@ -49,6 +144,7 @@ class AdGroup(Base):
     
     @classmethod
     def find_unique_name(cls, prefix, campaign=None):
+        session = get_session()
         if campaign == None:
             unique_name = '%s__%s' % (prefix, 1)
         else:
@@ -77,7 +173,7 @@ class Campaign(Base):
     NAME_PREFIX = 'campaign'
     
     id = Column(Integer, primary_key=True)
-    account_id = Column(Integer, ForeignKey('adwords_accounts.id'))
+    account_id = Column(Integer, ForeignKey('adwords_accounts.id'), index=True)
     adgroups = relation(AdGroup, order_by=AdGroup.id, backref='campaign')
     
     def __init__(self, id, account_id):
@@ -89,6 +185,7 @@ class Campaign(Base):
     
     @classmethod
     def find_unique_name(cls, account):
+        session = get_session()
         campaigns = session.query(UsedNames) \
             .filter(UsedNames.entity_type == cls.__name__) \
             .filter(UsedNames.entity_parent_id == account.id).all()
@@ -124,17 +221,154 @@ class Account(Base):
         return '<Account "%s">' % self.email
     
     
+class KeywordEntry(Base):
+    '''
+    Local copy of the keywords submitted to each adgroup, so the adgroup
+    holding a keyword can be found without scraping AdWords. Kept up to
+    date by every mapper function writing keywords.
+    
+    'keyword' is the keyword as submitted (with match mode syntax), 'text'
+    is its normalized form without the syntax used for lookups.
+    '''
+    __tablename__ = 'adwords_keywords'
+    
+    id = Column(Integer, primary_key=True)
+    adgroup_id = Column(Integer, ForeignKey('adwords_adgroups.id'), index=True)
+    keyword = Column(String(250), index=True)
+    text = Column(String(250), index=True)
+    match_mode = Column(String(10))
+    bid = Column(Numeric(), nullable=True)
+    url = Column(String(1024), nullable=True)
+    
+    def __init__(self, adgroup_id, keyword, bid=None, url=None):
+        self.adgroup_id = adgroup_id
+        self.keyword = keyword
+        self.text, self.match_mode = split_match_mode(keyword)
+        self.bid = bid
+        self.url = url
+    
+    def __repr__(self):
+        return '<KeywordEntry "%s" of adgroup %s>' % (self.keyword, self.adgroup_id)
+    
+    def to_keyword(self):
+        '''
+        Returns the entry the way it was passed to the mapper: a Keyword
+        instance when it has a bid or url, a plain string otherwise.
+        '''
+        if self.bid is None and self.url is None:
+            return self.keyword
+        
+        return Keyword(self.keyword, self.bid, self.url)
+    
+    @classmethod
+    def index_adgroup(cls, adgroup_id, keywords):
+        '''
+        Replaces indexed keywords of an adgroup.
+        
+        @param adgroup_id: long
+        @param keywords: list - strings and/or Keyword instances
+        '''
+        session = get_session()
+        session.execute(cls.__table__.delete().where(cls.__table__.c.adgroup_id == adgroup_id))
+        
+        rows = []
+        for keyword in keywords:
+            if isinstance(keyword, Keyword):
+                row = {'adgroup_id': adgroup_id, 'keyword': keyword.keyword, 'bid': keyword.bid, 'url': keyword.url}
+            else:
+                row = {'adgroup_id': adgroup_id, 'keyword': keyword, 'bid': None, 'url': None}
+            row['text'], row['match_mode'] = split_match_mode(row['keyword'])
+            rows.append(row)
+        
+        if rows:
+            session.execute(cls.__table__.insert(), rows)
+    
+    @classmethod
+    def unindex_adgroup(cls, adgroup_id):
+        '''
+        @param adgroup_id: long
+        '''
+        session = get_session()
+        session.execute(cls.__table__.delete().where(cls.__table__.c.adgroup_id == adgroup_id))
+    
+    
+class Job(Base):
+    '''
+    Queued call of a mapper function, run by adwords.worker. Jobs of one
+    account are only run by the worker holding the AccountLease of it.
+    '''
+    __tablename__ = 'adwords_jobs'
+    
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    
+    id = Column(Integer, primary_key=True)
+    operation = Column(String(50))
+    account = Column(String(250), index=True)
+    set = Column(String(1024))
+    arguments = Column(PickleType())
+    status = Column(String(10), index=True)
+    attempts = Column(Integer)
+    max_attempts = Column(Integer)
+    not_before = Column(DateTime())
+    worker = Column(String(250), nullable=True)
+    heartbeat_at = Column(DateTime(), nullable=True)
+    created_at = Column(DateTime())
+    finished_at = Column(DateTime(), nullable=True)
+    result = Column(PickleType(), nullable=True)
+    error = Column(Text(), nullable=True)
+    
+    def __repr__(self):
+        return '<Job %s %s "%s" (%s)>' % (self.id, self.operation, self.set, self.status)
+
+
+class AccountLease(Base):
+    '''
+    Marks an account as owned by a worker until expires_at, so no other
+    worker signs in to it meanwhile. Renewed by the owner's heartbeats.
+    '''
+    __tablename__ = 'adwords_account_leases'
+    
+    account = Column(String(250), primary_key=True)
+    worker = Column(String(250))
+    expires_at = Column(DateTime())
+    
+    def __repr__(self):
+        return '<AccountLease "%s" of %s>' % (self.account, self.worker)
+
+
+class CampaignClone(Base):
+    '''
+    Campaign of the destination account a source campaign is cloned to by
+    clone_account(), so a resumed clone keeps filling the same one.
+    '''
+    __tablename__ = 'adwords_campaign_clones'
+    
+    source_id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey('adwords_campaigns.id'))
+    
+    def __init__(self, source_id, campaign_id):
+        self.source_id = source_id
+        self.campaign_id = campaign_id
+    
+    def __repr__(self):
+        return '<CampaignClone of campaign %s to %s>' % (self.source_id, self.campaign_id)
+
+
 class UsedNames(Base):
     __tablename__ = 'adwords_usednames'
     
     id = Column(Integer, primary_key=True)
     entity_type = Column(String(50))
-    entity_id = Column(Integer, nullable=True)
-    entity_parent_id = Column(Integer, nullable=True)
+    entity_id = Column(Integer, nullable=True, index=True)
+    entity_parent_id = Column(Integer, nullable=True, index=True)
     entity_name = Column(String(100))
     
     @classmethod
     def add_entity(cls, entity_type, entity_id, entity_parent_id, entity_name):
+        session = get_session()
         used_name = cls()
         used_name.entity_id = entity_id
         used_name.entity_name = entity_name
@@ -145,16 +379,20 @@ class UsedNames(Base):
         
     @classmethod
     def remove_entity(cls, entity_type, entity_id):
+        session = get_session()
         used_name = session.query(cls) \
             .filter(cls.entity_type == entity_type) \
             .filter(cls.entity_id == entity_id) \
             .one()
-        used_name.id = None
+        # the row stays as AdWords doesn't let names of deleted entities be
+        # reused, only the link to the entity is dropped
+        used_name.entity_id = None
         
         session.add(used_name)
         
     @classmethod
     def get_entity_name(cls, entity_type, entity_id):
+        session = get_session()
         used_name = session.query(cls) \
             .filter(cls.entity_type == entity_type) \
             .filter(cls.entity_id == entity_id) \
@@ -163,6 +401,121 @@ class UsedNames(Base):
         return used_name.entity_name
 
 
+def normalize_text(text):
+    '''
+    Returns keyword text the way AdWords compares keywords: lower case with
+    single spaces between words.
+    
+    @param text: str
+    
+    @return: str
+    '''
+    return ' '.join(text.lower().split())
+
+
+def split_match_mode(keyword):
+    '''
+    Splits keyword as it's submitted to AdWords ('[exact]', '"phrase"',
+    '-negative' or 'broad') into its normalized text and match mode.
+    
+    @param keyword: str
+    
+    @return: str, str
+    '''
+    keyword = keyword.strip()
+    
+    if keyword.startswith('[') and keyword.endswith(']'):
+        return normalize_text(keyword[1:-1]), Keyword.MATCH_MODE_EXACT
+    if keyword.startswith('"') and keyword.endswith('"') and len(keyword) > 1:
+        return normalize_text(keyword[1:-1]), Keyword.MATCH_MODE_PHRASE
+    if keyword.startswith('-'):
+        return normalize_text(keyword[1:]), Keyword.MATCH_MODE_NEGATIVE
+    
+    return normalize_text(keyword), Keyword.MATCH_MODE_BROAD
+
+
+def iter_normalized_keywords(keywords, report):
+    '''
+    Yields given keywords normalized (lower case, single spaces, see
+    split_match_mode()) skipping the ones equal to a keyword yielded before:
+    same text and match mode. Of duplicates with different bids or urls the
+    first one is kept.
+    
+    Works lazily on any iterable, only the normalized keywords seen so far
+    are kept in memory. Counts are added to a given report dict, see
+    normalize_keywords().
+    
+    @param keywords: iterable - strings and/or Keyword instances
+    @param report: dict
+    
+    @return: generator
+    '''
+    seen = set()
+    report.setdefault('keywords', 0)
+    report.setdefault('duplicates', 0)
+    
+    for keyword in keywords:
+        report['keywords'] += 1
+        
+        text, match_mode = split_match_mode(isinstance(keyword, Keyword) and keyword.keyword or keyword)
+        if (text, match_mode) in seen:
+            report['duplicates'] += 1
+            continue
+        seen.add((text, match_mode))
+        
+        normalized = MATCH_MODE_SYNTAX[match_mode] % text
+        if isinstance(keyword, Keyword):
+            yield Keyword(normalized, keyword.bid, keyword.url)
+        else:
+            yield normalized
+
+
+def normalize_keywords(keywords):
+    '''
+    Normalizes keywords and drops duplicates, see iter_normalized_keywords().
+    Returns the keywords left and a report: counts of 'keywords' given,
+    'duplicates' dropped, 'slots_saved' (same as duplicates) and
+    'adgroups_saved' by the partitioner in use.
+    
+    @param keywords: iterable
+    
+    @return: list, dict
+    '''
+    report = {}
+    result = list(iter_normalized_keywords(keywords, report))
+    
+    return result, _complete_report(report)
+
+
+def _complete_report(report):
+    count = partitioner.get_partitioner().count
+    report['slots_saved'] = report['duplicates']
+    report['adgroups_saved'] = count(report['keywords']) - count(report['keywords'] - report['duplicates'])
+    
+    return report
+
+
+def _normalize_if_asked(set, keywords, normalize):
+    if not (settings.NORMALIZE_KEYWORDS if normalize is None else normalize):
+        return keywords
+    
+    return _iter_normalized_logged(set, keywords)
+
+
+def _iter_normalized_logged(set, keywords):
+    # the report is known only once all keywords have been read
+    report = {}
+    for keyword in iter_normalized_keywords(keywords, report):
+        yield keyword
+    
+    _complete_report(report)
+    logwriter.log(logwriter.INFO, 'normalized keywords: %(duplicates)d duplicates of %(keywords)d dropped, '
+        '%(adgroups_saved)d adgroups saved' % report, set=set)
+    if metrics.enabled():
+        metrics.increment('adwords_keyword_slots_saved_total', {}, report['slots_saved'])
+        metrics.increment('adwords_adgroups_saved_total', {}, report['adgroups_saved'])
+
+
 def preprocess_url(url, campaign_name=None, adgroup_name=None):
     import urllib
     
@@ -177,6 +530,7 @@ def preprocess_url(url, campaign_name=None, adgroup_name=None):
 
 
 def preprocess_keywords(keywords, campaign_name=None, adgroup_name=None, plain=False):
+    # Keywords are encoded once, by the processor submitting them
     for keyword in keywords:
         if isinstance(keyword, Keyword):
             if plain:
@@ -189,20 +543,384 @@ def preprocess_keywords(keywords, campaign_name=None, adgroup_name=None, plain=F
         else:
             yield keyword
 
+
+def iter_parts(keywords, size=None):
+    '''
+    Splits keywords into lists of at most size keywords lazily, so any
+    iterable (a file, a database cursor, a generator) can be used without
+    holding more than one list in memory.
+    
+    @param keywords: iterable
+    @param size: int - settings.MAX_KEYWORDS_PER_ADGROUP by default
+    
+    @return: generator
+    '''
+    size = size or settings.MAX_KEYWORDS_PER_ADGROUP
+    keywords = iter(keywords)
+    
+    while True:
+        part = list(itertools.islice(keywords, size))
+        if not part:
+            break
+        yield part
+
+
+def count_parts(keywords):
+    '''
+    Returns how many adgroups (set parts) are needed to store given keywords
+    
+    @param keywords: list
+    
+    @return: int
+    '''
+    parts_count = int(len(keywords)) / int(settings.MAX_KEYWORDS_PER_ADGROUP)
+    if int(len(keywords)) % int(settings.MAX_KEYWORDS_PER_ADGROUP) != 0:
+        parts_count += 1
+    
+    return parts_count
+
+
+class PlacementPlanner:
+    '''
+    Decides which campaign each new set goes to, keeping adgroups and
+    campaigns counts of all accounts in memory so placements of many sets
+    are computed with a couple of queries.
+    
+    The strategy is the one of create_set(): the fullest campaign still able
+    to store all parts of a set is used, then a new campaign in the account
+    having most campaigns. Planned new campaigns are keyed by ('new', n)
+    tuples and can receive later sets as well.
+    '''
+    
+    def __init__(self, session):
+        # campaign key => [account id, adgroups count]
+        self.campaigns = {}
+        # account id => campaigns count
+        self.accounts = {}
+        
+        for (account_id,) in session.query(Account.id).all():
+            self.accounts[account_id] = 0
+        
+        rows = session.query(Campaign.id, Campaign.account_id, func.count(AdGroup.id)) \
+            .outerjoin(AdGroup) \
+            .group_by(Campaign.id, Campaign.account_id).all()
+        for campaign_id, account_id, adgroups_count in rows:
+            self.campaigns[campaign_id] = [account_id, adgroups_count]
+            self.accounts[account_id] = self.accounts.get(account_id, 0) + 1
+        
+        self._new_campaigns_count = 0
+    
+    def place(self, parts_count, account_id=None):
+        '''
+        Reserves room for a set and returns account id and campaign key.
+        
+        @param parts_count: int
+        @param account_id: int - restricts placement to this account
+        
+        @return: int, int or tuple
+        '''
+        if parts_count > settings.MAX_ADGROUPS_PER_CAMPAIGN:
+            raise OverflowError('Set is too big to fit into a campaign')
+        
+        candidates = [(-adgroups_count, key) for key, (campaign_account_id, adgroups_count) in self.campaigns.items()
+            if adgroups_count <= settings.MAX_ADGROUPS_PER_CAMPAIGN - parts_count
+            and (account_id is None or campaign_account_id == account_id)]
+        
+        if candidates:
+            key = min(candidates)[1]
+        else:
+            if account_id is None:
+                accounts = [(-campaigns_count, id) for id, campaigns_count in self.accounts.items()
+                    if campaigns_count < settings.MAX_CAMPAIGNS_PER_ACCOUNT]
+                if not accounts:
+                    raise OverflowError('limits exceeded during new set creation')
+                account_id = min(accounts)[1]
+            elif self.accounts[account_id] >= settings.MAX_CAMPAIGNS_PER_ACCOUNT:
+                raise OverflowError('Specified account is not capable enough to store a set')
+            
+            self._new_campaigns_count += 1
+            key = ('new', self._new_campaigns_count)
+            self.campaigns[key] = [account_id, 0]
+            self.accounts[account_id] += 1
+        
+        self.campaigns[key][1] += parts_count
+        
+        return self.campaigns[key][0], key
+
+
+def get_definition(adgroup):
+    '''
+    Returns create_set() arguments (but keywords) an adgroup was created with
+    
+    @param adgroup: AdGroup
+    
+    @return: dict
+    '''
+    return {
+        'set': adgroup.set,
+        'display_url': adgroup.display_url,
+        'default_bid': adgroup.default_bid,
+        'default_url': adgroup.default_url,
+        'headline': adgroup.headline,
+        'adline1': adgroup.adline1,
+        'adline2': adgroup.adline2,
+    }
+
+
+@cancellation.unit
+def add_set_part(processor, definition, keywords_part, campaign=None, account=None):
+    '''
+    Creates one adgroup of a set and records it. A new campaign is created
+    in a given account when campaign is None. Returns the campaign used.
+    Never stopped halfway by a cancellation.
+    
+    @param processor: RequestProcessor - signed in to the campaign account
+    @param definition: dict - create_set() arguments
+    @param keywords_part: list
+    @param campaign: Campaign
+    @param account: Account
+    
+    @return: Campaign
+    '''
+    session = get_session()
+    d = definition
+    
+    if campaign is None:
+        campaign_name = Campaign.find_unique_name(account)
+        new_adgroup_name = AdGroup.find_unique_name(d['set'])
+        new_campaign_id, new_adgroup_id = processor.add_campaign(
+            campaign_name, new_adgroup_name, d['display_url'], preprocess_url(d['default_url'], campaign_name, new_adgroup_name), 
+            d['headline'], d['adline1'], d['adline2'], preprocess_keywords(keywords_part, plain=True), d['default_bid']
+        )
+        UsedNames.add_entity(Campaign.__name__, new_campaign_id, account.id, campaign_name)
+        
+        campaign = Campaign(long(new_campaign_id), account.id)
+        session.add(campaign)
+    else:
+        campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)
+        new_adgroup_name = AdGroup.find_unique_name(d['set'], campaign)
+        new_adgroup_id = processor.add_adgroup(
+            campaign.id, new_adgroup_name, d['display_url'], preprocess_url(d['default_url'], campaign_name, new_adgroup_name), 
+            d['headline'], d['adline1'], d['adline2'], preprocess_keywords(keywords_part, plain=True), d['default_bid']
+        )
+    
+    UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, campaign.id, new_adgroup_name)
+    processor.set_keywords(campaign.id, new_adgroup_id, preprocess_keywords(keywords_part, campaign_name, new_adgroup_name))
+    
+    session.add(AdGroup(long(new_adgroup_id), campaign.id, d['set'],
+        d['default_bid'], d['default_url'], d['display_url'], d['headline'], d['adline1'], d['adline2']))
+    KeywordEntry.index_adgroup(long(new_adgroup_id), keywords_part)
+    session.commit()
+    
+    return campaign
+
+def _keyword_values(keyword):
+    if isinstance(keyword, Keyword):
+        return keyword.keyword, keyword.bid, keyword.url
+    return keyword, None, None
+
+
+def is_adgroup_unchanged(adgroup_id, keywords):
+    '''
+    Returns whether the local index (see KeywordEntry) says an adgroup holds
+    exactly given keywords, bids and urls included, in any order.
+    
+    @param adgroup_id: long
+    @param keywords: list
+    
+    @return: bool
+    '''
+    entries = get_session().query(KeywordEntry.keyword, KeywordEntry.bid, KeywordEntry.url) \
+        .filter(KeywordEntry.adgroup_id == adgroup_id)
+    indexed = [tuple(entry) for entry in entries]
+    
+    return len(indexed) == len(keywords) and \
+        frozenset(indexed) == frozenset([_keyword_values(keyword) for keyword in keywords])
+
+
+def update_set_adgroups(processor, adgroups, keywords=None, bid=None):
+    '''
+    Applies new keywords and/or default bid to the adgroups of one set with
+    one EditKeywords submission per adgroup. Keywords are split into parts
+    by the partitioner chosen in settings.KEYWORD_PARTITIONER, adgroups
+    already holding their part are skipped unless the bid changes. Adgroups
+    not needed anymore are deleted, missing ones are added to the campaign
+    of the set.
+    
+    @param processor: RequestProcessor - signed in to the set account
+    @param adgroups: list - AdGroup instances of the set ordered by id
+    @param keywords: iterable
+    @param bid: decimal.Decimal
+    '''
+    session = get_session()
+    
+    an_adgroup = adgroups[0]
+    campaign = an_adgroup.campaign
+    campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)
+    adgroups = list(adgroups)
+    
+    if keywords is None:
+        for adgroup in adgroups:
+            _edit_adgroup(processor, campaign_name, adgroup, None, bid)
+        return
+    
+    definition = get_definition(an_adgroup)
+    if bid is not None:
+        definition['default_bid'] = bid
+    
+    # parts are taken one by one, so a contiguous split of an iterator
+    # never holds more than one adgroup of keywords
+    parts = iter(partitioner.get_partitioner().split(keywords, len(adgroups)))
+    first_part = next(parts, None)
+    if first_part is None:
+        raise ValueError('"new_keywords" should not be empty')
+    
+    for keywords_part in itertools.chain([first_part], parts):
+        if len(adgroups) == 0:
+            if len(keywords_part) == 0:
+                continue
+            if not (len(campaign.adgroups) < settings.MAX_ADGROUPS_PER_CAMPAIGN):
+                raise OverflowError('limits exceeded during modifying keywords')
+            
+            add_set_part(processor, definition, keywords_part, campaign)
+            continue
+        
+        adgroup = adgroups.pop(0)
+        if len(keywords_part) == 0:
+            _remove_adgroup(processor, adgroup)
+            continue
+        if bid is None and is_adgroup_unchanged(adgroup.id, keywords_part):
+            continue
+        
+        _edit_adgroup(processor, campaign_name, adgroup, keywords_part, bid)
+    
+    for adgroup_to_remove in adgroups:
+        _remove_adgroup(processor, adgroup_to_remove)
+
+
+@cancellation.unit
+def _edit_adgroup(processor, campaign_name, adgroup, keywords_part, bid):
+    session = get_session()
+    
+    if keywords_part is None:
+        processor.edit_keywords(adgroup.campaign_id, adgroup.id, bid=bid)
+    else:
+        adgroup_name = UsedNames.get_entity_name(AdGroup.__name__, adgroup.id)
+        processor.edit_keywords(adgroup.campaign_id, adgroup.id,
+            preprocess_keywords(keywords_part, campaign_name, adgroup_name), bid)
+        KeywordEntry.index_adgroup(adgroup.id, keywords_part)
+    
+    if bid is not None:
+        adgroup.default_bid = bid
+    session.commit()
+
+
+@cancellation.unit
+def _remove_adgroup(processor, adgroup):
+    session = get_session()
+    processor.delete_adgroup(adgroup.campaign_id, adgroup.id)
+    KeywordEntry.unindex_adgroup(adgroup.id)
+    session.delete(adgroup)
+    session.commit()
+
+def read_adgroups(processor, adgroups, read, concurrency=None, results=None):
+    '''
+    Calls read(processor, campaign_id, adgroup_id) for every adgroup and
+    returns the results in adgroups order. With concurrency above 1 that
+    many adgroups are read at a time, each thread by its own fork of the
+    processor (see RequestProcessor.fork()). The first error stops reading
+    and is raised.
+    
+    @param processor: RequestProcessor - signed in to the adgroups account
+    @param adgroups: list - (campaign_id, adgroup_id) tuples
+    @param read: callable
+    @param concurrency: int - settings.READ_CONCURRENCY by default
+    @param results: dict - filled with adgroup index => result as adgroups
+        are read, so results read before an error are kept there
+    
+    @return: list
+    '''
+    concurrency = concurrency or settings.READ_CONCURRENCY
+    if results is None:
+        results = {}
+    
+    if concurrency <= 1 or len(adgroups) <= 1:
+        for index, (campaign_id, adgroup_id) in enumerate(adgroups):
+            results[index] = read(processor, campaign_id, adgroup_id)
+        return [results[index] for index in range(len(adgroups))]
+    
+    lock = threading.Lock()
+    pending = range(len(adgroups))
+    errors = []
+    token = cancellation.get_current()
+    
+    def read_pending(reader):
+        if token is not None:
+            with cancellation.use(token):
+                read_pending_until_done(reader)
+        else:
+            read_pending_until_done(reader)
+    
+    def read_pending_until_done(reader):
+        while True:
+            with lock:
+                if errors or not pending:
+                    return
+                index = pending.pop(0)
+            
+            try:
+                result = read(reader, *adgroups[index])
+            except:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+            
+            with lock:
+                results[index] = result
+    
+    readers = []
+    for number in range(min(concurrency, len(adgroups))):
+        reader = threading.Thread(target=read_pending, args=(processor.fork(),), name='adwords-read-%d' % (number + 1))
+        reader.setDaemon(True)
+        reader.start()
+        readers.append(reader)
+    
+    for reader in readers:
+        reader.join()
+    
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    
+    return [results[index] for index in range(len(adgroups))]
+
 #-------------------------------------------------------------------------------
 # Public API
 #-------------------------------------------------------------------------------
 
 from requestprocessor import Keyword
 
+# keyword syntax of each match mode, see split_match_mode()
+MATCH_MODE_SYNTAX = {
+    Keyword.MATCH_MODE_BROAD: '%s',
+    Keyword.MATCH_MODE_PHRASE: '"%s"',
+    Keyword.MATCH_MODE_EXACT: '[%s]',
+    Keyword.MATCH_MODE_NEGATIVE: '-%s',
+}
+
 
 def install():
     '''
     Creates a new db schema in an empty database
     '''
-    Base.metadata.create_all(engine)
+    current = configuration.get_current()
+    Base.metadata.create_all(current.engine)
+    
+    if current.is_sqlite():
+        # MySQL can't index a column this long so it's sqlite only
+        current.engine.execute('CREATE INDEX IF NOT EXISTS ix_adwords_adgroups_set ON adwords_adgroups ("set")')
 
 
+@transactional
 def add_account(email, password):
     '''
     Adds a new empty account to the mapper.
@@ -212,31 +930,40 @@ def add_account(email, password):
     
     @return: Account
     '''
+    session = get_session()
     account = Account(email, password)
     session.add(account)
     session.commit()
     
     return account
 
+@transactional
 def remove_account(email):
     '''
     Removes account and related data from the mapper database.
     
     @param email: str
     '''
+    session = get_session()
     conn = session.connection()
     
     account = session.query(Account).filter(Account.email == email).one()
     campaigns = session.query(Campaign).join(Account).filter(Account.id == account.id).all()
     
     for campaign in campaigns:
+        adgroups_ids = AdGroup.__table__.select().with_only_columns([AdGroup.__table__.c.id]) \
+            .where(AdGroup.__table__.c.campaign_id == campaign.id)
+        conn.execute(KeywordEntry.__table__.delete().where(KeywordEntry.__table__.c.adgroup_id.in_(adgroups_ids)))
         conn.execute(AdGroup.__table__.delete().where(AdGroup.__table__.c.campaign_id == campaign.id))
+        conn.execute(CampaignClone.__table__.delete().where((CampaignClone.__table__.c.source_id == campaign.id)
+                                                            | (CampaignClone.__table__.c.campaign_id == campaign.id)))
     conn.execute(Campaign.__table__.delete().where(Campaign.__table__.c.account_id == account.id))
     session.delete(account)
     
     session.commit()
     
     
+@transactional
 def get_account_capacity(email):
     '''
     Returns a list. Each element specifies how many adgroups (set parts) can be
@@ -250,21 +977,29 @@ def get_account_capacity(email):
     
     @return: list
     '''
+    session = get_session()
     account = session.query(Account).filter(Account.email == email).first()
     if not account:
         raise ValueError('Account "%s" not found' % email)
     
+    # one aggregate query instead of loading every campaign and its adgroups
+    adgroups_counts = session.query(Campaign.id, func.count(AdGroup.id)) \
+        .outerjoin(AdGroup) \
+        .filter(Campaign.account_id == account.id) \
+        .group_by(Campaign.id).all()
+    
     adgroups_left = [settings.MAX_ADGROUPS_PER_CAMPAIGN] \
-        * (settings.MAX_CAMPAIGNS_PER_ACCOUNT - len(account.campaigns))
+        * (settings.MAX_CAMPAIGNS_PER_ACCOUNT - len(adgroups_counts))
 
-    adgroups_left += [settings.MAX_ADGROUPS_PER_CAMPAIGN - len(campaign.adgroups) \
-        for campaign in account.campaigns]
+    adgroups_left += [settings.MAX_ADGROUPS_PER_CAMPAIGN - adgroups_count \
+        for campaign_id, adgroups_count in adgroups_counts]
     
     adgroups_left.sort(reverse=True)
     
     return adgroups_left
 
 
+@transactional
 def get_capacity(set):
     '''
     Returns max number of keywords can be put into the set using 
@@ -272,6 +1007,7 @@ def get_capacity(set):
     
     @param set: str
     '''
+    session = get_session()
     an_adgroup = session.query(AdGroup).filter(AdGroup.set == set).first()
     
     if not an_adgroup:
@@ -289,6 +1025,7 @@ def get_capacity(set):
     return capacity
 
 
+@transactional
 def clone_account(email_source, email_dest):
     '''
     Clones an account identified by its email to another one.
@@ -296,9 +1033,17 @@ def clone_account(email_source, email_dest):
     Destination account should be empty (or at least to be capable enough
     to store all source account data). Removes source account after cloning.
     
+    Every cloned adgroup is committed and forgotten in the source account
+    right away, so a cancelled clone (see adwords.cancellation) is resumed
+    by calling it again. The campaign each source campaign is cloned to is
+    recorded (see CampaignClone), so a resumed clone keeps its sets in one
+    campaign. The status of OperationCancelledError tells how many adgroups
+    were 'cloned' and how many are 'remaining'.
+    
     @param email_source: str
     @param email_dest: str
     '''
+    session = get_session()
     account_from = session.query(Account).filter(Account.email == email_source).one()
     account_to = session.query(Account).filter(Account.email == email_dest).one()
     
@@ -311,64 +1056,57 @@ def clone_account(email_source, email_dest):
     campaigns = session.query(Campaign).join(AdGroup).group_by(Campaign) \
         .filter(Campaign.account_id == account_from.id).all()
         
-    for campaign in campaigns:
-        adgroups = session.query(AdGroup).filter(AdGroup.campaign_id == campaign.id).all()
-        first_adgroup = adgroups.pop(0)
-        first_adgroup_keywords = processor_from.get_keywords(campaign.id, first_adgroup.id)
-        
-        new_campaign_name = Campaign.find_unique_name(account_to)
-        new_adgroup_name = AdGroup.find_unique_name(first_adgroup.set)
-        new_campaign_id, new_adgroup_id = processor_to.add_campaign(
-            new_campaign_name, new_adgroup_name,
-            first_adgroup.display_url, preprocess_url(first_adgroup.default_url, new_campaign_name, new_adgroup_name), 
-            first_adgroup.headline, first_adgroup.adline1, first_adgroup.adline2, 
-            preprocess_keywords(first_adgroup_keywords, plain=True), first_adgroup.default_bid
-        )
-        UsedNames.add_entity(Campaign.__name__, new_campaign_id, account_to.id, new_campaign_name)
-        UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, new_campaign_id, new_adgroup_name)
-        
-        processor_to.set_keywords(new_campaign_id, new_adgroup_id, preprocess_keywords(first_adgroup_keywords, new_campaign_name, new_adgroup_name))
-        
-        session.add(Campaign(long(new_campaign_id), account_to.id))
-        session.add(AdGroup(long(new_adgroup_id), long(new_campaign_id), first_adgroup.set, 
-                first_adgroup.default_bid, first_adgroup.default_url, first_adgroup.display_url, 
-                first_adgroup.headline, first_adgroup.adline1, first_adgroup.adline2))
-        
-        for adgroup in adgroups:
-            adgroup_keywords = processor_from.get_keywords(campaign.id, adgroup.id)
-            
-            campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)
-            new_adgroup_name = AdGroup.find_unique_name(adgroup.set, campaign)
-            new_adgroup_id = processor_to.add_adgroup(
-                campaign.id, new_adgroup_name, adgroup.display_url, preprocess_url(adgroup.default_url, campaign_name, new_adgroup_name), 
-                adgroup.headline, adgroup.adline1, adgroup.adline2, 
-                preprocess_keywords(adgroup_keywords, plain=True), adgroup.default_bid
-            )
-            UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, campaign.id, new_adgroup_name)
-            processor_to.set_keywords(campaign.id, adgroup.id, preprocess_keywords(first_adgroup_keywords, campaign_name, new_adgroup_name))
-            
-            session.add(AdGroup(long(new_adgroup_id), campaign.id, adgroup.set,
-                adgroup.default_bid, adgroup.default_url, adgroup.display_url, 
-                adgroup.headline, adgroup.adline1, adgroup.adline2))
+    cloned = 0
+    try:
+        for campaign in campaigns:
+            clone = session.query(CampaignClone).get(campaign.id)
+            new_campaign = clone and session.query(Campaign).get(clone.campaign_id)
             
+            for adgroup in session.query(AdGroup).filter(AdGroup.campaign_id == campaign.id).order_by(AdGroup.id).all():
+                with cancellation.shielded():
+                    adgroup_keywords = processor_from.get_keywords(campaign.id, adgroup.id)
+                    new_campaign = add_set_part(processor_to, get_definition(adgroup), adgroup_keywords, new_campaign, account_to)
+                    if clone is None:
+                        clone = CampaignClone(campaign.id, new_campaign.id)
+                        session.add(clone)
+                    
+                    UsedNames.remove_entity(AdGroup.__name__, adgroup.id)
+                    KeywordEntry.unindex_adgroup(adgroup.id)
+                    session.delete(adgroup)
+                    session.commit()
+                cloned += 1
+    except cancellation.OperationCancelledError, e:
+        remaining = session.query(AdGroup).filter(AdGroup.campaign_id == Campaign.id) \
+            .filter(Campaign.account_id == account_from.id).count()
+        e.status.update(cloned=cloned, remaining=remaining)
+        raise
+    
     session.commit()
     processor_from.sign_out()
     processor_to.sign_out()
     remove_account(email_source)
 
 
-def create_set(set, display_url, default_bid, default_url, headline, adline1, adline2, keywords, account_email=None):
+@transactional
+def create_set(set, display_url, default_bid, default_url, headline, adline1, adline2, keywords, account_email=None,
+               normalize=None, keywords_count=None):
     '''
     Creates a new keywords set.
     
     The current strategy is to prefer filling up existing campaigns/accounts
     instead of creating new ones. 'keywords' should be a list of strings and/or
-    Keyword instances.
+    Keyword instances, or any other iterable of them. An iterable without a
+    length (a file, a cursor, a generator) is only read one adgroup at a time
+    when keywords_count tells how many keywords it holds, so the set can be
+    placed before reading it; otherwise it's read into a list first.
     
     Optional account argument can be used to explictly specify which account
     should be used to store a new set. OverflowError will be raised in case
     there's not enough capacity there to store a new set.
     
+    With normalize (settings.NORMALIZE_KEYWORDS by default) keywords are
+    normalized and deduplicated first, see normalize_keywords().
+    
     @param set: str
     @param display_url: str
     @param default_bid: decimal.Decimal
@@ -378,112 +1116,139 @@ def create_set(set, display_url, default_bid, default_url, headline, adline1, ad
     @param adline2: str
     @param keywords: list
     @param account_email: Account
+    @param normalize: bool
+    @param keywords_count: int
     
     @return: Account
     '''
-    
-    if session.query(AdGroup).filter(AdGroup.set == set).count() > 0:
-        raise ValueError('Set "%s" already exists' % set)
+    return create_sets([{
+        'set': set,
+        'display_url': display_url,
+        'default_bid': default_bid,
+        'default_url': default_url,
+        'headline': headline,
+        'adline1': adline1,
+        'adline2': adline2,
+        'keywords': keywords,
+        'account_email': account_email,
+        'normalize': normalize,
+        'keywords_count': keywords_count,
+    }])[set]
+
 
-    if account_email:
-        account = session.query(Account).filter(Account.email == account_email).first()
-        if not account:
-            raise ValueError('Account "%s" not found' % account_email)
+@transactional
+def create_sets(definitions):
+    '''
+    Creates many keywords sets at once.
     
-    processor = None
+    Each definition is a dict with create_set() argument names as keys
+    ('account_email', 'normalize' and 'keywords_count' are optional). Placements of all sets are computed
+    before any request is made, then the work is grouped by account so each
+    account is signed in once. Every created adgroup is committed right
+    away, so sets created before a failure are kept.
     
-    # getting how many parts should be created
-    parts_count = int(len(keywords)) / int(settings.MAX_KEYWORDS_PER_ADGROUP)
-    if int(len(keywords)) % int(settings.MAX_KEYWORDS_PER_ADGROUP) != 0:
-        parts_count += 1
-    if account_email and (parts_count > get_account_capacity(account_email)[0]):
-        raise OverflowError('Specified account is not capable enough to store a set')
-    
-    # looking for campaigns capable to store required number of parts
-    campaigns = session.query(Campaign).outerjoin(AdGroup) \
-        .group_by(Campaign) \
-        .having(func.count('*') <= (settings.MAX_ADGROUPS_PER_CAMPAIGN - parts_count)) \
-        .order_by(desc(func.count('*')))
-    if account_email:
-        campaigns = campaigns.having(Campaign.account_id == account.id)
-    
-    if campaigns.count() > 0:
-        # campaign found
-        campaign = campaigns.first()
-    else:
-        # creating a new campaign
-        # looking for an account to use
-        if not account_email:
-            accounts = session.query(Account).outerjoin(Campaign) \
-                .group_by(Account) \
-                .having(func.count('*') < settings.MAX_CAMPAIGNS_PER_ACCOUNT) \
-                .order_by(desc(func.count('*')))
-                
-            if accounts.count() > 0:
-                account = accounts.first()
-            else:
-                raise OverflowError('limits exceeded during new set creation')
-        
-        processor = RequestProcessor(account.email, account.password)
-        processor.sign_in()
-        
-        keywords_part = keywords[:settings.MAX_KEYWORDS_PER_ADGROUP]
-        
-        new_campaign_name = Campaign.find_unique_name(account)
-        new_adgroup_name = AdGroup.find_unique_name(set)
-        new_campaign_id, new_adgroup_id = processor.add_campaign(
-            new_campaign_name, new_adgroup_name, display_url, preprocess_url(default_url, new_campaign_name, new_adgroup_name), headline, adline1, adline2, 
-            preprocess_keywords(keywords_part, plain=True), default_bid
-        )
-        UsedNames.add_entity(Campaign.__name__, new_campaign_id, account.id, new_campaign_name)
-        UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, new_campaign_id, new_adgroup_name)
-        processor.set_keywords(new_campaign_id, new_adgroup_id, preprocess_keywords(keywords_part, new_campaign_name, new_adgroup_name))
-        
-        campaign = Campaign(long(new_campaign_id), account.id)
-        session.add(campaign)
-        
-        adgroup = AdGroup(long(new_adgroup_id), long(new_campaign_id), set,
-            default_bid, default_url, display_url, headline, adline1, adline2)
-        session.add(adgroup)
-        
-        keywords = keywords[settings.MAX_KEYWORDS_PER_ADGROUP:]
-        
-    # now we have a campaign to put the rest of set parts into
-    if not processor:
-        processor = RequestProcessor(campaign.account.email, campaign.account.password)
-        processor.sign_in()
-
-    # creating the rest of set parts
-    while len(keywords) > 0:
-        keywords_part = keywords[:settings.MAX_KEYWORDS_PER_ADGROUP]
-        
-        campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)        
-        new_adgroup_name = AdGroup.find_unique_name(set, campaign)
-        new_adgroup_id = processor.add_adgroup(
-            campaign.id, new_adgroup_name, display_url, preprocess_url(default_url, campaign_name, new_adgroup_name), headline, adline1, adline2, 
-            preprocess_keywords(keywords_part, plain=True), default_bid
-        )
-        UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, campaign.id, new_adgroup_name)
-        processor.set_keywords(campaign.id, new_adgroup_id, preprocess_keywords(keywords_part, campaign_name, new_adgroup_name))
+    The status of OperationCancelledError (see adwords.cancellation) lists
+    sets 'created', the one created in part ('partial', to be completed by
+    modify_keywords()) and the 'remaining' ones, to be created again.
+    
+    @param definitions: list
+    
+    @return: dict - set name => Account
+    '''
+    session = get_session()
+    
+    names = [definition['set'] for definition in definitions]
+    for i, name in enumerate(names):
+        if name in names[:i]:
+            raise ValueError('Set "%s" is given more than once' % name)
+    
+    existing = session.query(AdGroup.set).filter(AdGroup.set.in_(names)).first()
+    if existing:
+        raise ValueError('Set "%s" already exists' % existing[0])
+    
+    planner = PlacementPlanner(session)
+    
+    # account id => [(campaign key, definition)] in order of definitions
+    placements = {}
+    accounts_order = []
+    
+    for definition in definitions:
+        definition = dict(definition, keywords=_normalize_if_asked(
+            definition['set'], definition['keywords'], definition.get('normalize')))
+        keywords_count = definition.get('keywords_count')
+        if keywords_count is None:
+            if not hasattr(definition['keywords'], '__len__'):
+                definition['keywords'] = list(definition['keywords'])
+            keywords_count = len(definition['keywords'])
+        if keywords_count == 0:
+            raise ValueError('"keywords" of set "%s" should not be empty' % definition['set'])
         
-        adgroup = AdGroup(long(new_adgroup_id), campaign.id, set,
-            default_bid, default_url, display_url, headline, adline1, adline2)
-        session.add(adgroup)
+        account_id = None
+        if definition.get('account_email'):
+            account = session.query(Account).filter(Account.email == definition['account_email']).first()
+            if not account:
+                raise ValueError('Account "%s" not found' % definition['account_email'])
+            account_id = account.id
         
-        keywords = keywords[settings.MAX_KEYWORDS_PER_ADGROUP:]
-
-    processor.sign_out()
-    session.commit()
+        parts_count = partitioner.get_partitioner().count(keywords_count)
+        account_id, campaign_key = planner.place(parts_count, account_id)
+        if account_id not in placements:
+            placements[account_id] = []
+            accounts_order.append(account_id)
+        placements[account_id].append((campaign_key, definition, parts_count))
+    
+    result = {}
+    new_campaigns = {}
+    partial = None
+    
+    try:
+        for account_id in accounts_order:
+            account = session.query(Account).get(account_id)
+            processor = RequestProcessor(account.email, account.password)
+            processor.sign_in()
+            
+            for campaign_key, definition, parts_count in placements[account_id]:
+                if isinstance(campaign_key, tuple):
+                    campaign = new_campaigns.get(campaign_key)
+                else:
+                    campaign = session.query(Campaign).get(campaign_key)
+                
+                added = 0
+                for keywords_part in partitioner.get_partitioner().split(definition['keywords']):
+                    if len(keywords_part) == 0:
+                        continue
+                    if added == parts_count:
+                        # the room planned for the set is used up
+                        raise ValueError('Set "%s" has more keywords than "keywords_count"' % definition['set'])
+                    campaign = add_set_part(processor, definition, keywords_part, campaign, account)
+                    added += 1
+                    partial = definition['set']
+                
+                if added == 0:
+                    raise ValueError('"keywords" of set "%s" should not be empty' % definition['set'])
+                
+                if isinstance(campaign_key, tuple):
+                    new_campaigns[campaign_key] = campaign
+                result[definition['set']] = account
+                partial = None
+            
+            processor.sign_out()
+    except cancellation.OperationCancelledError, e:
+        e.status.update(created=[name for name in names if name in result], partial=partial,
+                        remaining=[name for name in names if name not in result and name != partial])
+        raise
     
-    return campaign.account
+    return result
     
     
+@transactional
 def drop_set(set):
     '''
     Deletes the current set of keywords with related AdGroups.
     
     @param set: str
     '''
+    session = get_session()
     adgroups = session.query(AdGroup).filter(AdGroup.set == set)
     
     if adgroups.count() == 0:
@@ -495,22 +1260,31 @@ def drop_set(set):
         processor.sign_in()
         
         for adgroup in adgroups.all():
-            processor.delete_adgroup(campaign.id, adgroup.id)
-            UsedNames.remove_entity(AdGroup.__name__, adgroup.id)
-            session.delete(adgroup)
+            with cancellation.shielded():
+                processor.delete_adgroup(campaign.id, adgroup.id)
+                UsedNames.remove_entity(AdGroup.__name__, adgroup.id)
+                KeywordEntry.unindex_adgroup(adgroup.id)
+                session.delete(adgroup)
+                session.commit()
         
         session.commit()
         processor.sign_out()
 
     
-def get_keywords(set):
+@transactional
+def get_keywords(set, concurrency=None):
     '''
     Returns list of Keyword instances from given set.
     
+    Adgroups are read one at a time unless concurrency (by default
+    settings.READ_CONCURRENCY) allows more, see read_adgroups().
+    
     @param set: str
+    @param concurrency: int
     
     @return: list
     '''
+    session = get_session()
     adgroups = session.query(AdGroup).filter(AdGroup.set == set)
     
     if adgroups.count() == 0:
@@ -521,115 +1295,358 @@ def get_keywords(set):
         processor.sign_in()
         
         keywords = []
-        for adgroup in adgroups.all():
-            keywords += processor.get_keywords(campaign.id, adgroup.id)
+        parts = read_adgroups(processor, [(adgroup.campaign_id, adgroup.id) for adgroup in adgroups.all()],
+            lambda reader, campaign_id, adgroup_id: reader.get_keywords(campaign_id, adgroup_id), concurrency)
+        for part in parts:
+            keywords += part
         
         processor.sign_out()
     
     return keywords
 
 
-def modify_keywords(set, new_keywords):
+@transactional
+def modify_keywords(set, new_keywords, normalize=None):
     '''
     Resubmits the keywords list of a given set with a new one.
     
-    List can contain both strings and Keyword instances
+    List can contain both strings and Keyword instances, any iterable of them
+    is read one adgroup at a time (see create_set()). With normalize
+    (settings.NORMALIZE_KEYWORDS by default) they are normalized and
+    deduplicated first, see normalize_keywords().
     
     @param set: str
     @param keywords: list
+    @param normalize: bool
     ''' 
-    adgroups = session.query(AdGroup).filter(AdGroup.set == set)
+    update_sets({set: {'keywords': new_keywords, 'normalize': normalize}})
+
+
+@transactional
+def change_default_bid(set, bid):
+    '''
+    Changes default bid value of a set
     
-    if adgroups.count() == 0:
-        raise ValueError('Set "%s" not found' % set)
-    if len(new_keywords) == 0:
-        raise ValueError('"new_keywords" should not be empty')
+    @param set: str
+    @param bid: Decimal
+    '''
+    update_sets({set: {'bid': bid}})
+
+
+@transactional
+def update_sets(updates):
+    '''
+    Changes default bids and/or keywords of many sets at once.
     
-    campaign = adgroups.first().campaign
-    processor = RequestProcessor(campaign.account.email, campaign.account.password)
-    processor.sign_in()
+    'updates' maps set names to dicts with optional 'bid' (new default bid)
+    and 'keywords' (new keywords list, as for modify_keywords()) keys, and
+    'normalize' (see modify_keywords()) applying to the keywords. When
+    both are given for a set they are merged into a single EditKeywords
+    submission per adgroup. Sets are grouped by account so each account is
+    signed in once.
     
-    an_adgroup = adgroups.first()
-    adgroups = adgroups.all()
+    The status of OperationCancelledError (see adwords.cancellation) lists
+    sets 'updated' and 'remaining'. Updating the remaining ones again skips
+    their adgroups already updated.
     
-    while True:
-        adgroup = adgroups.pop(0)
-        keywords_part = new_keywords[:settings.MAX_KEYWORDS_PER_ADGROUP]
-        new_keywords = new_keywords[settings.MAX_KEYWORDS_PER_ADGROUP:]
-        
-        campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)
-        adgroup_name = UsedNames.get_entity_name(AdGroup.__name__, adgroup.id)
-        processor.set_keywords(campaign.id, adgroup.id, preprocess_keywords(keywords_part, campaign_name, adgroup_name))
-        
-        if len(adgroups) == 0 or len(new_keywords) == 0:
-            break
+    @param updates: dict
+    '''
+    session = get_session()
+    updates = dict(updates)
+    
+    adgroups_by_set = {}
+    for adgroup in session.query(AdGroup).filter(AdGroup.set.in_(updates.keys())).order_by(AdGroup.id):
+        adgroups_by_set.setdefault(adgroup.set, []).append(adgroup)
+    
+    # account id => set names
+    sets_by_account = {}
+    for set_name in sorted(updates.keys()):
+        if set_name not in adgroups_by_set:
+            raise ValueError('Set "%s" not found' % set_name)
+        keywords = updates[set_name].get('keywords')
+        # normalizing never empties keywords, but hides their length
+        if hasattr(keywords, '__len__') and len(keywords) == 0:
+            raise ValueError('"new_keywords" should not be empty')
+        if keywords is not None:
+            keywords = _normalize_if_asked(set_name, keywords, updates[set_name].get('normalize'))
+            updates[set_name] = dict(updates[set_name], keywords=keywords)
         
-    if len(adgroups) > 0:
-        for adgroup_to_remove in adgroups:
-            processor.delete_adgroup(campaign.id, adgroup_to_remove.id)
-            session.delete(adgroup_to_remove)
+        account_id = adgroups_by_set[set_name][0].campaign.account_id
+        sets_by_account.setdefault(account_id, []).append(set_name)
+    
+    updated = []
+    try:
+        for account_id, set_names in sorted(sets_by_account.items()):
+            account = session.query(Account).get(account_id)
+            processor = RequestProcessor(account.email, account.password)
+            processor.sign_in()
             
-    while len(new_keywords) > 0:
-        if not (len(campaign.adgroups) < settings.MAX_ADGROUPS_PER_CAMPAIGN):
-            raise OverflowError('limits exceeded during modifying keywords')
-        
-        new_adgroup_name = AdGroup.find_unique_name(set, campaign)
-        campaign_name = UsedNames.get_entity_name(Campaign.__name__, campaign.id)
-        new_adgroup_id = processor.add_adgroup(
-            campaign.id, new_adgroup_name, an_adgroup.display_url, preprocess_url(an_adgroup.default_url, campaign_name, new_adgroup_name), 
-            an_adgroup.headline, an_adgroup.adline1, an_adgroup.adline2, 
-            preprocess_keywords(new_keywords[:settings.MAX_KEYWORDS_PER_ADGROUP], plain=True), an_adgroup.default_bid
-        )
-        UsedNames.add_entity(AdGroup.__name__, new_adgroup_id, campaign.id, new_adgroup_name)
-        processor.set_keywords(campaign.id, new_adgroup_id, preprocess_keywords(new_keywords[:settings.MAX_KEYWORDS_PER_ADGROUP], campaign_name, new_adgroup_name))
-        
-        adgroup = AdGroup(long(new_adgroup_id), campaign.id, set,
-            an_adgroup.default_bid, an_adgroup.default_url, an_adgroup.display_url, 
-            an_adgroup.headline, an_adgroup.adline1, an_adgroup.adline2)
-        session.add(adgroup)
-        
-        new_keywords = new_keywords[settings.MAX_KEYWORDS_PER_ADGROUP:]
-        
-    session.commit()
-    processor.sign_out()
+            for set_name in set_names:
+                update_set_adgroups(processor, adgroups_by_set[set_name],
+                    updates[set_name].get('keywords'), updates[set_name].get('bid'))
+                updated.append(set_name)
+            
+            processor.sign_out()
+    except cancellation.OperationCancelledError, e:
+        e.status.update(updated=sorted(updated), remaining=sorted(frozenset(updates) - frozenset(updated)))
+        raise
 
 
-def change_default_bid(set, bid):
+@transactional
+def change_keywords(keywords, set=None):
     '''
-    Changes default bid value of a set
+    Changes bids and/or urls of particular keywords rewriting only the
+    adgroups holding them.
     
-    @param set: str
-    @param bid: Decimal
+    'keywords' is a list of Keyword instances, a bid or url left None keeps
+    the current value. Holding adgroups are looked up in the local keywords
+    index (see KeywordEntry), so only keywords submitted through the mapper
+    can be found. Accounts are signed in once each.
+    
+    @param keywords: list
+    @param set: str - only change keywords of this set
+    
+    @return: int - number of adgroups rewritten
     '''
-    adgroups = session.query(AdGroup).filter(AdGroup.set == set)
+    session = get_session()
     
-    if adgroups.count() == 0:
-        raise ValueError('Set "%s" not found' % set)
-    else:
-        campaign = adgroups.first().campaign
-        processor = RequestProcessor(campaign.account.email, campaign.account.password)
+    changes = {}
+    for keyword in keywords:
+        changes[keyword.keyword] = keyword
+    
+    texts = changes.keys()
+    found = {}
+    for i in range(0, len(texts), 500):
+        query = session.query(KeywordEntry.keyword, KeywordEntry.adgroup_id) \
+            .filter(KeywordEntry.keyword.in_(texts[i:i + 500]))
+        if set is not None:
+            query = query.join((AdGroup, KeywordEntry.adgroup_id == AdGroup.id)).filter(AdGroup.set == set)
+        for text, adgroup_id in query:
+            found.setdefault(text, []).append(adgroup_id)
+    
+    for text in texts:
+        if text not in found:
+            raise ValueError('Keyword "%s" not found' % text)
+    
+    adgroups_ids = {}
+    for ids in found.values():
+        for adgroup_id in ids:
+            adgroups_ids[adgroup_id] = True
+    
+    # account id => adgroups
+    adgroups_by_account = {}
+    for adgroup in session.query(AdGroup).filter(AdGroup.id.in_(adgroups_ids.keys())).order_by(AdGroup.id):
+        adgroups_by_account.setdefault(adgroup.campaign.account_id, []).append(adgroup)
+    
+    for account_id, adgroups in sorted(adgroups_by_account.items()):
+        account = session.query(Account).get(account_id)
+        processor = RequestProcessor(account.email, account.password)
         processor.sign_in()
         
-        for adgroup in adgroups.all():
-            processor.set_default_bid(campaign.id, adgroup.id, bid)
+        for adgroup in adgroups:
+            with cancellation.shielded():
+                adgroup_keywords = []
+                for entry in session.query(KeywordEntry).filter(KeywordEntry.adgroup_id == adgroup.id).order_by(KeywordEntry.id):
+                    change = changes.get(entry.keyword)
+                    if change is not None:
+                        if change.bid is not None:
+                            entry.bid = change.bid
+                        if change.url is not None:
+                            entry.url = change.url
+                    adgroup_keywords.append(entry.to_keyword())
+                
+                campaign_name = UsedNames.get_entity_name(Campaign.__name__, adgroup.campaign_id)
+                adgroup_name = UsedNames.get_entity_name(AdGroup.__name__, adgroup.id)
+                processor.edit_keywords(adgroup.campaign_id, adgroup.id, 
+                    preprocess_keywords(adgroup_keywords, campaign_name, adgroup_name))
+                session.commit()
         
         processor.sign_out()
+    
+    return len(adgroups_ids)
+
+
+def _keyword_lookup_query(session):
+    return session.query(KeywordEntry.keyword, KeywordEntry.text, KeywordEntry.match_mode, 
+            AdGroup.set, AdGroup.id, Campaign.id, Account.email) \
+        .filter(KeywordEntry.adgroup_id == AdGroup.id) \
+        .filter(AdGroup.campaign_id == Campaign.id) \
+        .filter(Campaign.account_id == Account.id)
+
+
+def _keyword_lookup_results(rows):
+    return [{
+        'keyword': keyword,
+        'text': text,
+        'match_mode': match_mode,
+        'set': set,
+        'adgroup_id': adgroup_id,
+        'campaign_id': campaign_id,
+        'account': email,
+    } for keyword, text, match_mode, set, adgroup_id, campaign_id, email in rows]
+
+
+@transactional
+def find_keyword(keyword, match_mode=None):
+    '''
+    Looks a keyword up in the local keywords index. Returns a list of dicts
+    with 'keyword', 'text', 'match_mode', 'set', 'adgroup_id', 'campaign_id'
+    and 'account' (email) keys, one per adgroup holding the keyword.
+    
+    Keyword can be given with match mode syntax ('[exact]', '"phrase"',
+    '-negative'), which is used unless match_mode is passed explicitly.
+    No requests to AdWords are made.
+    
+    @param keyword: str
+    @param match_mode: str - one of Keyword.MATCH_MODE_* or None for any
+    
+    @return: list
+    '''
+    session = get_session()
+    
+    text, parsed_match_mode = split_match_mode(keyword)
+    if match_mode is None and text != normalize_text(keyword):
+        match_mode = parsed_match_mode
+    
+    query = _keyword_lookup_query(session).filter(KeywordEntry.text == text)
+    if match_mode is not None:
+        query = query.filter(KeywordEntry.match_mode == match_mode)
+    
+    return _keyword_lookup_results(query.order_by(KeywordEntry.id).all())
+
+
+@transactional
+def find_keywords_by_prefix(prefix, match_mode=None, limit=None):
+    '''
+    Returns index entries (see find_keyword()) of keywords starting with
+    a given prefix.
+    
+    @param prefix: str
+    @param match_mode: str - one of Keyword.MATCH_MODE_* or None for any
+    @param limit: int
+    
+    @return: list
+    '''
+    session = get_session()
+    
+    # a trailing space means the prefix is a whole word
+    whole_word = prefix[-1:].isspace()
+    prefix = normalize_text(prefix) + (' ' if whole_word else '')
+    escaped = prefix.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    
+    query = _keyword_lookup_query(session).filter(KeywordEntry.text.like(escaped + '%', escape='!'))
+    if match_mode is not None:
+        query = query.filter(KeywordEntry.match_mode == match_mode)
+    query = query.order_by(KeywordEntry.text)
+    if limit is not None:
+        query = query.limit(limit)
+    
+    return _keyword_lookup_results(query.all())
 
 
-def report_set_performance(set, days=7):
+@transactional
+def find_duplicates(keywords=None, exclude_set=None):
+    '''
+    Finds keywords present in more than one set, using the local keywords
+    index only.
+    
+    With 'keywords' given (e.g. a set being prepared) returns a dict
+    (text, match mode) => list of set names already holding that keyword.
+    Without it returns the same dict for every keyword of the index held
+    by two sets or more.
+    
+    @param keywords: list - strings and/or Keyword instances
+    @param exclude_set: str - set to ignore, e.g. the one being modified
+    
+    @return: dict
+    '''
+    session = get_session()
+    
+    query = session.query(KeywordEntry.text, KeywordEntry.match_mode, AdGroup.set) \
+        .filter(KeywordEntry.adgroup_id == AdGroup.id)
+    if exclude_set is not None:
+        query = query.filter(AdGroup.set != exclude_set)
+    
+    result = {}
+    
+    if keywords is None:
+        duplicated = session.query(KeywordEntry.text, KeywordEntry.match_mode) \
+            .filter(KeywordEntry.adgroup_id == AdGroup.id) \
+            .group_by(KeywordEntry.text, KeywordEntry.match_mode) \
+            .having(func.count(AdGroup.set.distinct()) > 1)
+        if exclude_set is not None:
+            duplicated = duplicated.filter(AdGroup.set != exclude_set)
+        wanted = dict([(key, True) for key in duplicated])
+        texts = dict([(text, True) for text, match_mode in wanted]).keys()
+    else:
+        wanted = {}
+        for keyword in keywords:
+            if isinstance(keyword, Keyword):
+                keyword = keyword.keyword
+            wanted[split_match_mode(keyword)] = True
+        texts = dict([(text, True) for text, match_mode in wanted]).keys()
+    
+    for i in range(0, len(texts), 500):
+        for text, match_mode, set in query.filter(KeywordEntry.text.in_(texts[i:i + 500])):
+            if (text, match_mode) in wanted:
+                sets = result.setdefault((text, match_mode), [])
+                if set not in sets:
+                    sets.append(set)
+    
+    if keywords is None:
+        for key in result.keys():
+            if len(result[key]) < 2:
+                del result[key]
+    
+    return result
+
+
+@transactional
+def reindex_set(set):
+    '''
+    Refills the local keywords index of a set from AdWords, e.g. for sets
+    created before the index existed.
+    
+    @param set: str
+    '''
+    session = get_session()
+    adgroups = session.query(AdGroup).filter(AdGroup.set == set).order_by(AdGroup.id).all()
+    
+    if len(adgroups) == 0:
+        raise ValueError('Set "%s" not found' % set)
+    
+    account = adgroups[0].campaign.account
+    processor = RequestProcessor(account.email, account.password)
+    processor.sign_in()
+    
+    for adgroup in adgroups:
+        KeywordEntry.index_adgroup(adgroup.id, processor.get_keywords(adgroup.campaign_id, adgroup.id))
+        session.commit()
+    
+    processor.sign_out()
+
+
+@transactional
+def report_set_performance(set, days=7, concurrency=None):
     '''
     Returns keywords performance report of given set for specified days count
     as a dictionary with keywords as keys and their perf values as the values
     of that dict.
     
     Some values may appear as None in case the value cannot be
-    calculated yet.
+    calculated yet. When cancelled (see adwords.cancellation) the report of
+    the adgroups done so far is the 'report' of the error status.
+    
+    Adgroups are read one at a time unless concurrency (by default
+    settings.READ_CONCURRENCY) allows more, see read_adgroups().
     
     @param set: str
     @param days: int
+    @param concurrency: int
     
     @return: dict
     '''
+    session = get_session()
     adgroups = session.query(AdGroup).filter(AdGroup.set == set)
     
     if days < 1:
@@ -642,10 +1659,169 @@ def report_set_performance(set, days=7):
     processor.sign_in()
     
     keywords = {}
-    for adgroup in adgroups.all():
-        keywords.update(processor.get_keywords_report(campaign.id, adgroup.id, days))
+    reports = {}
+    try:
+        read_adgroups(processor, [(adgroup.campaign_id, adgroup.id) for adgroup in adgroups.all()],
+            lambda reader, campaign_id, adgroup_id: reader.get_keywords_report(campaign_id, adgroup_id, days),
+            concurrency, reports)
+    except cancellation.OperationCancelledError, e:
+        for index in sorted(reports):
+            keywords.update(reports[index])
+        e.status['report'] = keywords
+        raise
+    finally:
+        processor.sign_out()
     
-    processor.sign_out()
+    for index in sorted(reports):
+        keywords.update(reports[index])
     
     return keywords
+
+
+@transactional
+def list_adgroups_by_account(sets=None):
+    '''
+    Loads adgroups of given (or all) sets with one query and groups them by
+    account. Plain values are returned so no session is needed to use them.
+    
+    @param sets: list
+    
+    @return: dict - (email, password) => list of (set, campaign_id, adgroup_id)
+        ordered by set and adgroup
+    '''
+    query = get_session().query(Account.email, Account.password, AdGroup.set, AdGroup.campaign_id, AdGroup.id) \
+        .filter(Campaign.id == AdGroup.campaign_id) \
+        .filter(Account.id == Campaign.account_id)
+    if sets is not None:
+        query = query.filter(AdGroup.set.in_(list(sets)))
+    
+    result = {}
+    for email, password, set, campaign_id, adgroup_id in query.order_by(AdGroup.set, AdGroup.id):
+        result.setdefault((email, password), []).append((set, campaign_id, adgroup_id))
+    
+    return result
+
+
+def _report_account(email, password, adgroups, days, sink):
+    processor = RequestProcessor(email, password)
+    processor.sign_in()
+    
+    sets_count = 0
+    try:
+        set, keywords = None, {}
+        for adgroup_set, campaign_id, adgroup_id in adgroups:
+            if adgroup_set != set:
+                if set is not None:
+                    sink(set, keywords)
+                    sets_count += 1
+                set, keywords = adgroup_set, {}
+            keywords.update(processor.get_keywords_report(campaign_id, adgroup_id, days))
+        
+        sink(set, keywords)
+        sets_count += 1
+    finally:
+        processor.sign_out()
+    
+    return sets_count
+
+
+def report_all_sets(sink, days=7, sets=None, threads=None):
+    '''
+    Reports performance of all (or given) sets, see report_set_performance(),
+    passing each set report to the sink as soon as it's complete:
+    
+        report_all_sets(lambda set, report: reports.__setitem__(set, report))
+    
+    Adgroups are loaded with one query. Every account is signed in once and
+    accounts are reported in parallel, the largest first, so a sweep takes
+    about as long as its largest account. The sink is called from these
+    threads but never by two at a time. A failing account doesn't stop the
+    others, its sets reported so far stay passed to the sink. Errors of the
+    sink are returned apart and stop neither the account nor the others.
+    
+    A cancellation token of the calling thread (see adwords.cancellation)
+    stops all accounts, sets not reported because of it are returned as
+    'cancelled' instead of raising OperationCancelledError.
+    
+    @param sink: callable - sink(set, report) with report as returned by
+        report_set_performance()
+    @param days: int
+    @param sets: list - None for all sets
+    @param threads: int - accounts reported at a time, settings.REPORT_THREADS
+        by default
+    
+    @return: dict - 'sets' (number of sets reported), 'failed' (account
+        email => error), 'sink_failed' (set => error raised by the sink) and
+        'cancelled' (list of sets)
+    '''
+    if days < 1:
+        raise ValueError('Days cannot be %d' % days)
+    
+    adgroups_by_account = list_adgroups_by_account(sets)
+    accounts = sorted(adgroups_by_account.keys(), key=lambda account: -len(adgroups_by_account[account]))
+    
+    lock = threading.Lock()
+    sink_lock = threading.Lock()
+    result = {'sets': 0, 'failed': {}, 'sink_failed': {}, 'cancelled': []}
+    token = cancellation.get_current()
+    reported = set()
+    
+    def locked_sink(set, report):
+        sink_lock.acquire()
+        try:
+            try:
+                sink(set, report)
+            except Exception, e:
+                logwriter.log(logwriter.ERROR, '! passing set report to the sink failed: %s' % e, set=set)
+                result['sink_failed'][set] = e
+            reported.add(set)
+        finally:
+            sink_lock.release()
+    
+    def report_accounts():
+        if token is not None:
+            with cancellation.use(token):
+                report_accounts_until_done()
+        else:
+            report_accounts_until_done()
+    
+    def report_accounts_until_done():
+        while True:
+            lock.acquire()
+            try:
+                if not accounts:
+                    return
+                email, password = accounts.pop(0)
+            finally:
+                lock.release()
+            
+            try:
+                sets_count = _report_account(email, password, adgroups_by_account[(email, password)], days, locked_sink)
+            except cancellation.OperationCancelledError:
+                account_sets = frozenset([adgroup[0] for adgroup in adgroups_by_account[(email, password)]])
+                lock.acquire()
+                result['cancelled'].extend(sorted(account_sets - reported))
+                lock.release()
+            except Exception, e:
+                logwriter.log(logwriter.ERROR, '! reporting account failed: %s' % e, account=email)
+                lock.acquire()
+                result['failed'][email] = e
+                lock.release()
+            else:
+                logwriter.log(logwriter.INFO, '%d sets reported' % sets_count, account=email)
+                lock.acquire()
+                result['sets'] += sets_count
+                lock.release()
+    
+    workers = []
+    for number in range(min(threads or settings.REPORT_THREADS, len(accounts))):
+        worker = threading.Thread(target=report_accounts, name='adwords-report-%d' % (number + 1))
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+    
+    for worker in workers:
+        worker.join()
+    
+    return result
 #-------------------------------------------------------------------------------
\ No newline at end of file
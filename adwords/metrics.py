@@ -0,0 +1,222 @@
+'''
+adwords.metrics
+
+@version: 0.1.1
+'''
+
+import threading
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+# Upper bounds of histogram buckets, seconds
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of histogram buckets, bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HISTOGRAMS = {
+    'adwords_request_seconds': TIME_BUCKETS,
+    'adwords_request_bytes': SIZE_BUCKETS,
+    'adwords_delay_seconds': TIME_BUCKETS,
+    'adwords_operation_seconds': TIME_BUCKETS + (300.0, 900.0),
+    'adwords_wizard_wasted_seconds': TIME_BUCKETS + (300.0,),
+    'adwords_job_seconds': TIME_BUCKETS + (300.0, 900.0, 3600.0),
+}
+
+
+def enabled():
+    '''
+    Returns whether metrics are being collected. Checked by every hook before
+    doing any work so collection costs a single lookup when it's off.
+
+    @return: bool
+    '''
+    return settings.METRICS_ENABLED
+
+#-------------------------------------------------------------------------------
+
+class Histogram:
+    '''
+    Cumulative histogram with fixed buckets, the way Prometheus expects it.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        return {
+            'buckets': zip(self.buckets, self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Registry:
+    '''
+    Keeps histograms and counters keyed by metric name and labels, plus a list
+    of listeners called with every raw event.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        '''
+        Registers a callable receiving (name, labels, value) for every
+        observation made while metrics are enabled.
+
+        @param listener: callable
+        '''
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def observe(self, name, labels, value):
+        '''
+        @param name: str - one of HISTOGRAMS keys
+        @param labels: dict
+        @param value: float
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(HISTOGRAMS[name])
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+        for listener in self._listeners:
+            listener(name, labels, value)
+
+    def increment(self, name, labels, value=1):
+        '''
+        @param name: str
+        @param labels: dict
+        @param value: int
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+        for listener in self._listeners:
+            listener(name, labels, value)
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._histograms = {}
+            self._counters = {}
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        '''
+        Returns a copy of everything collected so far as a dict:
+        {'histograms': {name: [(labels, data)]}, 'counters': {name: [(labels, value)]}}
+
+        @return: dict
+        '''
+        result = {'histograms': {}, 'counters': {}}
+
+        self._lock.acquire()
+        try:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                result['histograms'].setdefault(name, []).append((dict(labels), histogram.as_dict()))
+            for (name, labels), value in sorted(self._counters.items()):
+                result['counters'].setdefault(name, []).append((dict(labels), value))
+        finally:
+            self._lock.release()
+
+        return result
+
+    def summary(self, name, by='operation'):
+        '''
+        Aggregates a histogram over every label but the given one and returns
+        a dict {label value: {'count': int, 'sum': float, 'avg': float}}
+
+        @param name: str
+        @param by: str - 'operation' or 'account'
+
+        @return: dict
+        '''
+        result = {}
+        for labels, data in self.snapshot()['histograms'].get(name, []):
+            entry = result.setdefault(labels.get(by), {'count': 0, 'sum': 0.0})
+            entry['count'] += data['count']
+            entry['sum'] += data['sum']
+        for entry in result.values():
+            entry['avg'] = entry['sum'] / entry['count'] if entry['count'] else 0.0
+
+        return result
+
+    def export_prometheus(self):
+        '''
+        Renders collected data in Prometheus text exposition format.
+
+        @return: str
+        '''
+        snapshot = self.snapshot()
+        lines = []
+
+        for name, entries in sorted(snapshot['histograms'].items()):
+            lines.append('# TYPE %s histogram' % name)
+            for labels, data in entries:
+                for bound, count in data['buckets']:
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le=repr(float(bound))), count))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le='+Inf'), data['count']))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels), data['sum']))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), data['count']))
+
+        for name, entries in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in entries:
+                lines.append('%s%s %r' % (name, _format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels, **extra):
+    items = sorted(labels.items()) + sorted(extra.items())
+    if not items:
+        return ''
+
+    escaped = []
+    for key, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (key, value))
+
+    return '{' + ','.join(escaped) + '}'
+
+#-------------------------------------------------------------------------------
+
+registry = Registry()
+
+observe = registry.observe
+increment = registry.increment
+snapshot = registry.snapshot
+summary = registry.summary
+export_prometheus = registry.export_prometheus
+reset = registry.reset
+add_listener = registry.add_listener
+remove_listener = registry.remove_listener
+#-------------------------------------------------------------------------------
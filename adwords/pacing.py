@@ -0,0 +1,231 @@
+'''
+adwords.pacing
+
+@version: 0.1.1
+'''
+
+import time
+import threading
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+def enabled():
+    '''
+    Returns whether RequestProcessor delays are chosen by the controller
+    instead of being drawn from the fixed FAKE_DELAY_MIN/MAX range.
+
+    @return: bool
+    '''
+    return settings.ADAPTIVE_PACING
+
+#-------------------------------------------------------------------------------
+
+class Pace:
+    '''
+    Pacing state of one account and operation.
+    '''
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.latency = None
+        self.best_latency = None
+        self.failure_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    def as_dict(self):
+        return {
+            'delay': self.delay,
+            'latency': self.latency,
+            'best_latency': self.best_latency,
+            'failure_rate': self.failure_rate,
+            'successes': self.successes,
+            'failures': self.failures,
+        }
+
+
+class PacingController:
+    '''
+    Chooses the delay between requests of each account and operation, the
+    additive increase/multiplicative decrease way: every quick successful
+    response shortens the delay a little, every failure (an http error or an
+    UnexpectedResponseError) multiplies it. Responses getting much slower
+    than the best seen so far stop the shortening and lengthen the delay a
+    little, so the service is backed off before it starts failing.
+
+    Delays always stay within settings.PACING_MIN_DELAY and
+    settings.PACING_MAX_DELAY.
+
+    The controller also spaces the requests of each account, see reserve(),
+    so processors sharing an account (like forks reading in parallel) don't
+    multiply its request rate.
+    '''
+
+    def __init__(self, min_delay=None, max_delay=None, step=None, backoff=None, slow_response=None, smoothing=None):
+        '''
+        Arguments left None are taken from adwords.settings.
+
+        @param min_delay: float - seconds
+        @param max_delay: float - seconds
+        @param step: float - seconds a delay changes by on a success
+        @param backoff: float - factor a delay is multiplied by on a failure
+        @param slow_response: float - latency, relative to the best one, considered slow
+        @param smoothing: float - weight of the latest response in the averages
+        '''
+        self.min_delay = settings.PACING_MIN_DELAY if min_delay is None else min_delay
+        self.max_delay = max_delay or settings.PACING_MAX_DELAY
+        self.step = step or settings.PACING_STEP
+        self.backoff = backoff or settings.PACING_BACKOFF
+        self.slow_response = slow_response or settings.PACING_SLOW_RESPONSE
+        self.smoothing = smoothing or settings.PACING_SMOOTHING
+
+        self._lock = threading.Lock()
+        self._paces = {}
+        # account => time.time() the next request may be sent at
+        self._next_requests = {}
+
+    def _get_pace(self, account, operation):
+        pace = self._paces.get((account, operation))
+        if pace is None:
+            # starting at the fixed delay the processor would otherwise use
+            initial = (settings.FAKE_DELAY_MIN + settings.FAKE_DELAY_MAX) / 2
+            pace = self._paces[(account, operation)] = Pace(self._bound(initial))
+        return pace
+
+    def _bound(self, delay):
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def get_delay(self, account, operation):
+        '''
+        @param account: str
+        @param operation: str
+
+        @return: float - seconds
+        '''
+        self._lock.acquire()
+        try:
+            return self._get_pace(account, operation).delay
+        finally:
+            self._lock.release()
+
+    def reserve(self, account, delay):
+        '''
+        Reserves the next request of an account, delay seconds after now or
+        after the request reserved before, whichever is later, and returns
+        the seconds to wait for it. A single processor so waits the delay
+        itself, processors of one account waiting at the same time take
+        turns.
+
+        @param account: str
+        @param delay: float - seconds
+
+        @return: float - seconds
+        '''
+        self._lock.acquire()
+        try:
+            now = time.time()
+            at = max(now, self._next_requests.get(account, now)) + delay
+            self._next_requests[account] = at
+            return at - now
+        finally:
+            self._lock.release()
+
+    def record_success(self, account, operation, latency):
+        '''
+        @param account: str
+        @param operation: str
+        @param latency: float - seconds the response took
+        '''
+        self._lock.acquire()
+        try:
+            pace = self._get_pace(account, operation)
+            pace.successes += 1
+            pace.failure_rate *= 1 - self.smoothing
+
+            if pace.latency is None:
+                pace.latency = latency
+            else:
+                pace.latency += self.smoothing * (latency - pace.latency)
+            if pace.best_latency is None or pace.latency < pace.best_latency:
+                pace.best_latency = pace.latency
+
+            if pace.latency > pace.best_latency * self.slow_response:
+                pace.delay = self._bound(pace.delay + self.step)
+            else:
+                pace.delay = self._bound(pace.delay - self.step)
+        finally:
+            self._lock.release()
+
+    def record_failure(self, account, operation):
+        '''
+        @param account: str
+        @param operation: str
+        '''
+        self._lock.acquire()
+        try:
+            pace = self._get_pace(account, operation)
+            pace.failures += 1
+            pace.failure_rate += self.smoothing * (1 - pace.failure_rate)
+            pace.delay = self._bound(pace.delay * self.backoff)
+        finally:
+            self._lock.release()
+
+    def state(self):
+        '''
+        Returns the current state as a dict with (account, operation) keys
+        and dicts with delay, latency, best_latency, failure_rate, successes
+        and failures values.
+
+        @return: dict
+        '''
+        self._lock.acquire()
+        try:
+            return dict([(key, pace.as_dict()) for key, pace in self._paces.items()])
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._paces = {}
+            self._next_requests = {}
+        finally:
+            self._lock.release()
+
+#-------------------------------------------------------------------------------
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    '''
+    Returns the process-wide controller shared by all processors, creating
+    it from adwords.settings on first call.
+
+    @return: PacingController
+    '''
+    global _controller
+
+    if _controller is None:
+        _controller_lock.acquire()
+        try:
+            if _controller is None:
+                _controller = PacingController()
+        finally:
+            _controller_lock.release()
+
+    return _controller
+
+
+def set_controller(controller):
+    '''
+    Replaces the process-wide controller, e.g. with one using other bounds.
+
+    @param controller: PacingController
+    '''
+    global _controller
+    _controller = controller
+#-------------------------------------------------------------------------------
@@ -0,0 +1,132 @@
+'''
+adwords.pageparser
+
+@version: 0.1.1
+'''
+
+import re
+import decimal
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+# name => (tag start the element begins with, pattern with a group of that name)
+KEYWORDS_TEXTAREA = ('keywords', '<textarea', re.compile('<textarea [^>]*name="keywords"[^>]*>(?P<keywords>[^<]*)</textarea>'))
+PRICE_INPUT = ('price', '<input', re.compile('<input [^>]*name="price"[^>]*value="(?P<price>[^"]+)"'))
+ADGROUP_ID = ('adgroup_id', 'adgroupid=', re.compile('adgroupid=(?P<adgroup_id>\d+)'))
+
+# keywords report page (CampaignManagement keywords tab)
+REPORT_ROW = re.compile(r'<tr[^>]*?id="tr_\d+"[^>]*?>(?P<data_row>.*?)</tr>', re.DOTALL)
+REPORT_KEYWORD = re.compile('</div>\n</span>\n(?P<keyword>[\w\s\d]+?)</td>\n')
+REPORT_BID = re.compile('<td nowrap align="center" colspan="2">(?P<bid>[$\d\.-]+?)</td>\n')
+REPORT_DATA = re.compile('<td class="" align="right">(?P<clicks>[\d-]+?)\n' +
+                         '.*?</td>\n+?' +
+                         '<td class="" align="right">(?P<impr>[\d-]+?)\n' +
+                         '.*?</td>\n+?' +
+                         '<td class="" align="right">(?P<ctr>[\d\.-]+?)\n' +
+                         '.*?</td>\n+?' +
+                         '<td class="" align="right">(?P<cpc>[$\d\.-]+?)\n' +
+                         '.*?</td>\n+?' +
+                         '<td class="" align="right">(?P<cost>[$\d\.-]+?)\n' +
+                         '.*?</td>\n+?' +
+                         '<td class="rightcolumn" align="right">(?P<pos>[\d\.-]+?)\n' +
+                         '.*?</td>\n+?')
+REPORT_NEXT_PAGE = re.compile('<a href="(?P<url>[^"]+?)"><b>Next')
+
+#-------------------------------------------------------------------------------
+
+def extract(response, targets, chunk_size=None, stats=None):
+    '''
+    Reads a response in chunks and returns values of the first matches of
+    given targets as a dict (missing ones are left out). Reading stops as
+    soon as all targets are matched and the response is closed, so the rest
+    of the page is neither downloaded nor kept.
+
+    Only a window holding a possibly unfinished element is kept between
+    chunks, it grows beyond a chunk only while a long element (like the
+    keywords textarea) is being read.
+
+    @param response: file-like object
+    @param targets: list - tuples like KEYWORDS_TEXTAREA
+    @param chunk_size: int
+    @param stats: dict - if given, gets 'bytes_read' and 'max_window' keys
+
+    @return: dict
+    '''
+    chunk_size = chunk_size or settings.READ_CHUNK_SIZE
+    pending = list(targets)
+    result = {}
+
+    window = ''
+    bytes_read = 0
+    max_window = 0
+
+    while pending:
+        chunk = response.read(chunk_size)
+        finished = not chunk
+        bytes_read += len(chunk)
+        window += chunk
+        max_window = max(max_window, len(window))
+
+        for target in pending[:]:
+            name, start, pattern = target
+            match = pattern.search(window)
+            # a match touching the window end may still grow with the next chunk
+            if match and (finished or match.end() < len(window)):
+                result[name] = match.group(name)
+                pending.remove(target)
+
+        if finished:
+            break
+
+        # keeping everything since the last start of a still pending element
+        keep_from = len(window)
+        for name, start, pattern in pending:
+            position = window.rfind(start)
+            if position == -1:
+                position = max(0, len(window) - len(start) + 1)
+            keep_from = min(keep_from, position)
+        window = window[keep_from:]
+
+    response.close()
+
+    if stats is not None:
+        stats['bytes_read'] = bytes_read
+        stats['max_window'] = max_window
+
+    return result
+
+
+def parse_report_page(page):
+    '''
+    Parses one page of the keywords report. Returns a dict with keys -
+    keywords and values - dicts with the keyword rates (None if a rate is
+    shown as '-'), and the url of the next page or None for the last one.
+
+    @param page: str
+
+    @return: tuple - (dict, str)
+    '''
+    result = {}
+
+    for row_match in REPORT_ROW.finditer(page):
+        data_row = row_match.group('data_row')
+        keyword = REPORT_KEYWORD.search(data_row).group('keyword')
+        bid = REPORT_BID.search(data_row).group('bid')
+        data = REPORT_DATA.search(data_row)
+
+        result[keyword] = {'bid': bid,
+                           'clicks': int(data.group('clicks')),
+                           'impr': int(data.group('impr')),
+                           'ctr': None if data.group('ctr') == '-' else decimal.Decimal(data.group('ctr')),
+                           'cpc': None if data.group('cpc') == '-' else decimal.Decimal((data.group('cpc'))[1:]),
+                           'cost': None if data.group('cost') == '-' else decimal.Decimal((data.group('cost'))[1:]),
+                           'pos': None if data.group('pos') == '-' else decimal.Decimal(data.group('pos'))}
+
+    next_page = REPORT_NEXT_PAGE.search(page)
+    if next_page:
+        next_page = 'https://adwords.google.com/select/' + next_page.group('url').replace('&amp;', '&')
+
+    return result, next_page
+#-------------------------------------------------------------------------------
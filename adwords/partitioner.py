@@ -0,0 +1,155 @@
+'''
+adwords.partitioner
+
+Splits the keywords of a set into adgroups (set parts). The contiguous
+partitioner fills adgroups in the keywords order, so one keyword inserted
+near the start shifts every later adgroup. The consistent hashing one
+places each keyword by its hash, so adding or removing keywords changes
+only the adgroups holding them and adding an adgroup moves only the
+keywords it takes over:
+
+    KEYWORD_PARTITIONER = 'hash'
+
+Together with the unchanged adgroups skipped by mapper.update_set_adgroups()
+this keeps modify_keywords() submissions close to the size of the change.
+
+@version: 0.1.1
+'''
+
+import bisect
+import hashlib
+
+import mapper
+import settings
+
+#-------------------------------------------------------------------------------
+
+class ContiguousPartitioner:
+    '''
+    Fills adgroups one after another in the keywords order.
+    '''
+
+    def count(self, keywords_count, current_count=0):
+        '''
+        @param keywords_count: int
+        @param current_count: int - adgroups the set has now
+
+        @return: int - adgroups needed
+        '''
+        return mapper.count_parts(xrange(keywords_count))
+
+    def split(self, keywords, current_count=0):
+        '''
+        Returns keywords parts, one per adgroup. The first current_count
+        parts go to the existing adgroups of the set (ordered by id), the
+        rest to new ones. An empty part means its adgroup isn't needed.
+
+        Parts are made lazily, keywords can be any iterable.
+
+        @param keywords: iterable
+        @param current_count: int - adgroups the set has now
+
+        @return: iterable of lists
+        '''
+        return mapper.iter_parts(keywords)
+
+
+class HashPartitioner(ContiguousPartitioner):
+    '''
+    Places keywords on a consistent hashing ring of the adgroups (slots):
+    a keyword goes to the slot owning the ring point following its hash,
+    or to the next slot along the ring with room when that one is full.
+    Adgroups are filled to a fill factor only, so few keywords spill over.
+    The number of adgroups is kept while it stays near the one needed.
+    '''
+
+    def __init__(self, fill=None, replicas=None):
+        '''
+        @param fill: float - share of MAX_KEYWORDS_PER_ADGROUP new adgroups are filled to
+        @param replicas: int - ring points per adgroup
+        '''
+        self.fill = fill or settings.PARTITION_FILL
+        self.replicas = replicas or settings.PARTITION_REPLICAS
+        self._rings = {}
+
+    def count(self, keywords_count, current_count=0):
+        size = settings.MAX_KEYWORDS_PER_ADGROUP
+        needed = max(1, -(-keywords_count // size))
+        target = max(needed, int(-(-keywords_count // (size * self.fill))))
+
+        # changing the count moves keywords, so a count a bit off is kept
+        if needed <= current_count <= 2 * target and current_count <= keywords_count:
+            return current_count
+        return target
+
+    def split(self, keywords, current_count=0):
+        # every keyword has to be hashed before any part is known
+        keywords = list(keywords)
+        if not keywords:
+            return []
+
+        slots_count = self.count(len(keywords), current_count)
+        points, slots = self._get_ring(slots_count)
+        size = settings.MAX_KEYWORDS_PER_ADGROUP
+
+        hashes = [_hash(_key(keyword)) for keyword in keywords]
+        # slot => indexes of keywords, filled in hash order so which ones
+        # spill over doesn't depend on the keywords order
+        parts = [[] for slot in range(slots_count)]
+        for index in sorted(range(len(keywords)), key=hashes.__getitem__):
+            point = bisect.bisect_left(points, hashes[index])
+            for step in range(len(points)):
+                slot = slots[(point + step) % len(points)]
+                if len(parts[slot]) < size:
+                    parts[slot].append(index)
+                    break
+
+        return [[keywords[index] for index in sorted(part)] for part in parts]
+
+    def _get_ring(self, slots_count):
+        ring = self._rings.get(slots_count)
+        if ring is None:
+            pairs = sorted([(_hash('%d:%d' % (slot, replica)), slot)
+                            for slot in range(slots_count) for replica in range(self.replicas)])
+            ring = self._rings[slots_count] = ([point for point, slot in pairs], [slot for point, slot in pairs])
+        return ring
+
+
+def _key(keyword):
+    # duplicates by mapper.normalize_keywords() standards hash the same
+    if isinstance(keyword, mapper.Keyword):
+        keyword = keyword.keyword
+    text, match_mode = mapper.split_match_mode(keyword)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return '%s\x00%s' % (match_mode, text)
+
+
+def _hash(value):
+    return long(hashlib.md5(value).hexdigest()[:16], 16)
+
+#-------------------------------------------------------------------------------
+
+PARTITIONERS = {
+    'contiguous': ContiguousPartitioner,
+    'hash': HashPartitioner,
+}
+
+_partitioners = {}
+
+
+def get_partitioner(name=None):
+    '''
+    @param name: str - one of PARTITIONERS, settings.KEYWORD_PARTITIONER by default
+
+    @return: ContiguousPartitioner or HashPartitioner
+    '''
+    name = name or settings.KEYWORD_PARTITIONER
+    if name not in PARTITIONERS:
+        raise ValueError('Unknown keyword partitioner "%s"' % name)
+
+    partitioner = _partitioners.get(name)
+    if partitioner is None:
+        partitioner = _partitioners[name] = PARTITIONERS[name]()
+    return partitioner
+#-------------------------------------------------------------------------------
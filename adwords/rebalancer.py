@@ -0,0 +1,368 @@
+'''
+adwords.rebalancer
+
+@version: 0.1.1
+'''
+
+import time
+
+from sqlalchemy.sql import func
+
+import mapper
+import logwriter
+import cancellation
+import settings
+
+#-------------------------------------------------------------------------------
+
+class Move:
+    '''
+    Adgroups of a set to be moved from one campaign to another. Leftovers
+    are adgroups whose copies are in the other campaign already (left so by
+    an interrupted move), they are only deleted.
+    '''
+
+    def __init__(self, set, from_campaign_id, to_campaign_id, adgroup_ids, leftover_ids=None):
+        self.set = set
+        self.from_campaign_id = from_campaign_id
+        self.to_campaign_id = to_campaign_id
+        self.adgroup_ids = adgroup_ids
+        self.leftover_ids = leftover_ids or []
+
+    def __repr__(self):
+        if self.leftover_ids:
+            return '<Move of %d adgroups and %d leftovers of set "%s" from campaign %s to %s>' % (
+                len(self.adgroup_ids), len(self.leftover_ids), self.set, self.from_campaign_id, self.to_campaign_id)
+        return '<Move of %d adgroups of set "%s" from campaign %s to %s>' % (
+            len(self.adgroup_ids), self.set, self.from_campaign_id, self.to_campaign_id)
+
+
+class Plan:
+    '''
+    Moves making room for parts_count adgroups in campaign_id. A possible
+    plan without moves means there is room already: in campaign_id, or in
+    a new campaign when it's None.
+    '''
+
+    def __init__(self, parts_count, campaign_id=None, moves=None, possible=True):
+        self.parts_count = parts_count
+        self.campaign_id = campaign_id
+        self.moves = moves or []
+        self.possible = possible
+
+    def __repr__(self):
+        if not self.possible:
+            return '<Plan for %d adgroups, impossible>' % self.parts_count
+        return '<Plan for %d adgroups in campaign %s, %d moves of %d adgroups>' % (
+            self.parts_count, self.campaign_id, len(self.moves), self.adgroups_count())
+
+    def adgroups_count(self):
+        return sum([len(move.adgroup_ids) for move in self.moves])
+
+#-------------------------------------------------------------------------------
+
+def _load(session):
+    # campaign id => {set: [adgroup ids]}
+    campaigns = {}
+    for (campaign_id,) in session.query(mapper.Campaign.id):
+        campaigns[campaign_id] = {}
+
+    rows = session.query(mapper.AdGroup.campaign_id, mapper.AdGroup.set, mapper.AdGroup.id).order_by(mapper.AdGroup.id)
+    for campaign_id, set, adgroup_id in rows:
+        campaigns.setdefault(campaign_id, {}).setdefault(set, []).append(adgroup_id)
+
+    return campaigns
+
+
+def _find_copies(session, parts):
+    '''
+    Returns groups of adgroups of a set holding the same indexed keywords
+    (bids and urls included) as lists of (campaign id, adgroup id), only
+    groups of two or more adgroups having some keywords.
+    '''
+    campaign_ids = {}
+    for campaign_id, ids in parts.items():
+        for adgroup_id in ids:
+            campaign_ids[adgroup_id] = campaign_id
+
+    # adgroup id => [keyword values]
+    keywords = {}
+    rows = session.query(mapper.KeywordEntry.adgroup_id, mapper.KeywordEntry.keyword,
+                         mapper.KeywordEntry.bid, mapper.KeywordEntry.url) \
+        .filter(mapper.KeywordEntry.adgroup_id.in_(campaign_ids.keys()))
+    for adgroup_id, keyword, bid, url in rows:
+        keywords.setdefault(adgroup_id, []).append((keyword, bid, url))
+
+    # sorted keyword values => [(campaign id, adgroup id)]
+    copies = {}
+    for adgroup_id, values in sorted(keywords.items()):
+        values.sort()
+        copies.setdefault(tuple(values), []).append((campaign_ids[adgroup_id], adgroup_id))
+
+    return [group for group in copies.values() if len(group) > 1]
+
+
+def _find_leftovers(copies, target):
+    '''
+    Returns ids of adgroups outside target which are copies of an adgroup
+    kept: the one in target, or the first one when none is there.
+    '''
+    leftovers = []
+    for group in copies:
+        kept = [adgroup_id for campaign_id, adgroup_id in group if campaign_id == target] or [group[0][1]]
+        leftovers += [adgroup_id for campaign_id, adgroup_id in group
+                      if campaign_id != target and adgroup_id not in kept]
+    return leftovers
+
+
+def _gather_split_sets(session, campaigns, free):
+    '''
+    Returns moves gathering sets spread over several campaigns (left so by
+    a move which failed halfway) into one campaign, updating campaigns and
+    free as if they were done. A set goes to the campaign holding most of
+    it if the rest fits there, otherwise to the fullest one taking it all.
+
+    An adgroup the failed move copied but didn't delete is a leftover: it
+    is deleted rather than moved, so the set doesn't hold its keywords
+    twice.
+    '''
+    # set => {campaign id: [adgroup ids]}
+    spread = {}
+    for campaign_id, sets in campaigns.items():
+        for set, ids in sets.items():
+            spread.setdefault(set, {})[campaign_id] = ids
+
+    moves = []
+    for set, parts in sorted(spread.items()):
+        if len(parts) < 2:
+            continue
+
+        copies = _find_copies(session, parts)
+        total = sum([len(ids) for ids in parts.values()])
+        target = None
+        for campaign_id in sorted(parts, key=lambda campaign_id: (-len(parts[campaign_id]), campaign_id)):
+            if free[campaign_id] >= total - len(parts[campaign_id]) - len(_find_leftovers(copies, campaign_id)):
+                target = campaign_id
+                break
+        if target is None:
+            fitting = [(room, campaign_id) for campaign_id, room in free.items()
+                       if campaign_id not in parts and room >= total - len(_find_leftovers(copies, campaign_id))]
+            if not fitting:
+                logwriter.log(logwriter.WARNING, 'rebalancing: no room to gather split set', set=set)
+                continue
+            target = min(fitting)[1]
+
+        leftovers = _find_leftovers(copies, target)
+        gathered = list(parts.get(target, []))
+        for campaign_id, ids in sorted(parts.items()):
+            if campaign_id == target:
+                continue
+            moved = [adgroup_id for adgroup_id in ids if adgroup_id not in leftovers]
+            moves.append(Move(set, campaign_id, target, moved, [adgroup_id for adgroup_id in ids if adgroup_id in leftovers]))
+            gathered += moved
+            del campaigns[campaign_id][set]
+            free[campaign_id] += len(ids)
+            free[target] -= len(moved)
+        campaigns[target][set] = sorted(gathered)
+
+    return moves
+
+
+def _smallest_sums(sizes, need):
+    '''
+    Returns subsets (as index lists) of given sizes adding up to need or
+    more, by the sum ascending - one subset per sum.
+    '''
+    # sum => indexes of a subset having it
+    subsets = {0: []}
+    for index, size in enumerate(sizes):
+        for total, subset in subsets.items():
+            if total + size not in subsets:
+                subsets[total + size] = subset + [index]
+
+    return [subsets[total] for total in sorted(subsets) if total >= need]
+
+
+def _place(sizes, free):
+    '''
+    Places given sizes (largest first) into the fullest campaign still able
+    to take each, as create_set() does. Returns campaign ids in sizes order
+    or None if some doesn't fit.
+    '''
+    free = dict(free)
+    result = [None] * len(sizes)
+
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        fitting = [(room, campaign_id) for campaign_id, room in free.items() if room >= sizes[index]]
+        if not fitting:
+            return None
+        room, campaign_id = min(fitting)
+        free[campaign_id] -= sizes[index]
+        result[index] = campaign_id
+
+    return result
+
+
+@mapper.transactional
+def plan(parts_count=None):
+    '''
+    Computes the moves making room for a set of parts_count adgroups (a
+    whole empty campaign by default) in one campaign, moving as few
+    adgroups as possible. Sets are moved whole, possibly to campaigns of
+    other accounts. Sets left split between campaigns by an interrupted
+    rebalance are gathered into one first, those moves lead the plan.
+
+    @param parts_count: int
+
+    @return: Plan
+    '''
+    return _plan(mapper.get_session(), parts_count)
+
+
+def _plan(session, parts_count):
+    parts_count = parts_count or settings.MAX_ADGROUPS_PER_CAMPAIGN
+    if parts_count > settings.MAX_ADGROUPS_PER_CAMPAIGN:
+        raise OverflowError('Set is too big to fit into a campaign')
+
+    campaigns = _load(session)
+    free = dict([(campaign_id, settings.MAX_ADGROUPS_PER_CAMPAIGN - sum([len(ids) for ids in sets.values()]))
+                 for campaign_id, sets in campaigns.items()])
+    gathering = _gather_split_sets(session, campaigns, free)
+
+    fitting = [(room, campaign_id) for campaign_id, room in free.items() if room >= parts_count]
+    if fitting:
+        return Plan(parts_count, min(fitting)[1], gathering)
+
+    campaigns_counts = session.query(mapper.Account.id, func.count(mapper.Campaign.id)) \
+        .outerjoin(mapper.Campaign) \
+        .group_by(mapper.Account.id).all()
+    if [account_id for account_id, count in campaigns_counts if count < settings.MAX_CAMPAIGNS_PER_ACCOUNT]:
+        return Plan(parts_count, moves=gathering)
+
+    # gathered sets are moved once only, their adgroup ids change on moving
+    gathered = frozenset([move.set for move in gathering])
+    gathered_count = sum([len(move.adgroup_ids) for move in gathering])
+
+    best = None
+    for campaign_id in sorted(campaigns):
+        sets = sorted([(name, ids) for name, ids in campaigns[campaign_id].items() if name not in gathered])
+        sizes = [len(ids) for set, ids in sets]
+        others = dict([(other_id, room) for other_id, room in free.items() if other_id != campaign_id])
+
+        for subset in _smallest_sums(sizes, parts_count - free[campaign_id]):
+            moved = sum([sizes[index] for index in subset])
+            if best is not None and moved >= best.adgroups_count() - gathered_count:
+                break
+
+            targets = _place([sizes[index] for index in subset], others)
+            if targets is not None:
+                best = Plan(parts_count, campaign_id, gathering + [Move(sets[index][0], campaign_id, target, sets[index][1])
+                    for index, target in zip(subset, targets)])
+                break
+
+    return best or Plan(parts_count, moves=gathering, possible=False)
+
+#-------------------------------------------------------------------------------
+
+def _indexed_keywords(session, adgroup_id):
+    entries = session.query(mapper.KeywordEntry) \
+        .filter(mapper.KeywordEntry.adgroup_id == adgroup_id) \
+        .order_by(mapper.KeywordEntry.id).all()
+    return [entry.to_keyword() for entry in entries]
+
+
+@cancellation.unit
+def _move_adgroup(session, processors, adgroup_id, to_campaign):
+    adgroup = session.query(mapper.AdGroup).get(adgroup_id)
+    from_campaign = adgroup.campaign
+    source = _get_processor(processors, from_campaign.account)
+    destination = _get_processor(processors, to_campaign.account)
+
+    # the local index spares a scrape, adgroups indexed before it existed are read
+    keywords = _indexed_keywords(session, adgroup_id) or source.get_keywords(from_campaign.id, adgroup_id)
+
+    # the copy is made first so a failure leaves a duplicate rather than a hole
+    mapper.add_set_part(destination, mapper.get_definition(adgroup), keywords, to_campaign, to_campaign.account)
+
+    _delete_adgroup(session, processors, adgroup_id)
+
+
+@cancellation.unit
+def _delete_adgroup(session, processors, adgroup_id):
+    adgroup = session.query(mapper.AdGroup).get(adgroup_id)
+    campaign = adgroup.campaign
+
+    _get_processor(processors, campaign.account).delete_adgroup(campaign.id, adgroup_id)
+    mapper.UsedNames.remove_entity(mapper.AdGroup.__name__, adgroup_id)
+    mapper.KeywordEntry.unindex_adgroup(adgroup_id)
+    session.delete(adgroup)
+    session.commit()
+
+
+def _get_processor(processors, account):
+    processor = processors.get(account.id)
+    if processor is None:
+        processor = processors[account.id] = mapper.RequestProcessor(account.email, account.password)
+        processor.sign_in()
+    return processor
+
+
+@mapper.transactional
+def rebalance(parts_count=None, budget=None):
+    '''
+    Makes room for a set of parts_count adgroups (a whole empty campaign by
+    default) by moving sets between campaigns, see plan(). Meant to be used
+    instead of clone_account() when create_set() fails with OverflowError
+    while there is enough free room in total.
+
+    With a budget (seconds) no new set is started after it's used up, so
+    a big plan can be carried out in several runs: every run plans again
+    from the current state and continues where the previous one stopped.
+    A set being moved is finished despite the budget, leftovers of an
+    interrupted move are deleted first. Every moved or deleted adgroup is
+    committed right away.
+
+    A cancellation token (see adwords.cancellation) stops it after the
+    adgroup being moved, which may leave a set split between two campaigns
+    - the next run gathers it first. The error status holds the 'plan' and
+    the moves done ('moved') and not done ('remaining'), the first of them
+    possibly started.
+
+    @param parts_count: int
+    @param budget: float - seconds
+
+    @return: dict - 'plan' (Plan), 'moved' and 'remaining' (lists of Move)
+        and 'done' (bool, whether the room is made)
+    '''
+    started = time.time()
+    session = mapper.get_session()
+    compaction = _plan(session, parts_count)
+
+    moved = []
+    processors = {}
+    try:
+        for move in compaction.moves:
+            if budget is not None and time.time() - started >= budget:
+                break
+
+            logwriter.log(logwriter.INFO, 'rebalancing: %r' % move, set=move.set)
+            to_campaign = session.query(mapper.Campaign).get(move.to_campaign_id)
+            for adgroup_id in move.leftover_ids:
+                _delete_adgroup(session, processors, adgroup_id)
+            for adgroup_id in move.adgroup_ids:
+                _move_adgroup(session, processors, adgroup_id, to_campaign)
+            moved.append(move)
+    except cancellation.OperationCancelledError, e:
+        e.status.update(plan=compaction, moved=moved, remaining=compaction.moves[len(moved):])
+        raise
+    finally:
+        for processor in processors.values():
+            processor.sign_out()
+
+    return {
+        'plan': compaction,
+        'moved': moved,
+        'remaining': compaction.moves[len(moved):],
+        'done': compaction.possible and len(moved) == len(compaction.moves),
+    }
+#-------------------------------------------------------------------------------
@@ -5,22 +5,31 @@ adwords.requestprocessor
 @version: 0.1.1
 '''
 
+from __future__ import with_statement
+
 import urllib
 import urllib2
-import cookielib
+import urlparse
 import re
 import time
 import datetime
 import decimal
 import random
+import functools
 
 import settings
+import metrics
+import pacing
+import logwriter
+import pageparser
+import keywordcodec
+import cancellation
+from transport import create_transport
 
 #-------------------------------------------------------------------------------
 
-def log(message):
-    if settings.LOGGER:
-        settings.LOGGER('[' + str(datetime.datetime.now()) + ']: ' + message + '\n')
+def log(message, level=logwriter.INFO, **fields):
+    logwriter.log(level, message, **fields)
 
 #-------------------------------------------------------------------------------
 
@@ -30,8 +39,10 @@ class UnexpectedResponseError(Exception):
     after getting a response from AdWords it wasn't expecting for.
     '''
     def __init__(self, message=''):
-        log('! ERROR - UnexpectedResponseError')
+        log('! ERROR - UnexpectedResponseError', logwriter.ERROR)
         Exception.__init__(self, message)
+        # whether the failure has slowed down the pacing already
+        self.paced = False
 
 class IncorrectStateError(Exception):
     '''
@@ -39,11 +50,91 @@ class IncorrectStateError(Exception):
     that can't be currently performed like trying to sign out before signed in.
     '''
     def __init__(self, message=''):
-        log('! ERROR - IncorrectStateError')
+        log('! ERROR - IncorrectStateError', logwriter.ERROR)
         Exception.__init__(self, message)
 
 #-------------------------------------------------------------------------------
 
+def _operation(method):
+    '''
+    Marks a public RequestProcessor method as an operation: requests sent
+    while it runs are attributed to it and its total duration is recorded.
+    An UnexpectedResponseError it raises slows down its pacing.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        previous_operation = self._current_operation
+        self._current_operation = method.__name__
+        
+        started = time.time()
+        try:
+            try:
+                return method(self, *args, **kwargs)
+            except UnexpectedResponseError, e:
+                # counted once, also when it passes through nested operations
+                if pacing.enabled() and not e.paced:
+                    pacing.get_controller().record_failure(self._current_email, self._current_operation)
+                    e.paced = True
+                raise
+        finally:
+            if metrics.enabled():
+                metrics.observe('adwords_operation_seconds', {
+                    'operation': self._current_operation,
+                    'account': self._current_email,
+                }, time.time() - started)
+            self._current_operation = previous_operation
+    
+    return wrapper
+
+
+class _MeteredResponse:
+    '''
+    Wraps urllib2 response to count bytes actually read from it. The total is
+    recorded once the body is exhausted or the response gets closed.
+    '''
+    
+    def __init__(self, response, labels):
+        self._response = response
+        self._labels = labels
+        self._bytes = 0
+        self._recorded = False
+    
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+    
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            metrics.observe('adwords_request_bytes', self._labels, self._bytes)
+    
+    def read(self, size=-1):
+        data = self._response.read(size)
+        self._bytes += len(data)
+        if size < 0 or not data:
+            self._record()
+        return data
+    
+    def close(self):
+        self._record()
+        self._response.close()
+
+#-------------------------------------------------------------------------------
+
+def to_decimal(value):
+    '''
+    Converts a bid to Decimal. Floats go through repr(), the shortest text
+    reading back as the same float, so 0.1 becomes Decimal('0.1') and not
+    its binary approximation.
+    
+    @param value: Decimal, int, long, float or str
+    
+    @return: Decimal
+    '''
+    if isinstance(value, float):
+        value = repr(value)
+    return decimal.Decimal(value)
+
+
 class Keyword:
     '''
     Can be passed as an element of keywords list to methods of RequestProcessor
@@ -56,7 +147,7 @@ class Keyword:
     
     def __init__(self, keyword, bid=None, url=None):
         self.keyword = keyword
-        self.bid = decimal.Decimal(bid) if bid else None
+        self.bid = to_decimal(bid) if bid else None
         self.url = url
         
     def __str__(self):
@@ -72,6 +163,40 @@ class Keyword:
     
     def __repr__(self):
         return self.__str__()
+    
+    def __eq__(self, other):
+        if not isinstance(other, Keyword):
+            return NotImplemented
+        return (self.keyword, self.bid, self.url) == (other.keyword, other.bid, other.url)
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __hash__(self):
+        return hash((self.keyword, self.bid, self.url))
+
+#-------------------------------------------------------------------------------
+
+class _WizardStep:
+    '''
+    One form of the campaign/adgroup creation wizard: the page AdWords shows
+    it on, the url it's posted to (with %s for the wizard key) and its data.
+    '''
+    
+    def __init__(self, name, page, action, data):
+        '''
+        @param name: str
+        @param page: str - pattern of the url of the page showing the form
+        @param action: str
+        @param data: dict
+        '''
+        self.name = name
+        self.page = re.compile(page)
+        self.action = action
+        self.data = data
 
 #-------------------------------------------------------------------------------
 
@@ -83,6 +208,20 @@ class RequestProcessor:
     
     # identifies the current processor state as being logged in
     _signed_in = False
+    # name of the public method being run, used to label metrics and log records
+    _current_operation = None
+
+
+    def _log(self, message, level=logwriter.INFO, **fields):
+        '''
+        Logs a message adding the current account and operation to its fields.
+        
+        @param message: str
+        @param level: int
+        '''
+        if logwriter.is_enabled_for(level):
+            logwriter.log(level, message, account=self._current_email, 
+                operation=self._current_operation, **fields)
 
 
     def _fetchurl(self, request):
@@ -92,12 +231,59 @@ class RequestProcessor:
         @param request: urllib2.Request
         @return: urllib2.Response
         '''
-        response = self._urlopener.open(request)
+        token = self._get_cancel_token()
+        if token is not None:
+            token.check()
+        
+        if not metrics.enabled() and not pacing.enabled():
+            response = self._transport.open(request)
+            if request.get_full_url() != response.geturl():
+                if settings.DEBUG_LEVEL > 0:
+                    self._log('   -> ' + response.geturl())
+            
+            return response
+        
+        labels = {
+            'operation': self._current_operation,
+            'account': self._current_email,
+            'url': urlparse.urlparse(request.get_full_url())[2],
+        }
+        started = time.time()
+        try:
+            response = self._transport.open(request)
+        except urllib2.HTTPError, e:
+            if pacing.enabled():
+                pacing.get_controller().record_failure(self._current_email, self._current_operation)
+            if metrics.enabled():
+                metrics.increment('adwords_requests_total', dict(labels, status=e.code))
+            raise
+        except urllib2.URLError:
+            if pacing.enabled():
+                pacing.get_controller().record_failure(self._current_email, self._current_operation)
+            if metrics.enabled():
+                metrics.increment('adwords_requests_total', dict(labels, status='error'))
+            raise
+        
+        elapsed = time.time() - started
+        # urllib2 redirect handler keeps visited urls on the original request
+        redirects = sum(getattr(request, 'redirect_dict', {}).values())
+        
         if request.get_full_url() != response.geturl():
             if settings.DEBUG_LEVEL > 0:
-                log('   -> ' + response.geturl())
+                self._log('   -> ' + response.geturl())
         
-        return response
+        if pacing.enabled():
+            pacing.get_controller().record_success(self._current_email, self._current_operation, elapsed)
+        if not metrics.enabled():
+            return response
+        
+        histogram_labels = {'operation': labels['operation'], 'account': labels['account']}
+        metrics.observe('adwords_request_seconds', histogram_labels, elapsed)
+        metrics.increment('adwords_requests_total', dict(labels, status=getattr(response, 'code', None)))
+        if redirects:
+            metrics.increment('adwords_redirects_total', labels, redirects)
+        
+        return _MeteredResponse(response, histogram_labels)
 
     
     def _unescape_js(self, unescaped):
@@ -123,7 +309,7 @@ class RequestProcessor:
         @param url: string
         @return: urllib2.Request
         '''
-        request = urllib2.Request(url)
+        request = self._transport.create_request(url)
         request.add_header('User-Agent', 
             settings.USER_AGENTS[hash(self._current_email) % len(settings.USER_AGENTS)])
         request.add_header('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8')
@@ -131,7 +317,7 @@ class RequestProcessor:
         request.add_header('Accept-Charset', 'ISO-8859-1,utf-8;q=0.7,*;q=0.7')
         
         if settings.DEBUG_LEVEL > 0:
-            log(url)
+            self._log(url)
         
         return request
         
@@ -139,25 +325,205 @@ class RequestProcessor:
     def _do_fake_delay(self):
         '''
         Waits random amount of time to emulate a real user/browser behavior.
+        With settings.ADAPTIVE_PACING on the delay is chosen by the pacing
+        controller of the account and operation, see adwords.pacing.
+        
+        The delay counts from the request of the account reserved last (see
+        PacingController.reserve()), so forks reading at the same time keep
+        to the pace of a single processor.
         '''
-        time.sleep(random.uniform(settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX))
+        if pacing.enabled():
+            controller = pacing.get_controller()
+            delay = controller.get_delay(self._current_email, self._current_operation)
+            delay = random.uniform(delay, delay * settings.PACING_JITTER)
+            delay = min(controller.max_delay, max(controller.min_delay, delay))
+        else:
+            delay = random.uniform(settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX)
+        
+        wait = pacing.get_controller().reserve(self._current_email, delay)
+        self._sleep(wait)
+        
+        if metrics.enabled():
+            metrics.observe('adwords_delay_seconds', {
+                'operation': self._current_operation,
+                'account': self._current_email,
+            }, wait)
+    
+    
+    def _sleep(self, seconds):
+        '''
+        Sleeps, stopped by the cancellation token as soon as it fires.
         
+        @param seconds: float
+        '''
+        token = self._get_cancel_token()
+        if token is not None:
+            token.sleep(seconds)
+        else:
+            time.sleep(seconds)
+    
+    
+    def _get_cancel_token(self):
+        '''
+        Returns the token given to the constructor or the one activated in
+        the current thread, see adwords.cancellation.
         
-    def __init__(self, email, password):
+        @return: cancellation.CancellationToken
         '''
+        return self._cancel_token or cancellation.get_current()
+    
+    
+    def _start_wizard(self, url, key_pattern):
+        '''
+        Opens the first page of a wizard and returns its wizard key, None if
+        AdWords didn't start the wizard.
+        
+        @param url: str
+        @param key_pattern: str - with a wizard_key group, matched against the url of the landing page
+        @return: str
+        '''
+        request = self._create_browserlike_request(url)
+        try:
+            response = self._fetchurl(request)
+        except urllib2.URLError:
+            return None
+        self._do_fake_delay()
+        
+        match = re.search(key_pattern, response.geturl())
+        return match and match.group('wizard_key')
+    
+    
+    def _run_wizard(self, url, key_pattern, steps, finish):
+        '''
+        Starts a wizard and posts given steps one after another, each one
+        has to land on the page of the next one. The response of the last
+        step is passed to finish() which returns the result or raises
+        UnexpectedResponseError.
+        
+        A step landing elsewhere is retried with a growing backoff (up to
+        settings.WIZARD_STEP_RETRIES times in a row) while the wizard key is
+        still valid - the landing url carries it or the request failed before
+        getting any response. If it shows the page of an earlier step, the
+        wizard is resumed from there. Only when the key is lost or a step
+        keeps failing the whole wizard is started over, up to
+        settings.WIZARD_RESTARTS times.
+        
+        The last step is never repeated: it saves, and a repeated save could
+        leave a duplicate behind.
+        
+        @param url: str - first page of the wizard
+        @param key_pattern: str - see _start_wizard()
+        @param steps: list - _WizardStep instances
+        @param finish: callable
+        @return: object
+        '''
+        restarts = 0
+        
+        while True:
+            started = time.time()
+            error = None
+            paced = False
+            wizard_key = self._start_wizard(url, key_pattern)
+            
+            position = 0
+            retries = 0
+            while wizard_key is not None:
+                step = steps[position]
+                step_started = time.time()
+                
+                request = self._create_browserlike_request(step.action % wizard_key)
+                request.add_data(urllib.urlencode(step.data))
+                if position == len(steps) - 1:
+                    return finish(self._fetchurl(request))
+                
+                try:
+                    landed = self._fetchurl(request).geturl()
+                except urllib2.URLError, e:
+                    error, landed = e, None
+                
+                if landed is not None and steps[position + 1].page.search(landed):
+                    position += 1
+                    retries = 0
+                    continue
+                
+                if landed is not None and pacing.enabled():
+                    pacing.get_controller().record_failure(self._current_email, self._current_operation)
+                    paced = True
+                
+                if retries >= settings.WIZARD_STEP_RETRIES or (landed is not None and wizard_key not in landed):
+                    break
+                
+                retries += 1
+                for index, shown in enumerate(steps[:position]):
+                    if landed is not None and shown.page.search(landed):
+                        position = index
+                        break
+                
+                self._log('! wizard step "%s" failed, retry %d from "%s"' % (step.name, retries, steps[position].name), 
+                          logwriter.WARNING)
+                self._sleep(settings.WIZARD_RETRY_BACKOFF * 2 ** (retries - 1))
+                self._record_wizard_waste('adwords_wizard_retries_total', time.time() - step_started, step=step.name)
+            
+            restarts += 1
+            self._log('! wizard restarted (%d)' % restarts, logwriter.WARNING)
+            self._record_wizard_waste('adwords_wizard_restarts_total', time.time() - started)
+            
+            if restarts > settings.WIZARD_RESTARTS:
+                if error is None:
+                    error = UnexpectedResponseError()
+                    # the failed step ending the last attempt has been counted
+                    error.paced = paced
+                raise error
+    
+    
+    def _record_wizard_waste(self, counter, seconds, **labels):
+        if metrics.enabled():
+            labels.update({'operation': self._current_operation, 'account': self._current_email})
+            metrics.increment(counter, labels)
+            metrics.observe('adwords_wizard_wasted_seconds', {
+                'operation': self._current_operation,
+                'account': self._current_email,
+            }, seconds)
+        
+        
+    def __init__(self, email, password, cancel_token=None, transport=None):
+        '''
+        A cancellation token makes requests and delays of the processor
+        raise cancellation.OperationCancelledError once it fires. Requests
+        are sent by a given transport or one made by
+        adwords.transport.create_transport().
+        
         @param email: str
         @param password: str
+        @param cancel_token: cancellation.CancellationToken
+        @param transport: transport.UrllibTransport or alike
         '''
         self._current_email = email
         self._current_password = password
+        self._cancel_token = cancel_token
         
-        self._cookiejar = cookielib.CookieJar()
-        self._cookieprocessor = urllib2.HTTPCookieProcessor(self._cookiejar)
-        self._urlopener = urllib2.build_opener(self._cookieprocessor)
+        self._transport = transport or create_transport()
         
         random.seed()
     
     
+    def fork(self):
+        '''
+        Returns a processor of the same account sharing the session (cookies)
+        of this one, so reads can be sent concurrently from other threads.
+        A fork is signed in while this processor is and shouldn't be signed
+        out itself. It takes turns with this processor in the delays of the
+        account, see _do_fake_delay().
+        
+        @return: RequestProcessor
+        '''
+        fork = RequestProcessor(self._current_email, self._current_password,
+                                self._get_cancel_token(), self._transport.fork())
+        fork._signed_in = self._signed_in
+        return fork
+    
+    
+    @_operation
     def sign_in(self):
         '''
         Renders the current instance as logged into Google AdWords account
@@ -166,7 +532,7 @@ class RequestProcessor:
         @param email: string
         @param password: string  
         '''
-        log(' + sign_in')
+        self._log(' + sign_in')
         
         request = self._create_browserlike_request('http://adwords.google.com/')
         self._fetchurl(request)
@@ -200,18 +566,21 @@ class RequestProcessor:
         self._signed_in = True
     
     
+    @_operation
     def sign_out(self):
         '''
         Signs the current instance out.
         '''
-        log(' +++ sign_out')
+        self._log(' +++ sign_out')
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
         
-        request = self._create_browserlike_request('https://adwords.google.com/select/gaialogout')
-        self._fetchurl(request)
-        self._do_fake_delay()
+        # signing out is finished even after a cancellation
+        with cancellation.shielded(check_first=False):
+            request = self._create_browserlike_request('https://adwords.google.com/select/gaialogout')
+            self._fetchurl(request)
+            self._do_fake_delay()
         self._signed_in = False
     
     
@@ -224,6 +593,7 @@ class RequestProcessor:
         return self._signed_in
     
     
+    @_operation
     def add_campaign(self, campaign_name, adgroup_name, display_url, url, headline, adline1, adline2, keywords, bid):
         '''
         Adds a campaign with a given AdGroup (as the first AdGroup in campaign)
@@ -240,7 +610,7 @@ class RequestProcessor:
         @param bid: decimal.Decimal
         @return: long,long
         '''
-        log(' +++ add_campaign "%s" (first adgroup - "%s")' % (campaign_name, adgroup_name))
+        self._log(' +++ add_campaign "%s" (first adgroup - "%s")' % (campaign_name, adgroup_name))
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
@@ -249,98 +619,66 @@ class RequestProcessor:
         self._fetchurl(request)
         self._do_fake_delay()
         
-        # Step 0
-        request = self._create_browserlike_request('https://adwords.google.com/select/StartNewCampaign')
-        response = self._fetchurl(request)
-        self._do_fake_delay()
-        
-        try:
-            wizard_key = re.search('TargetingWizardWithGeoPicker.+wizardKey=(?P<wizard_key>\w+)', response.geturl()).group('wizard_key')
-        except:
-            raise UnexpectedResponseError()
-        
-        # Step 1
-        request = self._create_browserlike_request('https://adwords.google.com/select/TargetingWizardWithGeoPickerInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'campaignBox': 'noneSelected',
-            'campaignName': campaign_name,
-            'adGroupName': adgroup_name,
-            'language': 'en',
-            'targetedLocationsSerialized': settings.DEFAULT_TARGETED_LOCATION_STRING,
-            'excludedLocationsSerialized': '',
-            'emptyAudienceMeansTargetsAllCountries': 'false',
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-        
-        if re.search('FirstAdTypeFinder', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 2
-        request = self._create_browserlike_request('https://adwords.google.com/select/StartCKSRequest?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'thisAction': '//CreateAd',
-            'creativeScope': 'textController.textCreative',
-            'controllerScope': 'textController',
-            'textController.textCreative.headline': headline,
-            'textController.textCreative.description1': adline1,
-            'textController.textCreative.description2': adline2,
-            'textController.textCreative.visibleUrl': display_url,
-            'textController.protocol': 'https://' if url.startswith('https://') else 'http://',
-            'textController.destUrl': url if url.find('://') == -1 else url[url.find('://') + 3:],
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-        
-        if re.search('ChooseKeywords', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 3
-        request = self._create_browserlike_request('https://adwords.google.com/select/ChooseKeywordsInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'thisAction': '//ChooseKeywords',
-            'akssSuggestedKeywords': '',
-            'cksSuggestedKeywords': '',
-            'helperSuggestedKeywords': '',
-            'keywords': '\x0D\x0A'.join(keywords),
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-        
-        if re.search('SetPricing', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 4
-        request = self._create_browserlike_request('https://adwords.google.com/select/SetPricingInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({                                          
-            'thisAction': '//SetPricing',
-            'initialCurrencyCode': 'USD',
-            'usersBudgetUnits': '%.2f' % settings.CAMPAIGN_BUDGET,
-            'usersBudgetPeriod': 'DAILY',
-            'usersMaxCpcUnits': '%.2f' % bid,
-            'usersMaxContentCpcUnits': '',
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-        
-        if re.search('ReviewAccount', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 5
-        request = self._create_browserlike_request('https://adwords.google.com/select/ReviewAccountInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({                                          
-            'saveCampaignButton': 'Save Campaign',
-        }))
-        response = self._fetchurl(request)
-        
-        try:
-            campaign_id = re.search('CampaignManagement.+campaignid=(?P<campaign_id>\d+)', response.geturl()).group('campaign_id')
-            campaign_id = long(campaign_id)
-            
-            adgroup_id = re.search('adgroupid=(?P<adgroup_id>\d+)', response.read()).group('adgroup_id')
-            adgroup_id = long(adgroup_id)
-        except:
-            raise UnexpectedResponseError()
+        steps = [
+            _WizardStep('targeting', 'TargetingWizardWithGeoPicker', 
+                'https://adwords.google.com/select/TargetingWizardWithGeoPickerInput?wizardKey=%s', {
+                'campaignBox': 'noneSelected',
+                'campaignName': campaign_name,
+                'adGroupName': adgroup_name,
+                'language': 'en',
+                'targetedLocationsSerialized': settings.DEFAULT_TARGETED_LOCATION_STRING,
+                'excludedLocationsSerialized': '',
+                'emptyAudienceMeansTargetsAllCountries': 'false',
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('ad', 'FirstAdTypeFinder', 
+                'https://adwords.google.com/select/StartCKSRequest?wizardKey=%s', {
+                'thisAction': '//CreateAd',
+                'creativeScope': 'textController.textCreative',
+                'controllerScope': 'textController',
+                'textController.textCreative.headline': headline,
+                'textController.textCreative.description1': adline1,
+                'textController.textCreative.description2': adline2,
+                'textController.textCreative.visibleUrl': display_url,
+                'textController.protocol': 'https://' if url.startswith('https://') else 'http://',
+                'textController.destUrl': url if url.find('://') == -1 else url[url.find('://') + 3:],
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('keywords', 'ChooseKeywords', 
+                'https://adwords.google.com/select/ChooseKeywordsInput?wizardKey=%s', {
+                'thisAction': '//ChooseKeywords',
+                'akssSuggestedKeywords': '',
+                'cksSuggestedKeywords': '',
+                'helperSuggestedKeywords': '',
+                'keywords': '\x0D\x0A'.join(keywords),
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('pricing', 'SetPricing', 
+                'https://adwords.google.com/select/SetPricingInput?wizardKey=%s', {
+                'thisAction': '//SetPricing',
+                'initialCurrencyCode': 'USD',
+                'usersBudgetUnits': '%.2f' % settings.CAMPAIGN_BUDGET,
+                'usersBudgetPeriod': 'DAILY',
+                'usersMaxCpcUnits': '%.2f' % bid,
+                'usersMaxContentCpcUnits': '',
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('review', 'ReviewAccount', 
+                'https://adwords.google.com/select/ReviewAccountInput?wizardKey=%s', {
+                'saveCampaignButton': 'Save Campaign',
+            }),
+        ]
+        
+        def finish(response):
+            try:
+                campaign_id = re.search('CampaignManagement.+campaignid=(?P<campaign_id>\d+)', response.geturl()).group('campaign_id')
+                adgroup_id = pageparser.extract(response, [pageparser.ADGROUP_ID])['adgroup_id']
+                return long(campaign_id), long(adgroup_id)
+            except:
+                raise UnexpectedResponseError()
+        
+        campaign_id, adgroup_id = self._run_wizard('https://adwords.google.com/select/StartNewCampaign', 
+            'TargetingWizardWithGeoPicker.+wizardKey=(?P<wizard_key>\w+)', steps, finish)
         
         request = self._create_browserlike_request('https://adwords.google.com/select/CampaignSummary')
         self._fetchurl(request)
@@ -349,6 +687,7 @@ class RequestProcessor:
         return campaign_id, adgroup_id
     
     
+    @_operation
     def add_adgroup(self, campaign_id, adgroup_name, display_url, url, headline, adline1, adline2, keywords, bid):
         '''
         Adds an AdGroup to a given campaign and returns its AdGroup ID
@@ -364,7 +703,7 @@ class RequestProcessor:
         @param bid: decimal.Decimal
         @return: long
         '''
-        log(' +++ add_adgroup "%s"' % adgroup_name)
+        self._log(' +++ add_adgroup "%s"' % adgroup_name, campaign_id=campaign_id)
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
@@ -377,87 +716,57 @@ class RequestProcessor:
         self._fetchurl(request)
         self._do_fake_delay()
         
-        # Step 0
-        request = self._create_browserlike_request('https://adwords.google.com/select/StartNewAdGroup?campaignId=%d' % campaign_id)
-        response = self._fetchurl(request)
-        self._do_fake_delay()
-
-        try:
-            wizard_key = re.search('TargetingWizard.+wizardKey=(?P<wizard_key>\w+)', response.geturl()).group('wizard_key')
-        except:
-            raise UnexpectedResponseError()
-        
-        # Step 1
-        request = self._create_browserlike_request('https://adwords.google.com/select/TargetingWizardInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'thisAction': '//TargetingWizard',
-            'adGroupName': adgroup_name,
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-
-        if re.search('FirstAdTypeFinder', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 2
-        request = self._create_browserlike_request('https://adwords.google.com/select/StartCKSRequest?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'thisAction': '//CreateAd',
-            'creativeScope': 'textController.textCreative',
-            'controllerScope': 'textController',
-            'textController.textCreative.headline': headline,
-            'textController.textCreative.description1': adline1,
-            'textController.textCreative.description2': adline2,
-            'textController.textCreative.visibleUrl': display_url,
-            'textController.protocol': 'https://' if url.startswith('https://') else 'http://',
-            'textController.destUrl': url if url.find('://') == -1 else url[url.find('://') + 3:],
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-
-        if re.search('ChooseKeywords', response.geturl()) == None:
-            raise UnexpectedResponseError()
-            
-        # Step 3
-        request = self._create_browserlike_request('https://adwords.google.com/select/ChooseKeywordsInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({
-            'thisAction': '//ChooseKeywords',
-            'akssSuggestedKeywords': '',
-            'cksSuggestedKeywords': '',
-            'helperSuggestedKeywords': '',
-            'keywords': '\x0D\x0A'.join(keywords),
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-
-        if re.search('SetPricing', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 4
-        request = self._create_browserlike_request('https://adwords.google.com/select/SetPricingInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({                                    
-            'initialCurrencyCode': 'USD',
-            'usersMaxCpcUnits': '%.2f' % bid,
-            'usersMaxContentCpcUnits': '',
-            'continueButton': 'Continue \xC2\xBB',
-        }))
-        response = self._fetchurl(request)
-
-        if re.search('ReviewAccount', response.geturl()) == None:
-            raise UnexpectedResponseError()
-        
-        # Step 5
-        request = self._create_browserlike_request('https://adwords.google.com/select/ReviewAccountInput?wizardKey=%s' % wizard_key)
-        request.add_data(urllib.urlencode({                                          
-            'saveAdgroupButton': 'Save Ad Group',
-        }))
-        response = self._fetchurl(request)
-
-        try:
-            adgroup_id = re.search('CampaignManagement.+adgroupid=(?P<adgroup_id>\d+)', response.geturl()).group('adgroup_id')
-            adgroup_id = long(adgroup_id)
-        except:
-            raise UnexpectedResponseError()
+        steps = [
+            _WizardStep('targeting', 'TargetingWizard', 
+                'https://adwords.google.com/select/TargetingWizardInput?wizardKey=%s', {
+                'thisAction': '//TargetingWizard',
+                'adGroupName': adgroup_name,
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('ad', 'FirstAdTypeFinder', 
+                'https://adwords.google.com/select/StartCKSRequest?wizardKey=%s', {
+                'thisAction': '//CreateAd',
+                'creativeScope': 'textController.textCreative',
+                'controllerScope': 'textController',
+                'textController.textCreative.headline': headline,
+                'textController.textCreative.description1': adline1,
+                'textController.textCreative.description2': adline2,
+                'textController.textCreative.visibleUrl': display_url,
+                'textController.protocol': 'https://' if url.startswith('https://') else 'http://',
+                'textController.destUrl': url if url.find('://') == -1 else url[url.find('://') + 3:],
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('keywords', 'ChooseKeywords', 
+                'https://adwords.google.com/select/ChooseKeywordsInput?wizardKey=%s', {
+                'thisAction': '//ChooseKeywords',
+                'akssSuggestedKeywords': '',
+                'cksSuggestedKeywords': '',
+                'helperSuggestedKeywords': '',
+                'keywords': '\x0D\x0A'.join(keywords),
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('pricing', 'SetPricing', 
+                'https://adwords.google.com/select/SetPricingInput?wizardKey=%s', {
+                'initialCurrencyCode': 'USD',
+                'usersMaxCpcUnits': '%.2f' % bid,
+                'usersMaxContentCpcUnits': '',
+                'continueButton': 'Continue \xC2\xBB',
+            }),
+            _WizardStep('review', 'ReviewAccount', 
+                'https://adwords.google.com/select/ReviewAccountInput?wizardKey=%s', {
+                'saveAdgroupButton': 'Save Ad Group',
+            }),
+        ]
+        
+        def finish(response):
+            try:
+                adgroup_id = re.search('CampaignManagement.+adgroupid=(?P<adgroup_id>\d+)', response.geturl()).group('adgroup_id')
+                return long(adgroup_id)
+            except:
+                raise UnexpectedResponseError()
+        
+        adgroup_id = self._run_wizard('https://adwords.google.com/select/StartNewAdGroup?campaignId=%d' % campaign_id, 
+            'TargetingWizard.+wizardKey=(?P<wizard_key>\w+)', steps, finish)
         
         request = self._create_browserlike_request('https://adwords.google.com/select/CampaignSummary')
         self._fetchurl(request)
@@ -466,6 +775,7 @@ class RequestProcessor:
         return adgroup_id
     
     
+    @_operation
     def delete_adgroup(self, campaign_id, adgroup_id):
         '''
         Deletes adgroup
@@ -473,7 +783,7 @@ class RequestProcessor:
         @param campaign_id: long
         @param adgroup_id: long
         '''
-        log(' +++ delete_adgroup')
+        self._log(' +++ delete_adgroup', campaign_id=campaign_id, adgroup_id=adgroup_id)
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
@@ -494,6 +804,7 @@ class RequestProcessor:
         self._do_fake_delay()
 
     
+    @_operation
     def get_keywords(self, campaign_id, adgroup_id):
         '''
         Returns current keywords for given domain
@@ -502,7 +813,7 @@ class RequestProcessor:
         @param adgroup_id: long
         @return: list
         '''
-        log(' +++ get_keywords')
+        self._log(' +++ get_keywords', campaign_id=campaign_id, adgroup_id=adgroup_id)
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
@@ -516,21 +827,11 @@ class RequestProcessor:
         self._do_fake_delay()
         
         try:
-            keywords = re.search('<textarea [^>]*name="keywords"[^>]*>(?P<keywords>[^<]*)</textarea>', response.read())
-            keywords = keywords.group('keywords')
-        except:
+            keywords = pageparser.extract(response, [pageparser.KEYWORDS_TEXTAREA])['keywords']
+        except KeyError:
             raise UnexpectedResponseError()
  
-        result = []
-        for keyword_string in keywords.split('\n'):
-            splitted = keyword_string.split(' ** ')
-            keyword = Keyword(splitted[0])
-            if len(splitted) > 1:
-                try: keyword.bid = float(splitted[1])
-                except ValueError: keyword.url = splitted[1]
-            if len(splitted) > 2:
-                keyword.url = splitted[2]
-            result.append(keyword)
+        result = keywordcodec.decode(keywords)
             
         request = self._create_browserlike_request('https://adwords.google.com/select/CampaignSummary')
         self._fetchurl(request)
@@ -539,16 +840,16 @@ class RequestProcessor:
         return result
 
     
-    def set_default_bid(self, campaign_id, adgroup_id, bid):
+    def _edit_keywords(self, campaign_id, adgroup_id, keywords=None, bid=None):
         '''
-        Changes the default bid for given AdGroup
+        Submits the EditKeywords form of given AdGroup once. Keywords and/or
+        default bid left None are resubmitted as they currently are.
         
         @param campaign_id: long
         @param adgroup_id: long
+        @param keywords: list
         @param bid: decimal.Decimal
         '''
-        log(' +++ set_default_bid')
-        
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
         
@@ -560,19 +861,36 @@ class RequestProcessor:
         response = self._fetchurl(request)
         self._do_fake_delay()
         
-        try:
-            keywords = re.search('<textarea [^>]*name="keywords"[^>]*>(?P<keywords>[^<]*)</textarea>', response.read())
-            keywords = keywords.group('keywords')
-        except:
-            raise UnexpectedResponseError()
+        targets = []
+        if keywords is None:
+            targets.append(pageparser.KEYWORDS_TEXTAREA)
+        if bid is None:
+            targets.append(pageparser.PRICE_INPUT)
+        
+        if targets:
+            found = pageparser.extract(response, targets)
+            if len(found) < len(targets):
+                raise UnexpectedResponseError()
+        else:
+            response.close()
+        
+        if keywords is None:
+            keywords_string = found['keywords']
+        else:
+            keywords_string = keywordcodec.encode(keywords)
+        
+        if bid is None:
+            price = found['price']
+        else:
+            price = '%.2f' % bid
         
         request = self._create_browserlike_request('https://adwords.google.com/select/EditKeywords')
         request.add_data(urllib.urlencode({    
             'campaignId': campaign_id,
             'adgroupid': adgroup_id,
-            'price': '%.2f' % bid,
+            'price': price,
             'priceContent': 'Auto',
-            'keywords': keywords,
+            'keywords': keywords_string,
             'save': 'Save+Changes',
         }))
         response = self._fetchurl(request)
@@ -584,7 +902,21 @@ class RequestProcessor:
         self._fetchurl(request)
         self._do_fake_delay()
     
+    
+    @_operation
+    def set_default_bid(self, campaign_id, adgroup_id, bid):
+        '''
+        Changes the default bid for given AdGroup
+        
+        @param campaign_id: long
+        @param adgroup_id: long
+        @param bid: decimal.Decimal
+        '''
+        self._log(' +++ set_default_bid', campaign_id=campaign_id, adgroup_id=adgroup_id)
+        self._edit_keywords(campaign_id, adgroup_id, bid=bid)
+    
 
+    @_operation
     def set_keywords(self, campaign_id, adgroup_id, keywords):
         '''
         Sets (replaces) keywords for given AdGroup
@@ -593,48 +925,26 @@ class RequestProcessor:
         @param adgroup_id: long
         @param keywords: list
         '''
-        log(' +++ set_keywords')
-        
-        if not self._signed_in:
-            raise IncorrectStateError('You have to be signed in to perform this action.')
-        
-        request = self._create_browserlike_request('https://adwords.google.com/select/CampaignManagement?adgroupid=%d&campaignId=%d' % (adgroup_id, campaign_id))
-        self._fetchurl(request)
-        self._do_fake_delay()
-        
-        request = self._create_browserlike_request('https://adwords.google.com/select/EditKeywords?adgroupid=%d&campaignId=%d#a' % (adgroup_id, campaign_id))
-        response = self._fetchurl(request)
-        self._do_fake_delay()
-        
-        try:
-            price = re.search('<input [^>]*name="price"[^>]*value="(?P<price>[^"]+)"', response.read())
-            price = price.group('price')
-        except:
-            raise UnexpectedResponseError()
-        
-        keywords_processed = []
-        for keyword in keywords:
-            keywords_processed.append(str(keyword))
-        
-        request = self._create_browserlike_request('https://adwords.google.com/select/EditKeywords')
-        request.add_data(urllib.urlencode({    
-            'campaignId': campaign_id,
-            'adgroupid': adgroup_id,
-            'price': price,
-            'priceContent': 'Auto',
-            'keywords': '\x0D\x0A'.join(keywords_processed),
-            'save': 'Save+Changes',
-        }))
-        response = self._fetchurl(request)
-        
-        if re.search('CampaignManagement', response.geturl()) == None:
-            raise UnexpectedResponseError()
+        self._log(' +++ set_keywords', campaign_id=campaign_id, adgroup_id=adgroup_id)
+        self._edit_keywords(campaign_id, adgroup_id, keywords=keywords)
+    
+    
+    @_operation
+    def edit_keywords(self, campaign_id, adgroup_id, keywords=None, bid=None):
+        '''
+        Sets (replaces) keywords and changes the default bid for given AdGroup
+        with a single form submission. Either can be None to keep it as is.
         
-        request = self._create_browserlike_request('https://adwords.google.com/select/CampaignSummary')
-        self._fetchurl(request)
-        self._do_fake_delay()
+        @param campaign_id: long
+        @param adgroup_id: long
+        @param keywords: list
+        @param bid: decimal.Decimal
+        '''
+        self._log(' +++ edit_keywords', campaign_id=campaign_id, adgroup_id=adgroup_id)
+        self._edit_keywords(campaign_id, adgroup_id, keywords, bid)
         
         
+    @_operation
     def get_keywords_report(self, campaign_id, adgroup_id, days=7):
         '''
         Generates a keywords performance report - dict with keys-keywords and
@@ -647,7 +957,7 @@ class RequestProcessor:
         
         @return: dict    
         '''
-        log(' +++ get_keywords_report')
+        self._log(' +++ get_keywords_report', campaign_id=campaign_id, adgroup_id=adgroup_id)
         
         if not self._signed_in:
             raise IncorrectStateError('You have to be signed in to perform this action.')
@@ -690,36 +1000,10 @@ class RequestProcessor:
         result = {}
         
         while True:
-            for row_match in re.finditer(r'<tr[^>]*?id="tr_\d+"[^>]*?>(?P<data_row>.*?)</tr>', response, re.DOTALL):
-                data_row = row_match.group('data_row')
-                keyword = re.search('</div>\n</span>\n(?P<keyword>[\w\s\d]+?)</td>\n', data_row).group('keyword')
-                bid = re.search('<td nowrap align="center" colspan="2">(?P<bid>[$\d\.-]+?)</td>\n', data_row).group('bid')
-                
-                data = re.search('<td class="" align="right">(?P<clicks>[\d-]+?)\n' +
-                                 '.*?</td>\n+?' +
-                                 '<td class="" align="right">(?P<impr>[\d-]+?)\n' +
-                                 '.*?</td>\n+?' +
-                                 '<td class="" align="right">(?P<ctr>[\d\.-]+?)\n' +
-                                 '.*?</td>\n+?' +
-                                 '<td class="" align="right">(?P<cpc>[$\d\.-]+?)\n' +
-                                 '.*?</td>\n+?' +
-                                 '<td class="" align="right">(?P<cost>[$\d\.-]+?)\n' +
-                                 '.*?</td>\n+?' +
-                                 '<td class="rightcolumn" align="right">(?P<pos>[\d\.-]+?)\n' +
-                                 '.*?</td>\n+?', data_row)
-                
-                result[keyword] = {'bid': bid,
-                                   'clicks': int(data.group('clicks')),
-                                   'impr': int(data.group('impr')),
-                                   'ctr': None if data.group('ctr') == '-' else decimal.Decimal(data.group('ctr')),
-                                   'cpc': None if data.group('cpc') == '-' else decimal.Decimal((data.group('cpc'))[1:]),
-                                   'cost': None if data.group('cost') == '-' else decimal.Decimal((data.group('cost'))[1:]),
-                                   'pos': None if data.group('pos') == '-' else decimal.Decimal(data.group('pos'))}
-                              
-            next_page = re.search('<a href="(?P<url>[^"]+?)"><b>Next', response)
+            rows, next_page = pageparser.parse_report_page(response)
+            result.update(rows)
+            
             if next_page:
-                next_page = next_page.group('url').replace('&amp;', '&')
-                next_page = 'https://adwords.google.com/select/' + next_page
                 request = self._create_browserlike_request(next_page)
                 response = self._fetchurl(request).read()
                 self._do_fake_delay()
@@ -11,7 +11,25 @@ USER_AGENTS = [
 
 # Database
 DB_CONNECTION = 'mysql://root:@localhost:3306/adwords'
+# Single-node workers may use an embedded database instead:
+# DB_CONNECTION = 'sqlite:///./adwords.db'
 DEBUG_DB = False
+# Connections kept open in the pool and allowed on top of it under load
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+# Seconds after which a pooled connection is reopened (MySQL drops idle ones)
+DB_POOL_RECYCLE = 3600
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = 30
+# Applied in order to every new sqlite connection
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', '-16000'),
+    ('temp_store', 'MEMORY'),
+)
+# Seconds a sqlite connection waits for another one to release a write lock
+SQLITE_BUSY_TIMEOUT = 60
 
 # USD
 CAMPAIGN_BUDGET = Decimal('1000.00')
@@ -20,11 +38,92 @@ CAMPAIGN_BUDGET = Decimal('1000.00')
 FAKE_DELAY_MIN = 2.0
 FAKE_DELAY_MAX = 4.0
 
-# Set False to turn logging off
-LOGGER = file('./log.txt', 'a').write
+# Set True to have delays adapt to how AdWords responds, see adwords.pacing.
+# A delay is shortened by PACING_STEP seconds after a quick response, lengthened
+# by PACING_STEP after a slow one (PACING_SLOW_RESPONSE times the best average
+# latency seen) and multiplied by PACING_BACKOFF on a failure, always staying
+# within PACING_MIN_DELAY..PACING_MAX_DELAY. The actual wait is drawn between
+# the delay and PACING_JITTER times it, and kept within the same bounds.
+ADAPTIVE_PACING = False
+PACING_MIN_DELAY = 0.5
+PACING_MAX_DELAY = 30.0
+PACING_STEP = 0.1
+PACING_BACKOFF = 2.0
+PACING_SLOW_RESPONSE = 2.0
+PACING_SMOOTHING = 0.2
+PACING_JITTER = 1.5
+
+# A wizard step landing on an unexpected page is retried this many times in a
+# row (waiting WIZARD_RETRY_BACKOFF seconds, doubled on every retry) before the
+# whole wizard is started over, at most WIZARD_RESTARTS times
+WIZARD_STEP_RETRIES = 2
+WIZARD_RETRY_BACKOFF = 2.0
+WIZARD_RESTARTS = 1
+
+# How RequestProcessor sends requests, see adwords.transport: 'urllib', 'record'
+# (sending them and saving requests and responses to TRANSPORT_CASSETTE) or
+# 'replay' (serving saved responses TRANSPORT_REPLAY_SPEED times faster than
+# recorded, 0 for no waiting)
+TRANSPORT = 'urllib'
+TRANSPORT_CASSETTE = './adwords.cassette'
+TRANSPORT_REPLAY_SPEED = 1.0
+
+# Set None to turn logging off
+LOG_FILE = './log.txt'
+# Messages below this level are dropped, see adwords.logwriter
+LOG_LEVEL = 20
+# Records are written by a background thread in batches of up to this size
+LOG_BATCH_SIZE = 100
+# Seconds the writer waits to fill up a batch before writing it
+LOG_FLUSH_INTERVAL = 0.5
 # 0 - log only processor routines calles, 1 - also log each http-request
 DEBUG_LEVEL = 0
 
+# Bytes read at once when looking for a form field in a page
+READ_CHUNK_SIZE = 16384
+
+# Set True to collect request/operation timings, see adwords.metrics
+METRICS_ENABLED = False
+
+# Adgroups of one set mapper.get_keywords() and report_set_performance() read
+# at a time, each by a fork of the account processor sharing its session. The
+# forks share the delays of the account too, so only response times overlap.
+READ_CONCURRENCY = 1
+
+# Accounts mapper.report_all_sets() reports at a time
+REPORT_THREADS = 8
+
+# Rows per file written by adwords.export before starting the next one
+EXPORT_CHUNK_ROWS = 100000
+
+# Seconds adwords.coalescer.WriteBuffer waits after the first buffered update
+# before sending it (with every update for the same sets made meanwhile)
+COALESCE_DELAY = 60
+
+# adwords.worker: seconds an account lease and a running job live without a
+# heartbeat, seconds between heartbeats and between polls of an empty queue
+WORKER_LEASE_TIME = 300
+WORKER_HEARTBEAT_INTERVAL = 30
+WORKER_POLL_INTERVAL = 5
+# A failed job is retried after WORKER_RETRY_BACKOFF seconds (doubled on every
+# retry) until it has been tried WORKER_MAX_ATTEMPTS times
+WORKER_MAX_ATTEMPTS = 3
+WORKER_RETRY_BACKOFF = 60
+# Pending jobs looked at when claiming one
+WORKER_CLAIM_BATCH = 50
+
+# Whether create_set() and modify_keywords() normalize keywords and drop
+# duplicates before submitting them, unless told otherwise by their argument
+NORMALIZE_KEYWORDS = False
+
+# How keywords of a set are split into adgroups: 'contiguous' (in the given
+# order) or 'hash' (consistent hashing, see adwords.partitioner). The hash
+# partitioner fills new adgroups to PARTITION_FILL of MAX_KEYWORDS_PER_ADGROUP
+# and puts PARTITION_REPLICAS points of every adgroup on its ring.
+KEYWORD_PARTITIONER = 'contiguous'
+PARTITION_FILL = 0.8
+PARTITION_REPLICAS = 64
+
 # Limits
 MAX_CAMPAIGNS_PER_ACCOUNT = 25
 MAX_ADGROUPS_PER_CAMPAIGN = 100
@@ -0,0 +1,380 @@
+'''
+adwords.transport
+
+Transports send the requests of RequestProcessor. The default one uses
+urllib2 with a cookie jar per processor. A recording transport saves every
+request and response to a cassette file (JSON lines), a replaying one
+serves them back without a network, at the recorded pace or faster, so
+mapper operations can be profiled offline:
+
+    TRANSPORT = 'record'
+    TRANSPORT_CASSETTE = './clone.cassette'
+    mapper.clone_account(...)                # once, against AdWords
+
+    TRANSPORT = 'replay'
+    TRANSPORT_REPLAY_SPEED = 0               # no waiting for responses
+    FAKE_DELAY_MIN = FAKE_DELAY_MAX = 0
+    cProfile.run('mapper.clone_account(...)')
+
+A replayed request is matched to the first interaction not served yet with
+the same method and url, or failing that with the same method and path
+(urls holding session keys differ between runs).
+
+Credentials posted in SCRUBBED_FIELDS and cookies (SCRUBBED_HEADERS) are
+replaced with SCRUBBED before recording, so a cassette can be shared.
+
+@version: 0.1.1
+'''
+
+from __future__ import with_statement
+
+import re
+import time
+import json
+import urllib2
+import urlparse
+import mimetools
+import cookielib
+import threading
+import StringIO
+
+import settings
+
+#-------------------------------------------------------------------------------
+
+SCRUBBED = 'scrubbed'
+SCRUBBED_FIELDS = ('Email', 'Passwd')
+SCRUBBED_HEADERS = ('Cookie', 'Set-Cookie', 'Set-Cookie2')
+
+_scrubbed_field_pattern = re.compile(r'(^|&)(%s)=[^&]*' % '|'.join([re.escape(name) for name in SCRUBBED_FIELDS]))
+_scrubbed_header_pattern = re.compile(r'^(%s)[ \t]*:' % '|'.join([re.escape(name) for name in SCRUBBED_HEADERS]),
+                                      re.IGNORECASE)
+
+#-------------------------------------------------------------------------------
+
+class CassetteError(Exception):
+    '''
+    Raised when a replayed request has no recorded interaction left.
+    '''
+
+
+class UrllibTransport:
+    '''
+    Sends requests with urllib2, keeping cookies in its own cookie jar.
+    '''
+
+    def __init__(self, cookiejar=None):
+        '''
+        @param cookiejar: cookielib.CookieJar - a new one by default
+        '''
+        # an empty jar is false, so it's tested against None
+        if cookiejar is None:
+            cookiejar = cookielib.CookieJar()
+        self.cookiejar = cookiejar
+        self._opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookiejar))
+
+    def create_request(self, url):
+        '''
+        @param url: str
+
+        @return: urllib2.Request
+        '''
+        return urllib2.Request(url)
+
+    def open(self, request):
+        '''
+        Sends a request following redirects. Raises urllib2.HTTPError and
+        urllib2.URLError the way urllib2.urlopen() does.
+
+        @param request: urllib2.Request
+
+        @return: response with read(), geturl(), info() and code
+        '''
+        return self._opener.open(request)
+
+    def fork(self):
+        '''
+        Returns a transport sharing the cookie jar (and so the session) of
+        this one, for requests sent concurrently from another thread.
+
+        @return: UrllibTransport
+        '''
+        return UrllibTransport(self.cookiejar)
+
+#-------------------------------------------------------------------------------
+
+class Cassette:
+    '''
+    Interactions recorded to or replayed from a file, shared by the
+    transports of all processors.
+    '''
+
+    def __init__(self, path):
+        '''
+        @param path: str
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        self._interactions = None
+        self._served = None
+
+    def record(self, interaction):
+        '''
+        Appends an interaction (a dict) to the file.
+
+        @param interaction: dict
+        '''
+        line = json.dumps(interaction) + '\n'
+        with self._lock:
+            f = open(self.path, 'ab')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+
+    def take(self, method, url):
+        '''
+        Returns the interaction to replay for a request and marks it served.
+
+        @param method: str
+        @param url: str
+
+        @return: dict
+        '''
+        path = urlparse.urlparse(url)[2]
+
+        with self._lock:
+            if self._interactions is None:
+                self._load()
+
+            fallback = None
+            for index, interaction in enumerate(self._interactions):
+                if self._served[index] or interaction['method'] != method:
+                    continue
+                if interaction['url'] == url:
+                    self._served[index] = True
+                    return interaction
+                if fallback is None and urlparse.urlparse(interaction['url'])[2] == path:
+                    fallback = index
+
+            if fallback is None:
+                raise CassetteError('No recorded interaction left for %s %s' % (method, url))
+            self._served[fallback] = True
+            return self._interactions[fallback]
+
+    def rewind(self):
+        '''
+        Makes every interaction available for replay again.
+        '''
+        with self._lock:
+            self._interactions = None
+
+    def _load(self):
+        f = open(self.path, 'rb')
+        try:
+            self._interactions = [json.loads(line) for line in f if line.strip()]
+        finally:
+            f.close()
+        self._served = [False] * len(self._interactions)
+
+
+class _RecordedResponse:
+    '''
+    Response served from a recorded body.
+    '''
+
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self._headers = mimetools.Message(StringIO.StringIO(headers))
+        self._body = StringIO.StringIO(body)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self._headers
+
+    def close(self):
+        self._body.close()
+
+
+def _encode_body(body):
+    # json keeps text only, bytes map to the first 256 code points one to one
+    return body.decode('latin-1')
+
+
+def _decode_body(body):
+    return body.encode('latin-1')
+
+
+def _scrub_data(data):
+    # form fields only, the rest is recorded byte for byte
+    return _scrubbed_field_pattern.sub(r'\1\2=' + SCRUBBED, data)
+
+
+def _scrub_headers(headers):
+    lines = []
+    scrubbing = False
+    for line in headers.splitlines(True):
+        # folded lines continue the header above
+        if line[:1] in (' ', '\t'):
+            if not scrubbing:
+                lines.append(line)
+            continue
+        match = _scrubbed_header_pattern.match(line)
+        scrubbing = match is not None
+        if scrubbing:
+            lines.append('%s: %s\r\n' % (match.group(1), SCRUBBED))
+        else:
+            lines.append(line)
+    return ''.join(lines)
+
+
+class RecordingTransport:
+    '''
+    Sends requests with another transport and records every interaction,
+    failed ones included, to a cassette.
+    '''
+
+    def __init__(self, cassette, transport=None):
+        '''
+        @param cassette: Cassette
+        @param transport: UrllibTransport by default
+        '''
+        self.cassette = cassette
+        self.transport = transport or UrllibTransport()
+        self.cookiejar = self.transport.cookiejar
+
+    def create_request(self, url):
+        return self.transport.create_request(url)
+
+    def fork(self):
+        return RecordingTransport(self.cassette, self.transport.fork())
+
+    def open(self, request):
+        interaction = {
+            'method': request.get_method(),
+            'url': request.get_full_url(),
+            'data': request.has_data() and _encode_body(_scrub_data(request.get_data())) or None,
+        }
+
+        started = time.time()
+        try:
+            response = self.transport.open(request)
+        except urllib2.HTTPError, e:
+            body = e.fp is not None and e.read() or ''
+            interaction.update(elapsed=time.time() - started, code=e.code, final_url=e.geturl(),
+                               headers=_scrub_headers(str(e.info() or '')), body=_encode_body(body), error=str(e.msg))
+            self.cassette.record(interaction)
+            raise urllib2.HTTPError(e.geturl(), e.code, e.msg, e.info(), StringIO.StringIO(body))
+        except urllib2.URLError, e:
+            interaction.update(elapsed=time.time() - started, code=None, reason=str(e.reason))
+            self.cassette.record(interaction)
+            raise
+
+        # the body is read now to be recorded, so elapsed includes reading it
+        body = response.read()
+        headers = str(response.info())
+        interaction.update(elapsed=time.time() - started, code=getattr(response, 'code', None),
+                           final_url=response.geturl(), headers=_scrub_headers(headers), body=_encode_body(body))
+        self.cassette.record(interaction)
+
+        return _RecordedResponse(response.geturl(), interaction['code'], headers, body)
+
+
+class ReplayTransport:
+    '''
+    Serves responses recorded in a cassette instead of sending requests.
+    '''
+
+    def __init__(self, cassette, speed=None):
+        '''
+        @param cassette: Cassette
+        @param speed: float - how many times faster than recorded responses
+            are served, 1 for the recorded pace, 0 to serve them at once;
+            settings.TRANSPORT_REPLAY_SPEED by default
+        '''
+        self.cassette = cassette
+        self.speed = settings.TRANSPORT_REPLAY_SPEED if speed is None else speed
+        self.cookiejar = cookielib.CookieJar()
+
+    def create_request(self, url):
+        return urllib2.Request(url)
+
+    def fork(self):
+        fork = ReplayTransport(self.cassette, self.speed)
+        fork.cookiejar = self.cookiejar
+        return fork
+
+    def open(self, request):
+        interaction = self.cassette.take(request.get_method(), request.get_full_url())
+        if self.speed:
+            time.sleep(interaction['elapsed'] / self.speed)
+
+        if interaction['code'] is None:
+            raise urllib2.URLError(interaction['reason'])
+
+        body = _decode_body(interaction['body'])
+        if 'error' in interaction:
+            raise urllib2.HTTPError(interaction['final_url'], interaction['code'], interaction['error'],
+                                    mimetools.Message(StringIO.StringIO(interaction['headers'])), StringIO.StringIO(body))
+
+        return _RecordedResponse(interaction['final_url'], interaction['code'], interaction['headers'], body)
+
+#-------------------------------------------------------------------------------
+
+_factory = None
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path):
+    '''
+    Returns the cassette of a file, shared by all transports using it.
+
+    @param path: str
+
+    @return: Cassette
+    '''
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is None:
+            cassette = _cassettes[path] = Cassette(path)
+        return cassette
+
+
+def create_transport():
+    '''
+    Creates the transport of a new RequestProcessor: by the factory given
+    to set_factory() or else as chosen by settings.TRANSPORT ('urllib',
+    'record' or 'replay', the latter two using settings.TRANSPORT_CASSETTE).
+
+    @return: UrllibTransport, RecordingTransport or ReplayTransport
+    '''
+    if _factory is not None:
+        return _factory()
+
+    if settings.TRANSPORT == 'urllib':
+        return UrllibTransport()
+    if settings.TRANSPORT == 'record':
+        return RecordingTransport(get_cassette(settings.TRANSPORT_CASSETTE))
+    if settings.TRANSPORT == 'replay':
+        return ReplayTransport(get_cassette(settings.TRANSPORT_CASSETTE))
+
+    raise ValueError('Unknown transport "%s"' % settings.TRANSPORT)
+
+
+def set_factory(factory):
+    '''
+    Makes new processors use transports made by a given callable (taking
+    no arguments), None restores the settings.TRANSPORT choice.
+
+    @param factory: callable
+    '''
+    global _factory
+    _factory = factory
+#-------------------------------------------------------------------------------
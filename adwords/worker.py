@@ -0,0 +1,400 @@
+'''
+adwords.worker
+
+Runs mapper functions queued in the database (see mapper.Job) in any
+number of processes and machines sharing the mapper database:
+
+    job_id = worker.enqueue('modify_keywords', 'shoes', keywords)
+
+    python -m adwords.worker --processes 4
+
+A worker only runs jobs of an account while holding its lease
+(mapper.AccountLease), so two workers never sign in to one account at the
+same time. Leases and running jobs are kept alive by heartbeats; jobs of a
+worker which stopped sending them are queued again.
+
+@version: 0.1.1
+'''
+
+from __future__ import with_statement
+
+import os
+import time
+import socket
+import datetime
+import threading
+import traceback
+import optparse
+
+from sqlalchemy import select, and_, or_
+from sqlalchemy.exc import IntegrityError
+
+import mapper
+import partitioner
+import configuration
+import metrics
+import logwriter
+import settings
+
+#-------------------------------------------------------------------------------
+
+OPERATIONS = ('create_set', 'drop_set', 'modify_keywords', 'change_default_bid', 'report_set_performance')
+
+# errors a retry can't help with
+PERMANENT_ERRORS = (ValueError, OverflowError, TypeError)
+
+# operation => (position after the set, name) of its keywords argument
+KEYWORDS_ARGUMENTS = {
+    'create_set': (6, 'keywords'),
+    'modify_keywords': (0, 'new_keywords'),
+}
+
+# positions of create_set() arguments following the set
+ACCOUNT_EMAIL_POSITION = 7
+KEYWORDS_COUNT_POSITION = 9
+
+#-------------------------------------------------------------------------------
+
+@mapper.transactional
+def enqueue(operation, set, *args, **kwargs):
+    '''
+    Queues a call of a mapper function, e.g.:
+
+        enqueue('change_default_bid', 'shoes', Decimal('0.50'))
+
+    The account a job runs in is decided now: the one holding the set, for
+    create_set() the given account_email or the one the set would be placed
+    to. Except for create_set() the set has to exist.
+
+    @param operation: str - one of OPERATIONS
+    @param set: str
+    @param max_attempts: int - keyword only, settings.WORKER_MAX_ATTEMPTS by default
+
+    @return: int - job id
+    '''
+    if operation not in OPERATIONS:
+        raise ValueError('Operation "%s" can\'t be queued' % operation)
+
+    max_attempts = kwargs.pop('max_attempts', None) or settings.WORKER_MAX_ATTEMPTS
+    session = mapper.get_session()
+
+    # arguments are pickled, so keywords given as any iterable are stored as a list
+    args = list(args)
+    if operation in KEYWORDS_ARGUMENTS:
+        position, name = KEYWORDS_ARGUMENTS[operation]
+        keywords = _get_argument(args, kwargs, position, name)
+        if keywords is not None and not isinstance(keywords, (list, tuple)):
+            _set_argument(args, kwargs, position, name, list(keywords))
+
+    if operation == 'create_set':
+        account = _get_argument(args, kwargs, ACCOUNT_EMAIL_POSITION, 'account_email')
+        if account is None:
+            keywords_count = _get_argument(args, kwargs, KEYWORDS_COUNT_POSITION, 'keywords_count')
+            if keywords_count is None:
+                keywords_count = len(_get_argument(args, kwargs, KEYWORDS_ARGUMENTS[operation][0], 'keywords') or [])
+            account_id = mapper.PlacementPlanner(session).place(partitioner.get_partitioner().count(keywords_count))[0]
+            account = session.query(mapper.Account).get(account_id).email
+            _set_argument(args, kwargs, ACCOUNT_EMAIL_POSITION, 'account_email', account)
+    else:
+        row = session.query(mapper.Account.email) \
+            .filter(mapper.Account.id == mapper.Campaign.account_id) \
+            .filter(mapper.Campaign.id == mapper.AdGroup.campaign_id) \
+            .filter(mapper.AdGroup.set == set).first()
+        if row is None:
+            raise ValueError('Set "%s" not found' % set)
+        account = row[0]
+
+    now = datetime.datetime.utcnow()
+    job = mapper.Job(operation=operation, account=account, set=set, arguments=(tuple(args), kwargs),
+                     status=mapper.Job.STATUS_PENDING, attempts=0, max_attempts=max_attempts,
+                     not_before=now, created_at=now)
+    session.add(job)
+    session.flush()
+
+    return job.id
+
+
+def _get_argument(args, kwargs, position, name):
+    # value of an argument given positionally or by name, None if not given
+    if position < len(args):
+        return args[position]
+    return kwargs.get(name)
+
+
+def _set_argument(args, kwargs, position, name, value):
+    # replaces an argument where it was given, so it isn't given twice
+    if position < len(args):
+        args[position] = value
+    else:
+        kwargs[name] = value
+
+
+@mapper.transactional
+def get_job(job_id):
+    '''
+    @param job_id: int
+
+    @return: mapper.Job
+    '''
+    return mapper.get_session().query(mapper.Job).get(job_id)
+
+#-------------------------------------------------------------------------------
+
+class Worker:
+    '''
+    Claims and runs queued jobs one at a time.
+    '''
+
+    def __init__(self, name=None, lease_time=None, heartbeat_interval=None, poll_interval=None, config=None):
+        '''
+        Arguments left None are taken from adwords.settings.
+
+        @param name: str - unique among all workers, host:pid by default
+        @param lease_time: int - seconds a lease/job lives without heartbeats
+        @param heartbeat_interval: int - seconds
+        @param poll_interval: int - seconds to wait when there is no job
+        @param config: configuration.Configuration - the current one by default
+        '''
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease_time = lease_time or settings.WORKER_LEASE_TIME
+        self.heartbeat_interval = heartbeat_interval or settings.WORKER_HEARTBEAT_INTERVAL
+        self.poll_interval = settings.WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.configuration = config or configuration.get_current()
+
+        self.stats = {'done': 0, 'failed': 0, 'retried': 0, 'started_at': None}
+
+        self._stopped = threading.Event()
+        self._jobs = mapper.Job.__table__
+        self._leases = mapper.AccountLease.__table__
+
+    def __repr__(self):
+        return '<Worker "%s">' % self.name
+
+    def throughput(self):
+        '''
+        @return: float - jobs finished (done or failed) per minute since run() started
+        '''
+        if self.stats['started_at'] is None:
+            return 0.0
+        elapsed = max(time.time() - self.stats['started_at'], 1e-6)
+        return 60.0 * (self.stats['done'] + self.stats['failed']) / elapsed
+
+    def stop(self):
+        '''
+        Makes run() return after the current job.
+        '''
+        self._stopped.set()
+
+    def run(self, max_jobs=None, exit_when_idle=False):
+        '''
+        Runs jobs until stopped.
+
+        @param max_jobs: int - return after this many jobs
+        @param exit_when_idle: bool - return when no job can be claimed
+        '''
+        self.stats['started_at'] = time.time()
+        self._log('worker started')
+
+        jobs_count = 0
+        while not self._stopped.isSet():
+            if self.run_once():
+                jobs_count += 1
+                if max_jobs is not None and jobs_count >= max_jobs:
+                    break
+            elif exit_when_idle:
+                break
+            else:
+                self._stopped.wait(self.poll_interval)
+
+        self._log('worker stopped, %(done)d jobs done, %(failed)d failed, %(retried)d retried' % self.stats)
+
+    def run_once(self):
+        '''
+        Claims and runs one job.
+
+        @return: bool - False if there was no job to claim
+        '''
+        claimed = self._claim()
+        if claimed is None:
+            return False
+
+        job_id, account = claimed
+        try:
+            self._run_job(job_id, account)
+        finally:
+            self._release_lease(account)
+
+        return True
+
+    def _execute(self, statement):
+        return self.configuration.engine.execute(statement)
+
+    def _claim(self):
+        now = datetime.datetime.utcnow()
+        self._requeue_stale(now)
+
+        jobs = self._jobs
+        candidates = self._execute(select([jobs.c.id, jobs.c.account],
+            and_(jobs.c.status == mapper.Job.STATUS_PENDING, jobs.c.not_before <= now))
+            .order_by(jobs.c.id).limit(settings.WORKER_CLAIM_BATCH)).fetchall()
+
+        tried = {}
+        for job_id, account in candidates:
+            if account in tried:
+                continue
+            tried[account] = True
+
+            if not self._acquire_lease(account, now):
+                continue
+
+            claimed = self._execute(jobs.update()
+                .where(and_(jobs.c.id == job_id, jobs.c.status == mapper.Job.STATUS_PENDING))
+                .values(status=mapper.Job.STATUS_RUNNING, worker=self.name, heartbeat_at=now,
+                        attempts=jobs.c.attempts + 1)).rowcount
+            if claimed:
+                return job_id, account
+
+            self._release_lease(account)
+
+        return None
+
+    def _requeue_stale(self, now):
+        # running jobs of workers which stopped sending heartbeats
+        jobs = self._jobs
+        stale = and_(jobs.c.status == mapper.Job.STATUS_RUNNING,
+                     jobs.c.heartbeat_at < now - datetime.timedelta(seconds=self.lease_time))
+
+        self._execute(jobs.update().where(and_(stale, jobs.c.attempts >= jobs.c.max_attempts))
+            .values(status=mapper.Job.STATUS_FAILED, finished_at=now, error='Worker stopped sending heartbeats'))
+        self._execute(jobs.update().where(stale)
+            .values(status=mapper.Job.STATUS_PENDING, not_before=now))
+
+    def _acquire_lease(self, account, now):
+        leases = self._leases
+        expires_at = now + datetime.timedelta(seconds=self.lease_time)
+
+        updated = self._execute(leases.update()
+            .where(and_(leases.c.account == account, or_(leases.c.worker == self.name, leases.c.expires_at < now)))
+            .values(worker=self.name, expires_at=expires_at)).rowcount
+        if updated:
+            return True
+
+        try:
+            self._execute(leases.insert().values(account=account, worker=self.name, expires_at=expires_at))
+        except IntegrityError:
+            # leased by another worker
+            return False
+
+        return True
+
+    def _release_lease(self, account):
+        leases = self._leases
+        self._execute(leases.delete().where(and_(leases.c.account == account, leases.c.worker == self.name)))
+
+    def _heartbeat(self, job_id, account, finished):
+        jobs, leases = self._jobs, self._leases
+
+        while True:
+            finished.wait(self.heartbeat_interval)
+            if finished.isSet():
+                break
+            
+            now = datetime.datetime.utcnow()
+            self._execute(jobs.update().where(jobs.c.id == job_id).values(heartbeat_at=now))
+            renewed = self._execute(leases.update()
+                .where(and_(leases.c.account == account, leases.c.worker == self.name))
+                .values(expires_at=now + datetime.timedelta(seconds=self.lease_time))).rowcount
+            if not renewed:
+                self._log('! lease of the account has been lost', logwriter.WARNING, account=account)
+
+    def _run_job(self, job_id, account):
+        job = self._execute(select([self._jobs]).where(self._jobs.c.id == job_id)).fetchone()
+        operation = job['operation']
+        args, kwargs = job['arguments']
+
+        self._log('job %d started (attempt %d)' % (job_id, job['attempts']), account=account,
+                  operation=operation, set=job['set'])
+
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, account, finished),
+                                     name='adwords-worker-heartbeat')
+        heartbeat.setDaemon(True)
+        heartbeat.start()
+
+        started = time.time()
+        values = {'finished_at': None}
+        try:
+            try:
+                with configuration.use(self.configuration):
+                    result = getattr(mapper, operation)(job['set'], *args, **kwargs)
+            except Exception, e:
+                error = traceback.format_exc()
+                if isinstance(e, PERMANENT_ERRORS) or job['attempts'] >= job['max_attempts']:
+                    status = mapper.Job.STATUS_FAILED
+                    values.update(status=status, error=error, finished_at=datetime.datetime.utcnow())
+                else:
+                    status = 'retried'
+                    backoff = settings.WORKER_RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+                    values.update(status=mapper.Job.STATUS_PENDING, error=error, worker=None,
+                                  not_before=datetime.datetime.utcnow() + datetime.timedelta(seconds=backoff))
+                self._log('! job %d %s: %s' % (job_id, status, e), logwriter.ERROR, account=account, operation=operation)
+            else:
+                status = mapper.Job.STATUS_DONE
+                if isinstance(result, mapper.Account):
+                    result = result.email
+                values.update(status=status, result=result, error=None, finished_at=datetime.datetime.utcnow())
+                self._log('job %d done' % job_id, account=account, operation=operation, set=job['set'])
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        self._execute(self._jobs.update().where(self._jobs.c.id == job_id).values(**values))
+        self.stats[status] += 1
+
+        if metrics.enabled():
+            metrics.increment('adwords_jobs_total', {'worker': self.name, 'operation': operation, 'status': status})
+            metrics.observe('adwords_job_seconds', {'worker': self.name, 'operation': operation}, time.time() - started)
+
+    def _log(self, message, level=logwriter.INFO, **fields):
+        logwriter.log(level, message, worker=self.name, **fields)
+
+#-------------------------------------------------------------------------------
+
+def _run_worker(name, options):
+    Worker(name, poll_interval=options.poll).run(options.max_jobs, options.exit_when_idle)
+
+
+def main(arguments=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--name', help='worker name, host:pid by default')
+    parser.add_option('--processes', type='int', default=1, help='worker processes to start')
+    parser.add_option('--poll', type='float', help='seconds to wait when there are no jobs')
+    parser.add_option('--max-jobs', type='int', dest='max_jobs', help='exit after this many jobs')
+    parser.add_option('--exit-when-idle', action='store_true', dest='exit_when_idle', default=False,
+                      help='exit when there are no jobs left')
+
+    options, arguments = parser.parse_args(arguments)
+
+    if options.processes == 1:
+        _run_worker(options.name, options)
+        return
+
+    import multiprocessing
+
+    processes = []
+    for number in range(options.processes):
+        name = options.name and '%s-%d' % (options.name, number + 1)
+        process = multiprocessing.Process(target=_run_worker, args=(name, options))
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
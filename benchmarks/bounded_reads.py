@@ -0,0 +1,86 @@
+'''
+benchmarks.bounded_reads
+
+Compares reading a whole EditKeywords page and searching it with the
+regular expressions against pageparser.extract() stopping right after the
+field it needs. Pages are synthetic: the form comes first and is followed
+by a given amount of unrelated markup, as on the real page.
+
+Pages are read from memory, so the 'ms' columns are parsing time only and
+the '@1MB/s' ones add the time the bytes read would take on such a link.
+
+    python benchmarks/bounded_reads.py
+'''
+
+import os
+import re
+import sys
+import time
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import pageparser
+
+#-------------------------------------------------------------------------------
+
+# bytes per second
+BANDWIDTH = 1024 * 1024
+
+
+def build_page(keywords_count, tail_bytes):
+    keywords = '\n'.join(['keyword number %d ** 0.%02d' % (i, i % 100) for i in range(keywords_count)])
+    row = '<tr class="row"><td><a href="CampaignManagement?adgroupid=1">x</a></td><td align="right">-</td></tr>\n'
+    
+    return ''.join([
+        '<html><body><form name="editkeywords">\n',
+        '<input type="hidden" name="campaignId" value="1">\n',
+        '<input type="text" name="price" value="0.25">\n',
+        '<textarea rows="20" name="keywords">%s</textarea>\n' % keywords,
+        '</form>\n',
+        row * (tail_bytes / len(row)),
+        '</body></html>\n',
+    ])
+
+
+def full_read(page):
+    data = StringIO.StringIO(page).read()
+    keywords = re.search('<textarea [^>]*name="keywords"[^>]*>(?P<keywords>[^<]*)</textarea>', data).group('keywords')
+    price = re.search('<input [^>]*name="price"[^>]*value="(?P<price>[^"]+)"', data).group('price')
+    return len(data), keywords, price
+
+
+def bounded_read(page):
+    stats = {}
+    found = pageparser.extract(StringIO.StringIO(page), [pageparser.KEYWORDS_TEXTAREA, pageparser.PRICE_INPUT], stats=stats)
+    return stats, found['keywords'], found['price']
+
+
+def measure(function, page, repeat):
+    started = time.time()
+    for i in range(repeat):
+        result = function(page)
+    return (time.time() - started) / repeat, result
+
+
+def main():
+    print '%-9s %-9s %10s %10s %14s %14s %12s %12s %12s' % ('keywords', 'page', 'full ms', 'bounded ms', 
+        'full @1MB/s', 'bounded @1MB/s', 'full held', 'bounded held', 'bounded read')
+    
+    for keywords_count in (100, 1000):
+        for tail_bytes in (100 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+            page = build_page(keywords_count, tail_bytes)
+            repeat = max(3, 20 * 1024 * 1024 / len(page))
+            
+            full_time, (held, full_keywords, full_price) = measure(full_read, page, repeat)
+            bounded_time, (stats, keywords, price) = measure(bounded_read, page, repeat)
+            assert (keywords, price) == (full_keywords, full_price)
+            
+            print '%-9d %-9s %10.3f %10.3f %14.1f %14.1f %12d %12d %12d' % (keywords_count, '%dKB' % (len(page) / 1024), 
+                1000 * full_time, 1000 * bounded_time, 
+                1000 * (full_time + float(held) / BANDWIDTH), 1000 * (bounded_time + float(stats['bytes_read']) / BANDWIDTH),
+                held, stats['max_window'], stats['bytes_read'])
+
+
+if __name__ == '__main__':
+    main()
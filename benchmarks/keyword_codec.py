@@ -0,0 +1,97 @@
+'''
+benchmarks.keyword_codec
+
+Measures encoding/decoding speed of large keyword blocks against the
+per-keyword str()/split() code the processor used before. The codec's
+round-trip behaviour is checked by tests/test_keywordcodec.py.
+
+    python benchmarks/keyword_codec.py
+'''
+
+import os
+import sys
+import time
+import random
+import decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import keywordcodec
+from requestprocessor import Keyword
+
+#-------------------------------------------------------------------------------
+
+WORDS = ['red', 'blue', 'shoes', 'cheap', 'buy', 'online', 'free', 'shipping', 'size', '10', 'kids']
+
+
+def random_keyword(rng):
+    text = ' '.join([rng.choice(WORDS) for i in range(rng.randint(1, 4))])
+    text = rng.choice(['%s', '[%s]', '"%s"', '-%s']) % text
+    
+    bid = None
+    if rng.random() < 0.6:
+        bid = decimal.Decimal(rng.randint(1, 50000)) / 100
+    url = None
+    if rng.random() < 0.4:
+        url = 'http://example.com/%s?kw=%d' % (rng.choice(WORDS), rng.randint(0, 1000))
+    
+    if bid is None and url is None and rng.random() < 0.5:
+        return Keyword(text)
+    return Keyword(text, bid, url)
+
+
+def random_block(rng, size):
+    return [random_keyword(rng) for i in range(size)]
+
+
+def old_encode(keywords):
+    keywords_processed = []
+    for keyword in keywords:
+        keywords_processed.append(str(keyword))
+    return '\x0D\x0A'.join(keywords_processed)
+
+
+def old_decode(keywords):
+    result = []
+    for keyword_string in keywords.split('\n'):
+        splitted = keyword_string.split(' ** ')
+        keyword = Keyword(splitted[0])
+        if len(splitted) > 1:
+            try: keyword.bid = float(splitted[1])
+            except ValueError: keyword.url = splitted[1]
+        if len(splitted) > 2:
+            keyword.url = splitted[2]
+        result.append(keyword)
+    return result
+
+
+def measure(function, argument, repeat):
+    # best of a few runs, single runs are too noisy to compare
+    best = None
+    for run in range(5):
+        started = time.time()
+        for i in range(repeat):
+            function(argument)
+        elapsed = (time.time() - started) / repeat
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    rng = random.Random(1)
+    print '%-8s %14s %14s %14s %14s' % ('lines', 'encode/s', 'old encode/s', 'decode/s', 'old decode/s')
+    for size in (100, 1000, 10000):
+        block = random_block(rng, size)
+        encoded = keywordcodec.encode(block)
+        repeat = max(1, 40000 / size)
+        
+        print '%-8d %14d %14d %14d %14d' % (size, 
+            size / measure(keywordcodec.encode, block, repeat),
+            size / measure(old_encode, block, repeat),
+            size / measure(keywordcodec.decode, encoded, repeat),
+            size / measure(old_decode, encoded, repeat))
+
+
+if __name__ == '__main__':
+    main()
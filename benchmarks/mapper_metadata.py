@@ -0,0 +1,99 @@
+'''
+benchmarks.mapper_metadata
+
+Measures how much time the mapper spends in its own database work per
+operation, with AdWords requests replaced by a processor doing nothing.
+Compares the database URLs given on the command line:
+
+    python benchmarks/mapper_metadata.py sqlite:///./bench.db mysql://root:@localhost/adwords_bench
+
+Databases should be empty, the schema is created by mapper.install().
+'''
+
+import os
+import sys
+import time
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import configuration
+import mapper
+
+#-------------------------------------------------------------------------------
+
+class NullProcessor:
+    '''
+    Stands in for RequestProcessor so only the mapper bookkeeping is timed.
+    '''
+    
+    _ids = itertools.count(1)
+    
+    def __init__(self, email, password):
+        pass
+    
+    def sign_in(self): pass
+    def sign_out(self): pass
+    def set_keywords(self, campaign_id, adgroup_id, keywords): list(keywords)
+    def set_default_bid(self, campaign_id, adgroup_id, bid): pass
+    
+    def edit_keywords(self, campaign_id, adgroup_id, keywords=None, bid=None):
+        if keywords is not None:
+            list(keywords)
+    
+    def delete_adgroup(self, campaign_id, adgroup_id): pass
+    def get_keywords(self, campaign_id, adgroup_id): return []
+    
+    def add_campaign(self, campaign_name, adgroup_name, display_url, url, headline, adline1, adline2, keywords, bid):
+        list(keywords)
+        return self._ids.next(), self._ids.next()
+    
+    def add_adgroup(self, campaign_id, adgroup_name, display_url, url, headline, adline1, adline2, keywords, bid):
+        list(keywords)
+        return self._ids.next()
+
+
+def timed(results, name, function, *args):
+    started = time.time()
+    result = function(*args)
+    results.setdefault(name, []).append(time.time() - started)
+    return result
+
+
+def run(db_connection, sets_count=200, parts_per_set=3):
+    results = {}
+    keywords = ['keyword %d' % i for i in range(settings.MAX_KEYWORDS_PER_ADGROUP * parts_per_set)]
+    
+    with configuration.use(configuration.Configuration(db_connection)):
+        mapper.install()
+        for i in range(sets_count / (settings.MAX_ADGROUPS_PER_CAMPAIGN / parts_per_set) + 1):
+            mapper.add_account('bench%d@example.com' % i, 'password')
+        
+        for i in range(sets_count):
+            set = 'set%d' % i
+            timed(results, 'create_set', mapper.create_set, 
+                set, 'example.com', 1, 'http://example.com/', 'headline', 'line1', 'line2', keywords)
+            timed(results, 'get_capacity', mapper.get_capacity, set)
+            timed(results, 'get_account_capacity', mapper.get_account_capacity, 'bench0@example.com')
+            timed(results, 'change_default_bid', mapper.change_default_bid, set, 2)
+        
+        for i in range(sets_count):
+            timed(results, 'drop_set', mapper.drop_set, 'set%d' % i)
+    
+    return results
+
+
+def main(urls):
+    mapper.RequestProcessor = NullProcessor
+    
+    for url in urls:
+        print url
+        for name, timings in sorted(run(url).items()):
+            print '  %-22s %8.2f ms/op  (%d ops)' % (name, 1000 * sum(timings) / len(timings), len(timings))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or ['sqlite:///./bench_metadata.db'])
@@ -0,0 +1,252 @@
+'''
+benchmarks.page_corpus
+
+Synthetic keywords report and EditKeywords pages shaped like the ones the
+processor parses. Pages are generated from a fixed seed, so a given size
+always gives byte-identical pages and the values parsers should return.
+
+Pages are generated in memory when a benchmark loads them. Run this module
+to write them to a directory, e.g. to look at them in a browser:
+
+    python benchmarks/page_corpus.py <directory> [--all]
+'''
+
+import os
+import sys
+import random
+import decimal
+
+#-------------------------------------------------------------------------------
+
+# (kind, rows, rows per page), report pages come single and multi-page
+CORPUS = [
+    ('report', 10, 10),
+    ('report', 10, 4),
+    ('report', 100, 100),
+    ('report', 100, 25),
+    ('report', 1000, 1000),
+    ('report', 1000, 100),
+    ('report', 10000, 10000),
+    ('report', 10000, 100),
+    ('editkeywords', 10, 10),
+    ('editkeywords', 100, 100),
+    ('editkeywords', 1000, 1000),
+    ('editkeywords', 10000, 10000),
+]
+
+# largest pages written without --all
+WRITTEN_ROWS = 1000
+
+WORDS = ['red', 'blue', 'shoes', 'cheap', 'buy', 'online', 'free', 'shipping', 'size', 'kids', 'sale', 'leather']
+
+REPORT_HEADER = '''<html><head><title>Google AdWords: Ad Group</title></head><body>
+<div id="header"><a href="CampaignSummary">All Online Campaigns</a></div>
+<table class="dataTable" id="keywordsTable">
+<tr class="header"><th></th><th>Keyword</th><th colspan="2">Max CPC</th><th>Clicks</th><th>Impr.</th><th>CTR</th><th>Avg. CPC</th><th>Cost</th><th>Avg. Pos</th></tr>
+'''
+
+REPORT_ROW = '''<tr class="%(parity)s" id="tr_%(id)d">
+<td><input type="checkbox" name="keywordIds" value="%(id)d"></td>
+<td class="keyword"><span class="statusWrap"><div class="status"><img src="images/active.gif" alt="Active"></div>
+</span>
+%(keyword)s</td>
+<td nowrap align="center" colspan="2">%(bid)s</td>
+<td class="" align="right">%(clicks)s
+<span class="delta"></span></td>
+<td class="" align="right">%(impr)s
+<span class="delta"></span></td>
+<td class="" align="right">%(ctr)s
+<span class="delta"></span></td>
+<td class="" align="right">%(cpc)s
+<span class="delta"></span></td>
+<td class="" align="right">%(cost)s
+<span class="delta"></span></td>
+<td class="rightcolumn" align="right">%(pos)s
+</td>
+</tr>
+'''
+
+REPORT_NEXT = '<div class="pager"><a href="CampaignManagement?adgroupid=%(adgroup_id)d&amp;campaignId=%(campaign_id)d&amp;keywordt=%(offset)d"><b>Next %(rows)d</b></a></div>\n'
+
+REPORT_FOOTER = '</table>\n<div id="footer">&copy; Google</div>\n</body></html>\n'
+
+EDITKEYWORDS_PAGE = '''<html><head><title>Google AdWords: Edit Keywords</title></head><body>
+<form name="editkeywords" method="post" action="EditKeywords">
+<input type="hidden" name="campaignId" value="%(campaign_id)d">
+<input type="hidden" name="adgroupid" value="%(adgroup_id)d">
+<input type="text" name="price" value="%(price)s">
+<textarea rows="20" cols="60" name="keywords">%(keywords)s</textarea>
+<input type="submit" name="save" value="Save Changes">
+</form>
+<div id="footer">&copy; Google</div>
+</body></html>
+'''
+
+CAMPAIGN_ID = 100
+ADGROUP_ID = 200
+
+#-------------------------------------------------------------------------------
+
+def _keyword_text(rng, index):
+    # report keywords can only hold word characters and spaces
+    return '%s %d' % (' '.join([rng.choice(WORDS) for i in range(rng.randint(1, 3))]), index)
+
+
+def _money(rng, low, high):
+    return decimal.Decimal(rng.randint(low, high)) / 100
+
+
+def report_rows(rows, seed=0):
+    '''
+    Returns the rows of a report as (markup values, expected parse result)
+    pairs.
+
+    @param rows: int
+    @param seed: int
+
+    @return: list
+    '''
+    rng = random.Random(seed)
+    result = []
+
+    for index in range(rows):
+        keyword = _keyword_text(rng, index)
+        bid = _money(rng, 5, 500)
+        impr = rng.choice([0, rng.randint(1, 100000)])
+        clicks = impr and rng.randint(0, impr / 10)
+
+        ctr = cpc = cost = pos = None
+        if impr:
+            ctr = (decimal.Decimal(clicks * 100) / impr).quantize(decimal.Decimal('0.01'))
+            pos = decimal.Decimal(rng.randint(10, 99)) / 10
+        if clicks:
+            cpc = _money(rng, 1, int(bid * 100))
+            cost = cpc * clicks
+
+        values = {
+            'parity': ('odd', 'even')[index % 2],
+            'id': 1000 + index,
+            'keyword': keyword,
+            'bid': '$%s' % bid,
+            'clicks': clicks,
+            'impr': impr,
+            'ctr': '-' if ctr is None else ctr,
+            'cpc': '-' if cpc is None else '$%s' % cpc,
+            'cost': '-' if cost is None else '$%s' % cost,
+            'pos': '-' if pos is None else pos,
+        }
+        expected = {'bid': '$%s' % bid, 'clicks': clicks, 'impr': impr, 'ctr': ctr, 'cpc': cpc, 'cost': cost, 'pos': pos}
+        result.append((values, (keyword, expected)))
+
+    return result
+
+
+def report_pages(rows, per_page, seed=0):
+    '''
+    Returns report pages with given rows split into pages of per_page rows,
+    and the dict pageparser.parse_report_page() results should add up to.
+
+    @param rows: int
+    @param per_page: int
+    @param seed: int
+
+    @return: tuple - (list, dict)
+    '''
+    generated = report_rows(rows, seed)
+    pages = []
+
+    for offset in range(0, max(rows, 1), per_page):
+        chunk = generated[offset:offset + per_page]
+        page = [REPORT_HEADER]
+        page.extend([REPORT_ROW % values for values, expected in chunk])
+        if offset + per_page < rows:
+            page.append(REPORT_NEXT % {'adgroup_id': ADGROUP_ID, 'campaign_id': CAMPAIGN_ID,
+                                       'offset': offset + per_page, 'rows': per_page})
+        page.append(REPORT_FOOTER)
+        pages.append(''.join(page))
+
+    return pages, dict([expected for values, expected in generated])
+
+
+def editkeywords_page(rows, seed=0):
+    '''
+    Returns an EditKeywords page with given number of keyword lines, and the
+    textarea contents and price it holds.
+
+    @param rows: int
+    @param seed: int
+
+    @return: tuple - (str, str, str)
+    '''
+    rng = random.Random(seed)
+    lines = []
+
+    for index in range(rows):
+        line = _keyword_text(rng, index)
+        line = rng.choice(['%s', '[%s]', '"%s"']) % line
+        if rng.random() < 0.6:
+            line += ' ** %s' % _money(rng, 5, 500)
+        if rng.random() < 0.3:
+            line += ' ** http://example.com/%s?kw=%d' % (rng.choice(WORDS), index)
+        lines.append(line)
+
+    keywords = '\n'.join(lines)
+    price = str(_money(rng, 5, 500))
+    page = EDITKEYWORDS_PAGE % {'campaign_id': CAMPAIGN_ID, 'adgroup_id': ADGROUP_ID, 'price': price, 'keywords': keywords}
+
+    return page, keywords, price
+
+#-------------------------------------------------------------------------------
+
+def _file_names(kind, rows, per_page, pages_count):
+    if kind == 'report':
+        return ['%s-%dx%d-%02d.html' % (kind, rows, per_page, number) for number in range(1, pages_count + 1)]
+    return ['%s-%d.html' % (kind, rows)]
+
+
+def load(kind, rows, per_page):
+    '''
+    Returns pages of a corpus entry with the expected parse result: a dict
+    for report pages, (keywords, price) for EditKeywords.
+
+    @return: tuple - (list, object)
+    '''
+    if kind == 'report':
+        return report_pages(rows, per_page)
+
+    page, keywords, price = editkeywords_page(rows)
+    return [page], (keywords, price)
+
+
+def write(directory, all_sizes=False):
+    '''
+    Writes corpus pages to given directory, by default only the ones up to
+    WRITTEN_ROWS rows.
+
+    @param directory: str
+    @param all_sizes: bool
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for kind, rows, per_page in CORPUS:
+        if rows > WRITTEN_ROWS and not all_sizes:
+            continue
+
+        pages = load(kind, rows, per_page)[0]
+
+        for name, page in zip(_file_names(kind, rows, per_page, len(pages)), pages):
+            output = open(os.path.join(directory, name), 'wb')
+            try:
+                output.write(page)
+            finally:
+                output.close()
+            print name
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    directories = [argument for argument in arguments if argument != '--all']
+    if len(directories) != 1:
+        sys.exit(__doc__.strip().splitlines()[-1].strip())
+    write(directories[0], '--all' in arguments)
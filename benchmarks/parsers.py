@@ -0,0 +1,129 @@
+'''
+benchmarks.parsers
+
+Runs the page parsers over the synthetic corpus (see page_corpus) and
+prints rows parsed per second and the peak memory growth while parsing.
+Every result is checked against the values the pages were generated from,
+so a changed regular expression shows up here as a failure, not just as a
+different timing.
+
+Each corpus entry is measured in its own process, peak memory is the
+growth of its maximum resident size (unix only). No network is used.
+
+    python benchmarks/parsers.py [report|editkeywords] [max rows]
+'''
+
+import os
+import sys
+import time
+import StringIO
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import pageparser
+import keywordcodec
+import page_corpus
+
+#-------------------------------------------------------------------------------
+
+# seconds each entry is parsed repeatedly for
+MEASURE_TIME = 1.0
+
+
+def parse_report(pages):
+    result = {}
+    for page in pages:
+        rows, next_page = pageparser.parse_report_page(page)
+        result.update(rows)
+    return result
+
+
+def parse_editkeywords(pages):
+    found = pageparser.extract(StringIO.StringIO(pages[0]), [pageparser.KEYWORDS_TEXTAREA, pageparser.PRICE_INPUT])
+    return found['keywords'], found['price'], keywordcodec.decode(found['keywords'])
+
+
+def check(kind, pages, expected, result):
+    if kind == 'report':
+        if result != expected:
+            missing = [keyword for keyword in expected if result.get(keyword) != expected[keyword]]
+            raise AssertionError('%d of %d rows parsed wrong, e.g. "%s"' % (len(missing), len(expected), missing[0]))
+        next_pages = [pageparser.parse_report_page(page)[1] for page in pages]
+        if None in next_pages[:-1] or next_pages[-1] is not None:
+            raise AssertionError('next page links parsed wrong')
+        return len(result)
+
+    keywords, price, decoded = result
+    if (keywords, price) != expected:
+        raise AssertionError('keywords textarea or price parsed wrong')
+    return len(decoded)
+
+
+def max_rss():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def measure(kind, rows, per_page):
+    '''
+    Parses one corpus entry and returns (rows, rows per second, peak memory
+    growth in KB).
+    '''
+    pages, expected = page_corpus.load(kind, rows, per_page)
+    parser = {'report': parse_report, 'editkeywords': parse_editkeywords}[kind]
+
+    rss_before = max_rss()
+    result = parser(pages)
+    rss_growth = max_rss() - rss_before
+    parsed = check(kind, pages, expected, result)
+
+    runs = 0
+    started = time.time()
+    while runs < 3 or time.time() - started < MEASURE_TIME:
+        parser(pages)
+        runs += 1
+
+    return parsed, parsed * runs / (time.time() - started), rss_growth
+
+
+def main(kinds, max_rows):
+    print '%-13s %7s %6s %6s %10s %12s %10s' % ('parser', 'rows', 'pages', 'KB', 'rows/s', 'peak +KB', 'status')
+
+    failed = False
+    for kind, rows, per_page in page_corpus.CORPUS:
+        if kind not in kinds or rows > max_rows:
+            continue
+
+        pages, expected = page_corpus.load(kind, rows, per_page)
+        size = sum([len(page) for page in pages]) / 1024
+
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--single', kind, str(rows), str(per_page)],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+
+        if process.returncode:
+            failed = True
+            print '%-13s %7d %6d %6d %10s %12s %10s' % (kind, rows, len(pages), size, '-', '-', 'FAILED')
+            print errors.strip().splitlines()[-1]
+        else:
+            parsed, speed, rss_growth = output.split()
+            print '%-13s %7d %6d %6d %10d %12s %10s' % (kind, rows, len(pages), size, float(speed), rss_growth, 'ok')
+
+    return failed
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+
+    if arguments[:1] == ['--single']:
+        kind, rows, per_page = arguments[1], int(arguments[2]), int(arguments[3])
+        print '%d %f %d' % measure(kind, rows, per_page)
+    else:
+        kinds = [argument for argument in arguments if not argument.isdigit()] or ['report', 'editkeywords']
+        max_rows = ([int(argument) for argument in arguments if argument.isdigit()] or [sys.maxint])[0]
+        sys.exit(main(kinds, max_rows) and 1 or 0)
@@ -0,0 +1,155 @@
+'''
+Tests of adwords.cancellation and of processors stopped by it.
+'''
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import cancellation
+import requestprocessor
+
+#-------------------------------------------------------------------------------
+
+class TokenTest(unittest.TestCase):
+
+    def test_cancel(self):
+        token = cancellation.CancellationToken()
+        token.check()
+        token.cancel()
+        self.assertTrue(token.is_cancelled())
+        self.assertEqual(token.reason, cancellation.CANCELLED)
+        try:
+            token.check()
+        except cancellation.OperationCancelledError, e:
+            self.assertEqual(e.reason, cancellation.CANCELLED)
+            self.assertEqual(e.status, {})
+        else:
+            self.fail('not cancelled')
+
+    def test_deadline(self):
+        token = cancellation.CancellationToken(timeout=0.05)
+        self.assertFalse(token.is_cancelled())
+        self.assertTrue(0 < token.remaining() <= 0.05)
+        time.sleep(0.06)
+        self.assertRaises(cancellation.OperationCancelledError, token.check)
+        self.assertEqual(token.reason, cancellation.DEADLINE)
+        self.assertEqual(token.remaining(), 0.0)
+        self.assertEqual(cancellation.CancellationToken().remaining(), None)
+
+    def test_sleep_stops_at_the_deadline(self):
+        token = cancellation.CancellationToken(timeout=0.05)
+        started = time.time()
+        self.assertRaises(cancellation.OperationCancelledError, token.sleep, 10)
+        self.assertTrue(time.time() - started < 1)
+
+    def test_sleep_stops_when_cancelled_from_another_thread(self):
+        token = cancellation.CancellationToken()
+        threading.Timer(0.05, token.cancel).start()
+        started = time.time()
+        self.assertRaises(cancellation.OperationCancelledError, token.sleep, 10)
+        self.assertTrue(time.time() - started < 1)
+
+
+class ShieldTest(unittest.TestCase):
+
+    def test_shielded_block_is_finished(self):
+        token = cancellation.CancellationToken()
+        with cancellation.use(token):
+            with cancellation.shielded():
+                token.cancel()
+                token.check()
+                token.sleep(0.01)
+                self.assertTrue(cancellation.is_shielded())
+            self.assertFalse(cancellation.is_shielded())
+            self.assertRaises(cancellation.OperationCancelledError, cancellation.check)
+
+    def test_shielded_block_is_not_started_once_fired(self):
+        token = cancellation.CancellationToken()
+        token.cancel()
+        started = []
+
+        @cancellation.unit
+        def work():
+            started.append(True)
+
+        with cancellation.use(token):
+            self.assertRaises(cancellation.OperationCancelledError, work)
+            with cancellation.shielded(check_first=False):
+                pass
+        self.assertEqual(started, [])
+        work()
+        self.assertEqual(started, [True])
+
+    def test_nested_units(self):
+        token = cancellation.CancellationToken()
+
+        @cancellation.unit
+        def inner():
+            token.cancel()
+
+        @cancellation.unit
+        def outer():
+            inner()
+            token.check()
+            return 'done'
+
+        with cancellation.use(token):
+            self.assertEqual(outer(), 'done')
+
+
+class UseTest(unittest.TestCase):
+
+    def test_tokens_are_per_thread_and_nest(self):
+        first = cancellation.CancellationToken()
+        second = cancellation.CancellationToken()
+        seen = []
+
+        self.assertEqual(cancellation.get_current(), None)
+        with cancellation.use(first):
+            with cancellation.use(second):
+                self.assertTrue(cancellation.get_current() is second)
+                thread = threading.Thread(target=lambda: seen.append(cancellation.get_current()))
+                thread.start()
+                thread.join()
+            self.assertTrue(cancellation.get_current() is first)
+        self.assertEqual(cancellation.get_current(), None)
+        self.assertEqual(seen, [None])
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._settings = settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX, settings.ADAPTIVE_PACING
+        settings.FAKE_DELAY_MIN = settings.FAKE_DELAY_MAX = 10.0
+        settings.ADAPTIVE_PACING = False
+
+    def tearDown(self):
+        settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX, settings.ADAPTIVE_PACING = self._settings
+
+    def test_delay_is_stopped(self):
+        processor = requestprocessor.RequestProcessor('a@example.com', 'password',
+                                                      cancellation.CancellationToken(timeout=0.05))
+        started = time.time()
+        self.assertRaises(cancellation.OperationCancelledError, processor._do_fake_delay)
+        self.assertTrue(time.time() - started < 1)
+
+    def test_token_of_the_thread_is_used(self):
+        processor = requestprocessor.RequestProcessor('a@example.com', 'password')
+        token = cancellation.CancellationToken()
+        token.cancel()
+        with cancellation.use(token):
+            self.assertRaises(cancellation.OperationCancelledError, processor._sleep, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
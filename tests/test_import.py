@@ -0,0 +1,78 @@
+'''
+Importing adwords.mapper has to stay cheap: no engine, no database
+driver and no log file until the mapper is first used.
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ADWORDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords')
+
+# imports the mapper with the default (MySQL) settings and reports back
+SCRIPT = '''
+import sys, time, json
+sys.path.insert(0, %r)
+
+import sqlalchemy
+engines = []
+def create_engine(*args, **kwargs):
+    engines.append(args)
+    return original(*args, **kwargs)
+original, sqlalchemy.create_engine = sqlalchemy.create_engine, create_engine
+
+started = time.time()
+import mapper
+elapsed = time.time() - started
+
+import configuration
+print json.dumps({
+    'elapsed': elapsed,
+    'engines': len(engines),
+    'default_created': configuration._default is not None,
+    'dialects': [name for name in sys.modules if name.startswith('sqlalchemy.databases.')],
+    'mysqldb_loaded': 'MySQLdb' in sys.modules,
+})
+'''
+
+#-------------------------------------------------------------------------------
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def import_mapper(self):
+        output = subprocess.Popen([sys.executable, '-c', SCRIPT % ADWORDS], cwd=self.directory,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_no_engine_is_created(self):
+        result = self.import_mapper()
+        self.assertEqual(result['engines'], 0)
+        self.assertFalse(result['default_created'])
+
+    def test_database_driver_is_not_loaded(self):
+        result = self.import_mapper()
+        self.assertFalse(result['mysqldb_loaded'])
+        self.assertEqual(result['dialects'], [])
+
+    def test_log_file_is_not_opened(self):
+        self.import_mapper()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_import_time(self):
+        elapsed = self.import_mapper()['elapsed']
+        sys.stderr.write('\nadwords.mapper imported in %.3fs ' % elapsed)
+        self.assertTrue(elapsed < 5, 'importing adwords.mapper took %.1fs' % elapsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+'''
+Tests of adwords.keywordcodec.
+'''
+
+import os
+import sys
+import random
+import decimal
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import keywordcodec
+from requestprocessor import Keyword
+
+D = decimal.Decimal
+
+#-------------------------------------------------------------------------------
+
+WORDS = ['red', 'blue', 'shoes', 'cheap', 'buy', 'online', 'free', 'shipping', 'size', '10', 'kids', '*', '**']
+
+
+def random_keyword(rng):
+    text = ' '.join([rng.choice(WORDS) for i in range(rng.randint(1, 4))])
+    text = rng.choice(['%s', '[%s]', '"%s"', '-%s']) % text
+
+    bid = None
+    if rng.random() < 0.6:
+        # any number of decimal places, not only the encodable whole cents
+        bid = D(rng.randint(1, 50000)).scaleb(-rng.choice([0, 1, 2, 2, 2, 3, 4]))
+    url = None
+    if rng.random() < 0.4:
+        url = 'http://example.com/%s?kw=%d' % (rng.choice(WORDS), rng.randint(0, 1000))
+
+    return Keyword(text, bid, url)
+
+
+def is_encodable(keyword):
+    try:
+        keywordcodec.encode_keyword(keyword)
+    except ValueError:
+        return False
+    return True
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_random_blocks(self):
+        rng = random.Random(0)
+        for i in range(200):
+            block = [random_keyword(rng) for j in range(rng.randint(0, 200))]
+            encodable = [keyword for keyword in block if is_encodable(keyword)]
+
+            if len(encodable) < len(block):
+                self.assertRaises(ValueError, keywordcodec.encode, block)
+            self.assertEqual(keywordcodec.decode(keywordcodec.encode(encodable)), encodable)
+
+    def test_refused_keywords_are_the_ones_not_decoding_back(self):
+        rng = random.Random(1)
+        for i in range(2000):
+            keyword = random_keyword(rng)
+            in_cents = keyword.bid is None or keyword.bid == keyword.bid.quantize(keywordcodec.CENT)
+            broken = keywordcodec.SEPARATOR in keyword.keyword \
+                or keyword.keyword.endswith(' **') and (keyword.bid or keyword.url)
+            self.assertEqual(is_encodable(keyword), in_cents and not broken, repr(keyword))
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_bids_have_two_decimal_places(self):
+        for bid, text in [(D('1'), '1.00'), (D('1.5'), '1.50'), (D('1.500'), '1.50'), (D('1E+2'), '100.00'),
+                          (2, '2.00'), ('0.35', '0.35')]:
+            self.assertEqual(keywordcodec.encode_keyword(Keyword('a', bid)), 'a ** ' + text)
+
+    def test_float_bids(self):
+        self.assertEqual(keywordcodec.encode_keyword(Keyword('a', 0.1)), 'a ** 0.10')
+        self.assertEqual(keywordcodec.encode_keyword(Keyword('a', 1.25, 'http://x')), 'a ** 1.25 ** http://x')
+        self.assertEqual(Keyword('a', 0.1).bid, D('0.1'))
+
+    def test_bids_not_in_whole_cents_are_refused(self):
+        for bid in ['1.005', '0.001', '-1', 'NaN', 'Infinity', '1E+40']:
+            self.assertRaises(ValueError, keywordcodec.encode_keyword, Keyword('a', D(bid)))
+
+    def test_separator_and_line_breaks_are_refused(self):
+        for keyword in [Keyword('a ** b'), Keyword('a\nb'), Keyword('a\r'), Keyword('a', None, 'u ** v'),
+                        Keyword('a **', D(1)), Keyword('a', D(1), 'u\r\nv'), 'x ** y']:
+            self.assertRaises(ValueError, keywordcodec.encode, [Keyword('ok'), keyword])
+
+    def test_url_in_place_of_a_bid(self):
+        self.assertRaises(ValueError, keywordcodec.encode_keyword, Keyword('a', None, '5'))
+        self.assertEqual(keywordcodec.encode_keyword(Keyword('a', D(1), '5')), 'a ** 1.00 ** 5')
+
+    def test_url_filter(self):
+        encoded = keywordcodec.encode([Keyword('a', None, 'http://x/%s')], lambda url: url % 'y')
+        self.assertEqual(encoded, 'a ** http://x/y')
+
+    def test_strings_and_blocks(self):
+        self.assertEqual(keywordcodec.encode([]), '')
+        self.assertEqual(keywordcodec.encode(iter(['a', Keyword('b', D(1))])), 'a\r\nb ** 1.00')
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_decode(self):
+        block = 'a ** 0.50\r\n\r\nb ** http://x\nc ** 1 ** http://y\r\nd\n'
+        self.assertEqual(keywordcodec.decode(block), [Keyword('a', D('0.50')), Keyword('b', None, 'http://x'),
+                                                      Keyword('c', D(1), 'http://y'), Keyword('d')])
+
+    def test_bids_are_exact(self):
+        keyword = keywordcodec.decode('a ** 0.35')[0]
+        self.assertTrue(isinstance(keyword.bid, decimal.Decimal))
+        self.assertEqual(str(keyword.bid), '0.35')
+
+
+if __name__ == '__main__':
+    unittest.main()
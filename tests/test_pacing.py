@@ -0,0 +1,94 @@
+'''
+Tests of adwords.pacing.
+'''
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import pacing
+import requestprocessor
+
+#-------------------------------------------------------------------------------
+
+class ControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = pacing.PacingController(min_delay=1, max_delay=10, step=0.5, backoff=2,
+                                                  slow_response=2, smoothing=0.5)
+
+    def test_quick_responses_shorten_the_delay(self):
+        initial = self.controller.get_delay('a', 'op')
+        for i in range(4):
+            self.controller.record_success('a', 'op', 0.1)
+        self.assertEqual(self.controller.get_delay('a', 'op'), max(1, initial - 2))
+
+    def test_failures_lengthen_it_within_bounds(self):
+        for i in range(10):
+            self.controller.record_success('a', 'op', 0.1)
+        self.controller.record_failure('a', 'op')
+        self.assertEqual(self.controller.get_delay('a', 'op'), 2)
+        for i in range(10):
+            self.controller.record_failure('a', 'op')
+        self.assertEqual(self.controller.get_delay('a', 'op'), 10)
+        self.assertEqual(self.controller.state()[('a', 'op')]['failures'], 11)
+
+    def test_slow_responses_lengthen_it(self):
+        for i in range(4):
+            self.controller.record_success('a', 'op', 0.1)
+        delay = self.controller.get_delay('a', 'op')
+        self.controller.record_success('a', 'op', 1.0)
+        self.assertEqual(self.controller.get_delay('a', 'op'), delay + 0.5)
+
+    def test_reserve_spaces_requests_of_an_account(self):
+        self.assertAlmostEqual(self.controller.reserve('a', 1.0), 1.0, 2)
+        self.assertAlmostEqual(self.controller.reserve('a', 1.0), 2.0, 2)
+        self.assertAlmostEqual(self.controller.reserve('b', 0.5), 0.5, 2)
+        self.controller.reset()
+        self.assertAlmostEqual(self.controller.reserve('a', 1.0), 1.0, 2)
+
+
+class ProcessorDelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._settings = settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX, settings.ADAPTIVE_PACING
+        settings.FAKE_DELAY_MIN = settings.FAKE_DELAY_MAX = 0.05
+        settings.ADAPTIVE_PACING = False
+        pacing.get_controller().reset()
+
+    def tearDown(self):
+        settings.FAKE_DELAY_MIN, settings.FAKE_DELAY_MAX, settings.ADAPTIVE_PACING = self._settings
+
+    def test_forks_share_the_delays(self):
+        processor = requestprocessor.RequestProcessor('a@example.com', 'password')
+        processors = [processor] + [processor.fork() for i in range(3)]
+
+        started = time.time()
+        threads = [threading.Thread(target=forked._do_fake_delay) for forked in processors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - started >= 4 * 0.05 - 0.01)
+
+    def test_other_accounts_do_not_wait(self):
+        processors = [requestprocessor.RequestProcessor('%d@example.com' % i, 'password') for i in range(4)]
+
+        started = time.time()
+        threads = [threading.Thread(target=processor._do_fake_delay) for processor in processors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - started < 2 * 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
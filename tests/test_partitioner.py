@@ -0,0 +1,124 @@
+'''
+Tests of adwords.partitioner.
+'''
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import partitioner
+from requestprocessor import Keyword
+
+#-------------------------------------------------------------------------------
+
+class PartitionerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._max_keywords = settings.MAX_KEYWORDS_PER_ADGROUP
+        settings.MAX_KEYWORDS_PER_ADGROUP = 10
+
+    def tearDown(self):
+        settings.MAX_KEYWORDS_PER_ADGROUP = self._max_keywords
+
+
+def keywords(count, start=0):
+    return ['keyword %d' % i for i in range(start, start + count)]
+
+
+class ContiguousPartitionerTest(PartitionerTestCase):
+
+    def test_count(self):
+        contiguous = partitioner.ContiguousPartitioner()
+        self.assertEqual([contiguous.count(n) for n in [0, 1, 10, 11, 20, 21]], [0, 1, 1, 2, 2, 3])
+        self.assertEqual(contiguous.count(11, current_count=5), 2)
+
+    def test_split_keeps_the_order(self):
+        parts = list(partitioner.ContiguousPartitioner().split(iter(keywords(25))))
+        self.assertEqual([len(part) for part in parts], [10, 10, 5])
+        self.assertEqual(sum(parts, []), keywords(25))
+
+
+class HashPartitionerTest(PartitionerTestCase):
+
+    def setUp(self):
+        PartitionerTestCase.setUp(self)
+        self.hash = partitioner.HashPartitioner(fill=0.8, replicas=64)
+
+    def test_count_fills_adgroups_partly(self):
+        self.assertEqual(self.hash.count(0), 1)
+        self.assertEqual(self.hash.count(8), 1)
+        self.assertEqual(self.hash.count(9), 2)
+        self.assertEqual(self.hash.count(80), 10)
+
+    def test_count_keeps_a_near_current_count(self):
+        self.assertEqual(self.hash.count(80, current_count=9), 9)
+        self.assertEqual(self.hash.count(80, current_count=20), 20)
+        # too few adgroups to hold the keywords, or too many to fill
+        self.assertEqual(self.hash.count(80, current_count=7), 10)
+        self.assertEqual(self.hash.count(80, current_count=21), 10)
+
+    def test_every_keyword_is_placed_once(self):
+        given = keywords(500)
+        parts = self.hash.split(given)
+        self.assertEqual(len(parts), self.hash.count(500))
+        self.assertTrue(max([len(part) for part in parts]) <= settings.MAX_KEYWORDS_PER_ADGROUP)
+        self.assertEqual(sorted(sum(parts, [])), sorted(given))
+
+    def test_parts_do_not_depend_on_the_order(self):
+        given = keywords(200)
+        shuffled = list(given)
+        random.Random(0).shuffle(shuffled)
+        self.assertEqual([sorted(part) for part in self.hash.split(given)],
+                         [sorted(part) for part in self.hash.split(shuffled)])
+
+    def test_parts_keep_the_keywords_order(self):
+        given = keywords(100)
+        for part in self.hash.split(given):
+            self.assertEqual(part, sorted(part, key=given.index))
+
+    def test_a_new_keyword_changes_one_part(self):
+        given = keywords(150)
+        before = self.hash.split(given, 19)
+        after = self.hash.split(given + ['new keyword'], 19)
+        self.assertEqual(len(before), len(after))
+        changed = [index for index in range(len(before)) if before[index] != after[index]]
+        self.assertEqual(len(changed), 1)
+        self.assertTrue('new keyword' in after[changed[0]])
+
+    def test_a_new_adgroup_moves_few_keywords(self):
+        given = keywords(150)
+        before = self.hash.split(given, 19)
+        after = self.hash.split(given, 20)
+        self.assertEqual(len(after), 20)
+        # besides the keywords it takes, only some which spilled over from
+        # a full adgroup may go back to it
+        moved = sum([len(frozenset(after[index]) - frozenset(before[index])) for index in range(19)])
+        self.assertTrue(0 < len(after[19]) and moved <= len(after[19]), (len(after[19]), moved))
+
+    def test_duplicates_go_to_the_same_part(self):
+        given = keywords(50) + ['KEYWORD  7', Keyword('keyword 7', 1), '[keyword 7]']
+        parts = self.hash.split(given)
+        holding = [part for part in parts if 'keyword 7' in part][0]
+        self.assertTrue('KEYWORD  7' in holding)
+        self.assertTrue([keyword for keyword in holding if isinstance(keyword, Keyword)])
+
+    def test_no_keywords(self):
+        self.assertEqual(self.hash.split(iter([])), [])
+
+
+class GetPartitionerTest(unittest.TestCase):
+
+    def test_get_partitioner(self):
+        self.assertTrue(isinstance(partitioner.get_partitioner('hash'), partitioner.HashPartitioner))
+        self.assertTrue(partitioner.get_partitioner('hash') is partitioner.get_partitioner('hash'))
+        self.assertRaises(ValueError, partitioner.get_partitioner, 'random')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+'''
+Tests of mapper.transactional nesting.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import configuration
+import mapper
+
+#-------------------------------------------------------------------------------
+
+@mapper.transactional
+def add_account(email):
+    # adds without committing, the decorator has to
+    mapper.get_session().add(mapper.Account(email, 'password'))
+
+
+@mapper.transactional
+def add_account_failing(email):
+    add_account(email)
+    raise RuntimeError('failed')
+
+
+def count_accounts(config):
+    return config.engine.execute('SELECT COUNT(*) FROM adwords_accounts').scalar()
+
+
+class TransactionalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.first = configuration.Configuration('sqlite:///' + os.path.join(self.directory, 'first.db'))
+        self.second = configuration.Configuration('sqlite:///' + os.path.join(self.directory, 'second.db'))
+        for config in (self.first, self.second):
+            with configuration.use(config):
+                mapper.install()
+
+    def tearDown(self):
+        self.first.dispose()
+        self.second.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_commits_on_return(self):
+        with configuration.use(self.first):
+            add_account('a@example.com')
+        self.assertEqual(count_accounts(self.first), 1)
+
+    def test_nested_call_rolls_back_with_outer(self):
+        with configuration.use(self.first):
+            self.assertRaises(RuntimeError, add_account_failing, 'a@example.com')
+        self.assertEqual(count_accounts(self.first), 0)
+
+    def test_nested_call_under_other_configuration_commits(self):
+        @mapper.transactional
+        def outer():
+            add_account('a@example.com')
+            with configuration.use(self.second):
+                add_account('b@example.com')
+            # the second session is done with before the outer call returns
+            self.assertEqual(count_accounts(self.second), 1)
+            self.assertEqual(count_accounts(self.first), 0)
+
+        with configuration.use(self.first):
+            outer()
+        self.assertEqual(count_accounts(self.first), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+Tests of adwords.transport recording and replaying.
+'''
+
+import os
+import sys
+import shutil
+import urllib
+import urllib2
+import tempfile
+import StringIO
+import mimetools
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'adwords'))
+
+import settings
+settings.LOG_FILE = None
+
+import transport
+
+#-------------------------------------------------------------------------------
+
+HEADERS = 'Content-Type: text/html\r\nSet-Cookie: SID=secret;\r\n path=/\r\nX-Other: 1\r\n\r\n'
+
+
+class Response:
+
+    def __init__(self, url, body, code=200):
+        self.url = url
+        self.code = code
+        self._body = StringIO.StringIO(body)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return mimetools.Message(StringIO.StringIO(HEADERS))
+
+
+class FakeTransport(transport.UrllibTransport):
+    '''
+    Answers from a dict of url => body, other urls fail.
+    '''
+
+    def __init__(self, pages):
+        transport.UrllibTransport.__init__(self)
+        self.pages = pages
+
+    def open(self, request):
+        url = request.get_full_url()
+        if url not in self.pages:
+            raise urllib2.URLError('unreachable')
+        body = self.pages[url]
+        if isinstance(body, int):
+            raise urllib2.HTTPError(url, body, 'Error', mimetools.Message(StringIO.StringIO(HEADERS)),
+                                    StringIO.StringIO('error page'))
+        return Response(url + '#landed', body)
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cassette')
+        self.pages = {
+            'https://x/a?key=1': 'page a \xff',
+            'https://x/b': 'page b',
+            'https://x/missing': 404,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, urls, data=None):
+        recorder = transport.RecordingTransport(transport.Cassette(self.path), FakeTransport(self.pages))
+        result = []
+        for url in urls:
+            request = recorder.create_request(url)
+            if data is not None:
+                request.add_data(data)
+            result.append(fetch(recorder, request))
+        return result
+
+    def test_replay(self):
+        urls = ['https://x/a?key=1', 'https://x/b', 'https://x/missing', 'https://x/down', 'https://x/b']
+        recorded = self.record(urls)
+
+        replayer = transport.ReplayTransport(transport.Cassette(self.path), speed=0)
+        replayed = [fetch(replayer, urllib2.Request(url)) for url in urls]
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(recorded[0], ('https://x/a?key=1#landed', 200, 'page a \xff'))
+        self.assertEqual(recorded[2], ('https://x/missing', 404, 'error page'))
+        self.assertEqual(recorded[3], ('URLError', 'unreachable'))
+
+        self.assertRaises(transport.CassetteError, replayer.open, urllib2.Request('https://x/b'))
+
+    def test_replay_falls_back_to_the_path(self):
+        self.record(['https://x/a?key=1'])
+        replayer = transport.ReplayTransport(transport.Cassette(self.path), speed=0)
+        self.assertEqual(fetch(replayer, urllib2.Request('https://x/a?key=2'))[2], 'page a \xff')
+
+    def test_rewind(self):
+        self.record(['https://x/b'])
+        cassette = transport.Cassette(self.path)
+        replayer = transport.ReplayTransport(cassette, speed=0)
+        fetch(replayer, urllib2.Request('https://x/b'))
+        cassette.rewind()
+        self.assertEqual(fetch(replayer.fork(), urllib2.Request('https://x/b'))[2], 'page b')
+
+    def test_credentials_and_cookies_are_scrubbed(self):
+        data = urllib.urlencode([('service', 'adwords'), ('Email', 'a@example.com'), ('Passwd', 'p&ss'), ('x', '1')])
+        response = self.record(['https://x/b', 'https://x/missing'], data)
+
+        recorded = open(self.path, 'rb').read()
+        for secret in ['example.com', 'p%26ss', 'SID', 'secret', 'path=']:
+            self.assertFalse(secret in recorded, secret)
+
+        interaction = transport.Cassette(self.path).take('POST', 'https://x/b')
+        self.assertEqual(interaction['data'], 'service=adwords&Email=scrubbed&Passwd=scrubbed&x=1')
+        self.assertEqual(interaction['headers'],
+                         'Content-Type: text/html\r\nSet-Cookie: scrubbed\r\nX-Other: 1\r\n')
+
+    def test_scrub_headers_keeps_the_others(self):
+        self.assertEqual(transport._scrub_headers('A: 1\r\n folded\r\ncookie: x\r\n y\r\nB: 2\r\n'),
+                         'A: 1\r\n folded\r\ncookie: scrubbed\r\nB: 2\r\n')
+
+
+def fetch(transport_, request):
+    try:
+        response = transport_.open(request)
+    except urllib2.HTTPError, e:
+        return e.geturl(), e.code, e.read()
+    except urllib2.URLError, e:
+        return 'URLError', e.reason
+    return response.geturl(), response.code, response.read()
+
+
+if __name__ == '__main__':
+    unittest.main()